@@ -1,78 +1,52 @@
 # encoding: utf-8
 from __future__ import print_function
 
-import random
-
 import numpy as np
 
+from random_streams import py_random
 
-# noinspection PyNoneFunctionAssignment
-def align_link_nd(scores, need, num_candidates, hh, fcols_labels,
-                  secondary_axis=None):
-    # need and num_candidates are LabeledArray, but we don't need the extra
-    # functionality from this point on
-    need = np.asarray(need)
-    num_candidates = np.asarray(num_candidates)
-    print("total needed", need.sum())
-
-    still_needed = need.copy()
-    still_available = num_candidates.copy()
-
-    rel_need = still_needed.astype(np.float64) / still_available
-
-    unfillable_bins = still_needed > still_available
-    filled_bins = still_needed <= 0
-
-    if secondary_axis is not None:
-        assert secondary_axis < need.ndim
-        other_axes = list(range(need.ndim))
-        other_axes.pop(secondary_axis)
-        other_axes = tuple(other_axes)
-        # requires np 1.7+
-        still_needed_by_sec_axis = need.sum(axis=other_axes)
-        print("needed by secondary axis", still_needed_by_sec_axis)
-    else:
-        still_needed_by_sec_axis = None
 
-    still_needed_total = need.sum()
-
-    col_range = list(range(len(fcols_labels)))
-    aligned = np.zeros(len(hh), dtype=bool)
-    sorted_indices = scores.argsort()[::-1]
+def py_align_households(sorted_indices, hh_indptr, hh_bins, hh_sec_values,
+                        still_needed, still_available, rel_need,
+                        filled_bins, unfillable_bins,
+                        still_needed_by_sec_axis, still_needed_total,
+                        random_func):
+    """
+    pure-python version of calign.align_households, used when the C
+    extension is not available. See there for the meaning of the arguments.
+    All "bin" arrays are flat and are updated in-place.
+    """
+    aligned = np.zeros(len(hh_indptr) - 1, dtype=bool)
     for sorted_idx in sorted_indices:
         if still_needed_total <= 0:
-            print("total reached")
             break
-        persons_in_hh_indices = hh[sorted_idx]
-        num_persons_in_hh = len(persons_in_hh_indices)
+        start, stop = hh_indptr[sorted_idx], hh_indptr[sorted_idx + 1]
+        num_persons_in_hh = stop - start
 
         # this will usually happen when the household is not a candidate
         # and thus no person in the household is a candidate either
         if num_persons_in_hh == 0:
             continue
 
-        persons_in_hh = tuple(np.empty(num_persons_in_hh, dtype=int)
-                              for _ in col_range)
-        prange = list(range(num_persons_in_hh))
-        for hh_col, fcol_labels in zip(persons_in_hh, fcols_labels):
-            for i in prange:
-                hh_col[i] = fcol_labels[persons_in_hh_indices[i]]
+        persons_bins = hh_bins[start:stop]
 
         # Keep the highest relative need index for the family
-        hh_rel_need = np.nanmax(rel_need[persons_in_hh])
+        hh_rel_need = np.nanmax(rel_need[persons_bins])
 
-        # count number of objects in the family belonging to already filled bins
-        surplus = filled_bins[persons_in_hh].sum()
-        if secondary_axis is not None and surplus == 0:
-            hh_axis_values = persons_in_hh[secondary_axis]
+        # count number of objects in the family belonging to already
+        # filled bins
+        surplus = filled_bins[persons_bins].sum()
+        if still_needed_by_sec_axis is not None and surplus == 0:
+            hh_axis_values = hh_sec_values[start:stop]
             axis_num_pvalues = len(still_needed_by_sec_axis)
             hh_counts_by_sec_axis = np.bincount(hh_axis_values,
                                                 minlength=axis_num_pvalues)
             if np.any(hh_counts_by_sec_axis >= still_needed_by_sec_axis):
                 surplus = 1
 
-        # count number of objects in the family belonging to unfillable bins
-        num_unfillable = unfillable_bins[persons_in_hh].sum()
+        # count number of objects in the family belonging to unfillable
+        # bins
+        num_unfillable = unfillable_bins[persons_bins].sum()
 
         # if either surplus or unfillable are not zero, adjust rel_need:
         if (surplus != 0) or (num_unfillable != 0):
@@ -85,7 +59,7 @@ def align_link_nd(scores, need, num_candidates, hh, fcols_labels,
 
         # Run through the random selection process, using rel_need as the
         # probability
-        if random.random() < hh_rel_need:
+        if random_func() < hh_rel_need:
             aligned[sorted_idx] = True
 
             # update all counters
@@ -93,34 +67,95 @@ def align_link_nd(scores, need, num_candidates, hh, fcols_labels,
 
             # update grids (only the bins present in the family)
 
-            # Note that we have to loop explicitly on individuals, instead
-            # of using xxx[persons_in_hh] += 1 because that syntax does not
-            # work as expected when there are more than one family member
-            # in a bin (it does not increment the bin several times)
-            for values in zip(*persons_in_hh):
-                sn = still_needed[values] - 1
-                still_needed[values] = sn
+            # Note that we have to use np.subtract.at instead of
+            # xxx[persons_bins] -= 1 because that syntax does not work as
+            # expected when there are more than one family member in a
+            # bin (it does not decrement the bin several times)
+            np.subtract.at(still_needed, persons_bins, 1)
+            np.subtract.at(still_available, persons_bins, 1)
+            if still_needed_by_sec_axis is not None:
+                np.subtract.at(still_needed_by_sec_axis,
+                               hh_sec_values[start:stop], 1)
+            sn = still_needed[persons_bins]
+            # unfillable stays unchanged in this case
+            filled_bins[persons_bins] = sn <= 0
+            # using np.float64 to workaround an issue with numpy 1.8
+            # https://github.com/numpy/numpy/issues/4636
+            rel_need[persons_bins] = \
+                sn.astype(np.float64) / still_available[persons_bins]
+        else:
+            np.subtract.at(still_available, persons_bins, 1)
+            sa = still_available[persons_bins]
+            sn = still_needed[persons_bins]
+            unfillable_bins[persons_bins] = sn > sa
+            rel_need[persons_bins] = sn.astype(np.float64) / sa
+    return aligned, still_needed_total
+
+
+try:
+    from calign import align_households
+except ImportError:
+    align_households = py_align_households
+
+
+def align_link_nd(scores, need, num_candidates, hh_indptr, hh_members,
+                  fcols_labels, secondary_axis=None):
+    """
+    * hh_indptr and hh_members describe the (candidate) persons of each
+      household: those of household i are
+      hh_members[hh_indptr[i]:hh_indptr[i + 1]]. hh_members are indices
+      valid for the fcols_labels columns.
+    * fcols_labels is a list of label columns (one per dimension of need)
+    """
+    # need and num_candidates are LabeledArray, but we don't need the extra
+    # functionality from this point on
+    need = np.asarray(need)
+    num_candidates = np.asarray(num_candidates)
+    print("total needed", need.sum())
 
-                sa = still_available[values] - 1
-                still_available[values] = sa
+    # from this point on, we work on flat versions of the grids and on the
+    # (flat) bin index of each person, in household order
+    still_needed = need.astype(np.int64).ravel()
+    still_available = num_candidates.astype(np.int64).ravel()
 
-                if secondary_axis is not None:
-                    still_needed_by_sec_axis[values[secondary_axis]] -= 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_need = still_needed.astype(np.float64) / still_available
 
-                # unfillable stays unchanged in this case
-                filled_bins[values] = sn <= 0
+    unfillable_bins = still_needed > still_available
+    filled_bins = still_needed <= 0
 
-                # using np.float64 to workaround an issue with numpy 1.8
-                # https://github.com/numpy/numpy/issues/4636
-                rel_need[values] = np.float64(sn) / sa
-        else:
-            for values in zip(*persons_in_hh):
-                sa = still_available[values] - 1
-                still_available[values] = sa
-                sn = still_needed[values]
+    hh_members = np.asarray(hh_members, dtype=np.int64)
+    person_bins = np.ravel_multi_index(fcols_labels, need.shape)
+    hh_bins = person_bins.astype(np.int64)[hh_members]
 
-                unfillable_bins[values] = sn > sa
+    if secondary_axis is not None:
+        assert secondary_axis < need.ndim
+        other_axes = list(range(need.ndim))
+        other_axes.pop(secondary_axis)
+        other_axes = tuple(other_axes)
+        # requires np 1.7+
+        still_needed_by_sec_axis = need.sum(axis=other_axes).astype(np.int64)
+        print("needed by secondary axis", still_needed_by_sec_axis)
+        hh_sec_values = \
+            fcols_labels[secondary_axis].astype(np.int64)[hh_members]
+    else:
+        still_needed_by_sec_axis = None
+        hh_sec_values = None
+
+    still_needed_total = need.sum()
 
-                rel_need[values] = np.float64(sn) / sa
+    sorted_indices = scores.argsort()[::-1].astype(np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        aligned, still_needed_total = \
+            align_households(sorted_indices,
+                             np.asarray(hh_indptr, dtype=np.int64),
+                             hh_bins, hh_sec_values,
+                             still_needed, still_available, rel_need,
+                             filled_bins, unfillable_bins,
+                             still_needed_by_sec_axis, still_needed_total,
+                             py_random().random)
+    if still_needed_total <= 0:
+        print("total reached")
+    still_needed = still_needed.reshape(need.shape)
     print("missing %d individuals" % np.sum(still_needed))
     return aligned, still_needed
@@ -8,12 +8,16 @@ import numpy as np
 
 import config
 from align_link import align_link_nd
-from context import context_length
-from expr import Expr, Variable, expr_eval, missing_values, always
-from exprbases import FilteredExpression
+from context import context_length, EntityContext
+from expr import (Expr, Variable, ShortLivedVariable, GlobalVariable,
+                  GlobalArray, UnaryOp, BinaryOp, expr_eval, traverse_expr,
+                  missing_values, always, expr_cache)
+from exprbases import FilteredExpression, NumexprFunction
+from exprmisc import Trunc, Round
 from groupby import GroupBy
 from links import LinkGet, Many2One
 from partition import partition_nd, filter_to_indices
+from random_streams import np_random
 from importer import load_ndarray
 from utils import PrettyTable, LabeledArray
 
@@ -46,6 +50,86 @@ def kill_axis(axis_name, value, expressions, possible_values, need):
     return expressions, possible_values, need
 
 
+# expression nodes which are deterministic and only depend on their children
+# (variables, constants, ...). Partitions on expressions made exclusively of
+# those can be cached.
+PURE_NODE_TYPES = (Variable, GlobalVariable, UnaryOp, BinaryOp,
+                   NumexprFunction, Trunc, Round)
+
+
+class PartitionKey(Expr):
+    """
+    Represents the partition of individuals according to the values of
+    several expressions. This is only used as the "expression" part of
+    expr_cache keys, so that the usual cache invalidation (when any variable
+    used in the expressions or filter is assigned, or when individuals are
+    added or removed) applies to cached partitions.
+    """
+    __children__ = ('expressions', 'filter')
+
+    def __init__(self, expressions, filter, possible_values):
+        self.expressions = tuple(expressions)
+        self.filter = filter
+        self.possible_values = tuple(tuple(np.asarray(pv).tolist())
+                                     for pv in possible_values)
+
+    def __repr__(self):
+        return 'partition(%s, filter=%s, possible_values=%s)' \
+               % (list(self.expressions), self.filter,
+                  list(self.possible_values))
+
+
+def partition_cache_key(context, expressions, filter_expr, possible_values):
+    """
+    returns an expr_cache key for partitioning on expressions or None if
+    the partition cannot be cached.
+    """
+    # partitions of subsets of the entity (e.g. within new() or matching())
+    # are not worth caching
+    entity_context = context.entity_data
+    if not isinstance(entity_context, EntityContext) or \
+            not entity_context.is_array_period:
+        return None
+
+    entity = context.entity
+    # local variables (including function arguments) can be modified without
+    # going through an Assignment (and thus without invalidating the cache)
+    local_var_names = entity.local_var_names
+    for node in traverse_expr((expressions, filter_expr)):
+        if not isinstance(node, Expr):
+            continue
+        if not isinstance(node, PURE_NODE_TYPES):
+            return None
+        if isinstance(node, ShortLivedVariable):
+            return None
+        if isinstance(node, Variable) and not isinstance(node, GlobalArray) \
+                and (node.entity is not entity or
+                     node.name in local_var_names):
+            return None
+    key = (PartitionKey(expressions, filter_expr, possible_values),
+           context.period, context.entity_name, context.filter_expr)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def pvalues_labels(values, pvalues):
+    """
+    returns the index in pvalues of each value in values (or -1 for values
+    which are not in pvalues)
+    """
+    if not len(pvalues):
+        return np.full(len(values), -1, dtype=np.int32)
+    sorter = np.argsort(pvalues, kind='mergesort')
+    pos = np.searchsorted(pvalues, values, sorter=sorter)
+    pos[pos == len(pvalues)] = 0
+    labels = sorter[pos]
+    labels[pvalues[labels] != values] = -1
+    return labels.astype(np.int32)
+
+
 def align_get_indices_nd(ctx_length, groups, need, filter_value, score,
                          take_filter=None, leave_filter=None,
                          method="bysorting"):
@@ -131,7 +215,7 @@ You may want to use a logistic function.
                             group_maybe_indices[sorted_local_indices]
                     elif method == 'sidewalk':
                         sorted_global_indices = \
-                            np.random.permutation(group_maybe_indices)
+                            np_random().permutation(group_maybe_indices)
                 else:
                     # if the score expression is a constant, we don't need to
                     # sort indices. In that case, the alignment will first take
@@ -152,7 +236,7 @@ You may want to use a logistic function.
                                 maybe_to_take, proba_sum
                                 )
                             )
-                    u = np.random.uniform() + np.arange(maybe_to_take)
+                    u = np_random().uniform() + np.arange(maybe_to_take)
                     # on the random sample, score are cumulated and then, we
                     # extract indices of each value before each value of u
                     cum_score = np.cumsum(score[sorted_global_indices])
@@ -199,6 +283,11 @@ class AlignmentAbsoluteValues(FilteredExpression):
             self.args = (self.args[0], need) + self.args[2:]
         self.past_error = None
 
+    # without expressions, they are taken from the dimensions of need
+    @property
+    def uses_all_variables(self):
+        return not self.args[5]
+
     def collect_variables(self):
         # args[9] is the "link" argument
         # if self.args.link is None:
@@ -261,11 +350,11 @@ class AlignmentAbsoluteValues(FilteredExpression):
                 if config.debug and config.log_level == "processes":
                     print()
                     print("random sequence position before:",
-                          np.random.get_state()[2])
-                u = np.random.uniform(size=need.shape)
+                          np_random().get_state()[2])
+                u = np_random().uniform(size=need.shape)
                 if config.debug and config.log_level == "processes":
                     print("random sequence position after:",
-                          np.random.get_state()[2])
+                          np_random().get_state()[2])
                 need = int_need + (u < need - int_need)
             elif method == 'cutoff':
                 int_need = need.astype(int)
@@ -390,7 +479,8 @@ class AlignmentAbsoluteValues(FilteredExpression):
         need, expressions, possible_values = \
             self._eval_need(context, need, expressions, possible_values)
 
-        filter_value = expr_eval(self._getfilter(context, filter), context)
+        filter_expr = self._getfilter(context, filter)
+        filter_value = expr_eval(filter_expr, context)
 
         if filter_value is not None:
             num_to_align = np.sum(filter_value)
@@ -398,12 +488,25 @@ class AlignmentAbsoluteValues(FilteredExpression):
             num_to_align = ctx_length
 
         # retrieve the columns we need to work with
+        columns = None
         if expressions:
-            columns = [expr_eval(expr, context) for expr in expressions]
-            if filter_value is not None:
-                groups = partition_nd(columns, filter_value, possible_values)
-            else:
-                groups = partition_nd(columns, True, possible_values)
+            # alignments using the same expressions and filter in the same
+            # period (e.g. several processes aligned by age x gender) reuse
+            # the same partition, as long as none of the variables involved
+            # is modified in between.
+            cache_key = partition_cache_key(context, expressions, filter_expr,
+                                            possible_values)
+            groups = expr_cache.get(cache_key) if cache_key is not None \
+                else None
+            if groups is None:
+                columns = [expr_eval(expr, context) for expr in expressions]
+                if filter_value is not None:
+                    groups = partition_nd(columns, filter_value,
+                                          possible_values)
+                else:
+                    groups = partition_nd(columns, True, possible_values)
+                if cache_key is not None:
+                    expr_cache[cache_key] = groups
         else:
             columns = []
             if filter_value is not None:
@@ -419,6 +522,8 @@ class AlignmentAbsoluteValues(FilteredExpression):
                 unaligned[~filter_value] = False
             for member_indices in groups:
                 unaligned[member_indices] = False
+            if columns is None:
+                columns = [expr_eval(expr, context) for expr in expressions]
             self._display_unaligned(expressions, context['id'], columns,
                                     unaligned)
 
@@ -492,13 +597,8 @@ class AlignmentAbsoluteValues(FilteredExpression):
         filtered_length = len(filtered_columns[0])
         unaligned = np.zeros(filtered_length, dtype=bool)
         for fcol, pvalues in zip(filtered_columns, need.pvalues):
-            pvalues_index = dict((v, i) for i, v in enumerate(pvalues))
-            fcol_labels = np.empty(filtered_length, dtype=np.int32)
-            for i in range(filtered_length):
-                value_idx = pvalues_index.get(fcol[i], -1)
-                if value_idx == -1:
-                    unaligned[i] = True
-                fcol_labels[i] = value_idx
+            fcol_labels = pvalues_labels(np.asarray(fcol), np.asarray(pvalues))
+            unaligned |= fcol_labels == -1
             fcols_labels.append(fcol_labels)
 
         num_unaligned = np.sum(unaligned)
@@ -546,24 +646,20 @@ class AlignmentAbsoluteValues(FilteredExpression):
         num_candidates = expr_eval(groupby_expr, target_context)
 
         # fetch the list of linked individuals for each local individual.
-        # e.g. the list of person ids for each household
-        hh = np.empty(context_length(context), dtype=object)
-        # we can't use .fill([]) because it reuses the same list for all
-        # objects
-        for i in range(len(hh)):
-            hh[i] = []
-
-        # Even though this is highly sub-optimal, the time taken to create
-        # those lists of ids is very small compared to the total time taken
-        # for align_other (0.2s vs 4.26), so I shouldn't care too much about
-        # it for now.
-
+        # e.g. the list of person ids for each household. The persons of
+        # household i are hh_members[hh_indptr[i]:hh_indptr[i + 1]], in
+        # increasing order.
         # target_row (row of person) is an index valid for *filtered/label*
         # columns !
-        for target_row, source_row in enumerate(source_rows):
-            if source_row == -1:
-                continue
-            hh[source_row].append(target_row)
+        source_rows = np.asarray(source_rows, dtype=int)
+        valid_target_rows = (source_rows != -1).nonzero()[0]
+        valid_source_rows = source_rows[valid_target_rows]
+        hh_members = valid_target_rows[np.argsort(valid_source_rows,
+                                                  kind='mergesort')]
+        hh_counts = np.bincount(valid_source_rows,
+                                minlength=context_length(context))
+        hh_indptr = np.zeros(len(hh_counts) + 1, dtype=int)
+        np.cumsum(hh_counts, out=hh_indptr[1:])
 
         class FakeContainer(object):
             def __init__(self, length):
@@ -578,8 +674,8 @@ class AlignmentAbsoluteValues(FilteredExpression):
         # need = np.asarray(need)
         need = np.asarray(need)
         aligned, error = \
-            align_link_nd(score, need, num_candidates, hh, fcols_labels,
-                          secondary_axis)
+            align_link_nd(score, need, num_candidates, hh_indptr, hh_members,
+                          fcols_labels, secondary_axis)
         self.past_error = error
         return aligned
 
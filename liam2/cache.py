@@ -19,4 +19,6 @@ class Cache(dict):
             if (c_period == period and c_entity_name == entity_name and
                     expr_match):
                 # print("matches", key, " => invalidating")
-                del self[key]
+                # the key may have been removed by another thread in the
+                # meantime
+                self.pop(key, None)
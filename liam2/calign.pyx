@@ -0,0 +1,143 @@
+cimport cython
+
+cimport numpy as np
+import numpy as np
+from numpy cimport int8_t, int64_t, float64_t, ndarray
+
+from libc.math cimport isnan
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+def align_households(ndarray[int64_t] sorted_indices,
+                     ndarray[int64_t] hh_indptr,
+                     ndarray[int64_t] hh_bins,
+                     object hh_sec_values,
+                     ndarray[int64_t] still_needed,
+                     ndarray[int64_t] still_available,
+                     ndarray[float64_t] rel_need,
+                     ndarray[int8_t, cast=True] filled_bins,
+                     ndarray[int8_t, cast=True] unfillable_bins,
+                     object still_needed_by_sec_axis,
+                     int64_t still_needed_total,
+                     object random_func):
+    '''
+    Select households (in score order) until the need is fulfilled. This is
+    the inner loop of align_link_nd. All "bin" arrays are flat (raveled)
+    views on the need grid and are updated in-place.
+
+    Arguments:
+     * sorted_indices: household indices, by decreasing score
+     * hh_indptr: persons of household i are at hh_indptr[i]:hh_indptr[i + 1]
+                  in hh_bins (and hh_sec_values)
+     * hh_bins: (flat) bin index of each person, in household order
+     * hh_sec_values: None or the label along the secondary axis of each
+                      person, in household order (ndarray[int64])
+     * still_needed_by_sec_axis: None or ndarray[int64]
+     * random_func: function returning a random float in [0, 1)
+
+    Returns:
+     * aligned: ndarray[bool] which households were selected
+     * still_needed_total: number of individuals still needed
+    '''
+    cdef:
+        Py_ssize_t i, j, k, start, stop, hh_idx, b
+        Py_ssize_t num_hh = len(hh_indptr) - 1
+        Py_ssize_t num_sorted = len(sorted_indices)
+        Py_ssize_t num_sec_values = 0
+        int64_t num_persons, surplus, num_unfillable, sn, sa
+        float64_t hh_rel_need, value
+        bint use_sec_axis = still_needed_by_sec_axis is not None
+        ndarray[int64_t] sec_values
+        ndarray[int64_t] sec_needed
+        ndarray[int64_t] sec_counts
+        ndarray[int8_t, cast=True] aligned
+
+    aligned = np.zeros(num_hh, dtype=bool)
+    if use_sec_axis:
+        sec_values = hh_sec_values
+        sec_needed = still_needed_by_sec_axis
+        num_sec_values = len(sec_needed)
+        sec_counts = np.zeros(num_sec_values, dtype=np.int64)
+
+    for i in range(num_sorted):
+        if still_needed_total <= 0:
+            break
+        hh_idx = sorted_indices[i]
+        start = hh_indptr[hh_idx]
+        stop = hh_indptr[hh_idx + 1]
+        num_persons = stop - start
+
+        # this will usually happen when the household is not a candidate
+        # and thus no person in the household is a candidate either
+        if num_persons == 0:
+            continue
+
+        # Keep the highest relative need index for the family (ignoring NaNs,
+        # like np.nanmax)
+        hh_rel_need = np.nan
+        surplus = 0
+        num_unfillable = 0
+        for j in range(start, stop):
+            b = hh_bins[j]
+            value = rel_need[b]
+            if not isnan(value) and (isnan(hh_rel_need) or
+                                     value > hh_rel_need):
+                hh_rel_need = value
+            # count number of objects in the family belonging to already
+            # filled bins
+            surplus += filled_bins[b]
+            # count number of objects in the family belonging to unfillable
+            # bins
+            num_unfillable += unfillable_bins[b]
+
+        if use_sec_axis and surplus == 0:
+            for k in range(num_sec_values):
+                sec_counts[k] = 0
+            for j in range(start, stop):
+                sec_counts[sec_values[j]] += 1
+            for k in range(num_sec_values):
+                if sec_counts[k] >= sec_needed[k]:
+                    surplus = 1
+                    break
+
+        # if either surplus or unfillable are not zero, adjust rel_need:
+        if surplus != 0 or num_unfillable != 0:
+            if num_unfillable > surplus:
+                hh_rel_need = 1.0
+            elif num_unfillable == surplus:
+                hh_rel_need = 0.5
+            else:  # num_unfillable < surplus
+                hh_rel_need = 0.0
+
+        # Run through the random selection process, using rel_need as the
+        # probability
+        if random_func() < hh_rel_need:
+            aligned[hh_idx] = 1
+
+            # update all counters
+            still_needed_total -= num_persons
+
+            # update grids (only the bins present in the family)
+            for j in range(start, stop):
+                b = hh_bins[j]
+                sn = still_needed[b] - 1
+                still_needed[b] = sn
+                sa = still_available[b] - 1
+                still_available[b] = sa
+                if use_sec_axis:
+                    sec_needed[sec_values[j]] -= 1
+                # unfillable stays unchanged in this case
+                filled_bins[b] = sn <= 0
+                rel_need[b] = <float64_t>sn / sa
+        else:
+            for j in range(start, stop):
+                b = hh_bins[j]
+                sa = still_available[b] - 1
+                still_available[b] = sa
+                sn = still_needed[b]
+                unfillable_bins[b] = sn > sa
+                rel_need[b] = <float64_t>sn / sa
+
+    return aligned, still_needed_total
@@ -17,3 +17,15 @@ log_level = "functions"
 autodump = None
 autodump_file = None
 autodiff = None
+# number of individuals per block when evaluating element-wise expressions
+# (None evaluates them for all individuals at once)
+block_size = None
+# number of threads used to run independent processes concurrently
+threads = 1
+random_seed = None
+# whether each process draws its random numbers from its own stream
+random_streams = False
+# whether random numbers are drawn for each individual id (counter-based)
+common_random_numbers = False
+# whether to record the time spent in each process and expression
+profile = False
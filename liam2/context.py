@@ -186,19 +186,17 @@ class EntityContext(object):
                 # FIXME: lags will break if used from a context subset (eg in
                 # new() or groupby(): all individuals will be returned instead
                 # of only the "filtered" ones.
-                if (self.entity.array_lag is not None and
-                    array_period is not None and
-                    period == array_period - 1 and
-                        key in self.entity.array_lag.dtype.fields):
-                    return self.entity.array_lag[key]
+                lag_array = self.entity.array_lags.get(period)
+                if (lag_array is not None and
+                        key in lag_array.dtype.fields):
+                    return lag_array[key]
 
                 bounds = self.entity.output_rows.get(period)
                 if bounds is not None:
                     startrow, stoprow = bounds
                 else:
                     startrow, stoprow = 0, 0
-                return self.entity.table.read(start=startrow, stop=stoprow,
-                                              field=key)
+                return self.entity.read_output(startrow, stoprow, key)
 
     # is the current array period the same as the context period?
     @property
@@ -214,17 +212,15 @@ class EntityContext(object):
     def __contains__(self, key):
         entity = self.entity
         period = self.eval_ctx.period
-        array_period = entity.array_period
         # entity.array can be None! (eg. with "explore")
         keyinarray = (self.is_array_period and
                       (key in entity.temp_variables or
                        key in entity.array.dtype.fields))
-        # we need to check explicitly whether the key is in array_lag because
+        # we need to check explicitly whether the key is in array_lags because
         # with output=None it can contain more fields than table.
-        keyinlagarray = (entity.array_lag is not None and
-                         array_period is not None and
-                         period == array_period - 1 and
-                         key in entity.array_lag.dtype.fields)
+        lag_array = entity.array_lags.get(period)
+        keyinlagarray = (lag_array is not None and
+                         key in lag_array.dtype.fields)
         keyintable = (entity.table is not None and
                       key in entity.table.dtype.fields)
         return key in self.extra or keyinarray or keyinlagarray or keyintable
@@ -1,6 +1,7 @@
 # encoding: utf-8
 from __future__ import print_function
 
+import os
 import time
 
 import tables
@@ -9,8 +10,11 @@ import config
 
 from expr import (normalize_type, get_default_value, get_default_array,
                   get_default_vector, gettype)
-from utils import loop_wh_progress, time2str, safe_put, LabeledArray, timed
-from importer import load_def, stream_to_array, array_to_disk_array
+from utils import (loop_wh_progress, time2str, size2str, safe_put,
+                   LabeledArray, timed)
+from importer import (load_def, chunks_to_array, array_to_disk_array,
+                      compression_str2filter)
+from writer import BackgroundWriter
 
 MB = 2 ** 20
 
@@ -190,6 +194,10 @@ class ColumnArray(object):
         if stop is None:
             stop = len(table)
         dtype = table.dtype
+        if isinstance(table, NpyTable):
+            # except when the table is stored by columns
+            return cls([(name, table.read(start, stop, field=name))
+                        for name in dtype.names])
         max_buffer_rows = buffersize // dtype.itemsize
         numlines = stop - start
         ca = cls.empty(numlines, dtype)
@@ -447,8 +455,9 @@ def merge_arrays(array1, array2, result_fields='union', default_values=None):
     return output_array, id_to_rownum
 
 
-def append_table(input_table, output_table, chunksize=10000, condition=None,
-                 stop=None, show_progress=False, default_values=None):
+def append_table(input_table, output_table, chunksize=None, condition=None,
+                 stop=None, show_progress=False, default_values=None,
+                 buffersize=10 * MB):
 
     if input_table.dtype != output_table.dtype:
         output_fields = get_fields(output_table)
@@ -460,7 +469,15 @@ def append_table(input_table, output_table, chunksize=10000, condition=None,
     else:
         numrows = stop
 
-    if not chunksize:
+    if chunksize is None:
+        # copy as many rows as fit in the buffer at once, in a whole number of
+        # chunks of the output table
+        chunksize = buffersize // output_table.dtype.itemsize
+        table_chunk_rows = output_table.chunkshape[0]
+        if chunksize > table_chunk_rows:
+            chunksize -= chunksize % table_chunk_rows
+        chunksize = max(min(chunksize, numrows), 1)
+    elif not chunksize:
         chunksize = numrows
 
     num_chunks, remainder = divmod(numrows, chunksize)
@@ -506,7 +523,7 @@ def append_table(input_table, output_table, chunksize=10000, condition=None,
 
 # noinspection PyProtectedMember
 def copy_table(input_table, output_node, output_dtype=None,
-               chunksize=10000, condition=None, stop=None, show_progress=False,
+               chunksize=None, condition=None, stop=None, show_progress=False,
                default_values=None, **kwargs):
     complete_kwargs = {'title': input_table._v_title}
 #                       'filters': input_table.filters}
@@ -573,8 +590,9 @@ def build_period_array(input_table, output_fields, input_rows,
         input_id_to_rownum = input_index[period]
         id_is_in_period = input_id_to_rownum != -1
 
-        # which output rows are filled by input for this period
-        output_rownums = id_to_rownum[id_is_in_period]
+        # which output rows are filled by input for this period (the index of
+        # earlier periods can be shorter if larger ids appeared afterwards)
+        output_rownums = id_to_rownum[:len(id_is_in_period)][id_is_in_period]
 
         # get source rows (in the global array) for individuals in this period
         source_rows = output_array_source_rows[output_rownums]
@@ -674,6 +692,44 @@ def index_table_light(table, index='period'):
     return rows_per_period
 
 
+def index_columns(periods, ids):
+    """
+    same as index_table but for the period and id columns of a table (which
+    must be sorted by period), without looping over each row.
+    """
+    unordered = np.flatnonzero(periods[1:] < periods[:-1])
+    if len(unordered):
+        idx = unordered[0] + 1
+        msg = "data is not ordered by period ({} at data line {} is < {})"
+        raise Exception(msg.format(periods[idx], idx + 1, periods[idx - 1]))
+
+    rows_per_period = {}
+    id_to_rownum_per_period = {}
+    starts = np.flatnonzero(periods[1:] != periods[:-1]) + 1
+    starts = [0] + starts.tolist() if len(periods) else []
+    stops = starts[1:] + [len(periods)]
+    max_id_so_far = -1
+    for start, stop in zip(starts, stops):
+        period = periods[start]
+        period_ids = ids[start:stop]
+        max_id_so_far = max(max_id_so_far, period_ids.max())
+        id_to_rownum = np.full(max_id_so_far + 1, -1, dtype=int)
+        id_to_rownum[period_ids] = np.arange(stop - start)
+        if np.sum(id_to_rownum != -1) != stop - start:
+            # find the first duplicate
+            seen = np.zeros(max_id_so_far + 1, dtype=bool)
+            for idx, row_id in enumerate(period_ids):
+                if seen[row_id]:
+                    msg = "duplicate row for id {} for period {} (at data " \
+                          "line {})"
+                    raise Exception(msg.format(row_id, period,
+                                               start + idx + 1))
+                seen[row_id] = True
+        rows_per_period[period] = start, stop
+        id_to_rownum_per_period[period] = id_to_rownum
+    return rows_per_period, id_to_rownum_per_period
+
+
 class IndexedTable(object):
     def __init__(self, table, period_index, id2rownum_per_period):
         self.table = table
@@ -702,6 +758,62 @@ class IndexedTable(object):
         return min(self.period_index.keys())
 
 
+class NpyTable(object):
+    """
+    A table stored as a directory containing one .npy file per column. The
+    columns are memory-mapped and only read when needed. This implements the
+    part of the tables.Table API we use on input tables.
+    """
+    def __init__(self, path, names=None):
+        if not os.path.isdir(path):
+            raise Exception("could not find '%s' directory" % path)
+        available = [fname[:-4] for fname in sorted(os.listdir(path))
+                     if fname.endswith('.npy')]
+        if names is None:
+            names = available
+        else:
+            # missing columns are reported by assert_valid_type
+            names = [name for name in names if name in available]
+        columns = []
+        for name in names:
+            column = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            if column.ndim != 1:
+                raise Exception("%s.npy in '%s' has %d dimensions instead of 1"
+                                % (name, path, column.ndim))
+            columns.append((name, column))
+        lengths = set(len(column) for _, column in columns)
+        if len(lengths) > 1:
+            raise Exception("columns in '%s' do not all have the same length"
+                            % path)
+        self.name = os.path.basename(path)
+        self._v_title = "%s table" % self.name
+        self.columns = dict(columns)
+        self.dtype = np.dtype([(name, column.dtype)
+                               for name, column in columns])
+        self.nrows = lengths.pop() if lengths else 0
+
+    def __len__(self):
+        return self.nrows
+
+    def read(self, start=None, stop=None, field=None, out=None):
+        if field is not None:
+            return np.array(self.columns[field][start:stop])
+        start, stop, _ = slice(start, stop).indices(self.nrows)
+        if out is None:
+            out = np.empty(max(stop - start, 0), dtype=self.dtype)
+        for name in self.dtype.names:
+            out[name] = self.columns[name][start:stop]
+        return out
+
+    def read_coordinates(self, coords, field=None):
+        if field is not None:
+            return self.columns[field][coords]
+        out = np.empty(len(coords), dtype=self.dtype)
+        for name in self.dtype.names:
+            out[name] = self.columns[name][coords]
+        return out
+
+
 class DataSet(object):
     pass
 
@@ -714,8 +826,8 @@ def load_path_globals(globals_def):
             continue
         kind, info = load_def(localdir, name, global_def, [])
         if kind == 'table':
-            fields, numlines, datastream, csvfile = info
-            array = stream_to_array(fields, datastream, numlines)
+            fields, numlines, chunks, csvfile = info
+            array = chunks_to_array(fields, chunks, numlines)
         else:
             assert kind == 'ndarray'
             array = info
@@ -793,11 +905,36 @@ def index_tables(globals_def, entities, fpath):
 
 
 class DataSource(object):
+    def __init__(self, input_path=None):
+        self.input_path = input_path
+
+    def load(self, globals_def, entities):
+        raise NotImplementedError()
+
     def close(self):
         pass
 
+    @staticmethod
+    def set_input_tables(entities, entities_tables):
+        """
+        entities_tables is a dict {entity_name: IndexedTable}
+        """
+        for ent_name, entity in entities.iteritems():
+            table = entities_tables[ent_name]
+            # entity.indexed_input_table = table
+            entity.input_index = table.id2rownum_per_period
+            entity.input_rows = table.period_index
+            entity.input_table = table.table
+            entity.base_period = table.base_period
+
 
 class DataSink(object):
+    def flush(self):
+        pass
+
+    def show_sizes(self):
+        pass
+
     def close(self):
         pass
 
@@ -814,14 +951,7 @@ class H5Source(DataSource):
 
     def load(self, globals_def, entities):
         h5file, dataset = index_tables(globals_def, entities, self.input_path)
-        entities_tables = dataset['entities']
-        for ent_name, entity in entities.iteritems():
-            table = entities_tables[ent_name]
-            # entity.indexed_input_table = table
-            entity.input_index = table.id2rownum_per_period
-            entity.input_rows = table.period_index
-            entity.input_table = table.table
-            entity.base_period = table.base_period
+        self.set_input_tables(entities, dataset['entities'])
         self.h5in = h5file
         return dataset
 
@@ -838,14 +968,94 @@ class H5Source(DataSource):
             entity.table = table.table
 
 
+class NpySource(DataSource):
+    """
+    Reads data from a directory of .npy files (one per column), which avoids
+    converting the data to HDF5 first. The directory must contain:
+
+    * entities/<entity_name>/<field_name>.npy for each field of each entity,
+      sorted by period then id like in HDF5 input files. Those are
+      memory-mapped instead of read in memory.
+    * globals/<table_name>/<field_name>.npy for each field of a table global
+      (e.g. periodic).
+    * globals/<array_name>.npy for array globals.
+    """
+    def load(self, globals_def, entities):
+        print("reading data from %s ..." % self.input_path)
+        globals_data = load_path_globals(globals_def)
+        globals_dir = os.path.join(self.input_path, 'globals')
+        for name, global_def in globals_def.iteritems():
+            # already loaded from another source (path)
+            if name in globals_data:
+                continue
+
+            table_path = os.path.join(globals_dir, name)
+            array_path = table_path + '.npy'
+            if os.path.isdir(table_path):
+                array = NpyTable(table_path).read()
+            elif os.path.exists(array_path):
+                array = np.load(array_path)
+            else:
+                raise Exception("could not find 'globals/%s' in the input "
+                                "data directory" % name)
+            global_type = global_def.get('type', global_def.get('fields'))
+            assert_valid_type(array, global_type, context=name)
+            if isinstance(global_type, list):
+                array = add_and_drop_fields(array, global_type)
+            globals_data[name] = array
+
+        entities_tables = {}
+        print(" * indexing tables")
+        for ent_name, entity in entities.iteritems():
+            print("    -", ent_name, "...", end=' ')
+            fields = list(entity.fields.in_input.name_types)
+            table = NpyTable(os.path.join(self.input_path, 'entities',
+                                          ent_name),
+                             [name for name, _ in fields])
+            assert_valid_type(table, fields)
+            rows_per_period, id_to_rownum_per_period = \
+                timed(index_columns, table.columns['period'],
+                      table.columns['id'])
+            entities_tables[ent_name] = IndexedTable(table, rows_per_period,
+                                                     id_to_rownum_per_period)
+        self.set_input_tables(entities, entities_tables)
+        return {'globals': globals_data, 'entities': entities_tables}
+
+
+# maps the values of the "method" option of the input section of simulation
+# files to DataSource classes, which are given the input path. Other sources
+# can be added here.
+data_sources = {
+    'h5': H5Source,
+    'npy': NpySource,
+    'void': VoidSource
+}
+
+
 class H5Sink(DataSink):
-    def __init__(self, output_path):
+    def __init__(self, output_path, background_write=False, compression=None,
+                 shuffle=True, chunk_size=None, history='copy'):
+        if history not in ('copy', 'link'):
+            raise ValueError("'%s' is an invalid value for 'history'. It "
+                             "should be either 'copy' or 'link'" % history)
         self.output_path = output_path
         self.h5out = None
+        self.background_write = background_write
+        self.writer = None
+        self.compression_msg, self.filters = \
+            compression_str2filter(compression, shuffle)
+        self.chunk_size = chunk_size
+        self.history = history
 
     def prepare(self, globals_def, entities, input_dataset, start_period):
         """copy input (if any) to output and create output index"""
-        output_file = tables.open_file(self.output_path, mode="w")
+        # all nodes created in the file inherit those filters
+        output_file = tables.open_file(self.output_path, mode="w",
+                                       filters=self.filters)
+        if self.chunk_size is not None:
+            table_kwargs = {'chunkshape': (self.chunk_size,)}
+        else:
+            table_kwargs = {}
 
         try:
             globals_data = input_dataset.get('globals')
@@ -860,7 +1070,22 @@ class H5Sink(DataSink):
             output_entities = output_file.create_group("/", "entities",
                                                        "Entities")
             output_file.create_group("/", "indexes", "Indexes")
-            print(" * copying tables")
+            copy_history = self.history == 'copy'
+            if not copy_history and entities_tables:
+                input_table = next(entities_tables.itervalues()).table
+                # make the input history reachable from the output file. This
+                # is only possible for HDF5 input files, but the history is
+                # read from the input data in all cases.
+                if isinstance(input_table, tables.Table):
+                    # noinspection PyProtectedMember
+                    input_path = os.path.abspath(input_table._v_file.filename)
+                    output_file.create_external_link("/", "history",
+                                                     input_path + ":/entities")
+            action = "copying" if copy_history else "creating"
+            if self.filters is not None:
+                print(" *", action, "tables", self.compression_msg)
+            else:
+                print(" *", action, "tables")
             for ent_name, entity in entities.iteritems():
                 print("    -", ent_name, "...", end=' ')
                 index_node = output_file.create_group("/indexes", ent_name)
@@ -885,21 +1110,29 @@ class H5Sink(DataSink):
                         _, stoprow = input_rows[max(output_rows.iterkeys())]
                     else:
                         stoprow = 0
+                    output_index = table.id2rownum_per_period.copy()
+                else:
+                    output_rows = {}
+                    output_index = {}
 
+                if table is not None and copy_history:
                     default_values = entity.fields.default_values
                     output_table = copy_table(table.table, output_entities,
                                               entity.fields.in_output.dtype,
                                               stop=stoprow,
                                               show_progress=True,
-                                              default_values=default_values)
-                    output_index = table.id2rownum_per_period.copy()
+                                              default_values=default_values,
+                                              **table_kwargs)
                 else:
-                    output_rows = {}
                     output_table = output_file.create_table(
                         output_entities, entity.name,
                         entity.fields.in_output.dtype,
-                        title="%s table" % entity.name)
-                    output_index = {}
+                        title="%s table" % entity.name, **table_kwargs)
+                    if table is not None:
+                        # the rows of the periods before start_period are
+                        # read directly from the input table
+                        entity.history_table = table.table
+                        entity.history_nrows = stoprow
 
                 # entity.indexed_output_table = IndexedTable(output_table,
                 #                                            output_rows,
@@ -913,7 +1146,41 @@ class H5Sink(DataSink):
             raise
         self.h5out = output_file
 
+        if self.background_write:
+            # allow one period per entity to be pending
+            self.writer = BackgroundWriter(maxsize=max(len(entities), 1))
+            for entity in entities.itervalues():
+                entity.writer = self.writer
+
+    def flush(self):
+        """
+        waits until all data has been written
+        """
+        if self.writer is not None:
+            self.writer.wait()
+
+    def show_sizes(self):
+        """
+        shows the size of the data (table and indexes) of each entity in the
+        output file, compressed (on disk) and uncompressed
+        """
+        if self.h5out is None or self.filters is None:
+            return
+        print(" * output size (compressed / uncompressed):")
+        h5root = self.h5out.root
+        for table in h5root.entities:
+            nodes = [table] + list(h5root.indexes._f_get_child(table.name))
+            on_disk = sum(node.size_on_disk for node in nodes)
+            in_memory = sum(node.size_in_memory for node in nodes)
+            ratio = float(on_disk) / in_memory if in_memory else 1.0
+            print("    - %s: %s / %s (%.1f%%)"
+                  % (table.name, size2str(on_disk), size2str(in_memory),
+                     ratio * 100))
+
     def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
         if self.h5out is not None:
             self.h5out.close()
 
@@ -10,21 +10,43 @@ import numpy as np
 import tables
 
 import config
+from actions import RemoveIndividuals, Breakpoint, AssertRaises
+from alignment import AlignmentAbsoluteValues, PURE_NODE_TYPES
 from data import (merge_arrays, get_fields, ColumnArray, index_table,
-                  build_period_array)
+                  build_period_array, add_and_drop_fields)
 from expr import (Variable, VariableMethodHybrid, GlobalVariable, GlobalTable,
-                  GlobalArray, Expr, BinaryOp, MethodSymbol, normalize_type)
+                  GlobalArray, Expr, BinaryOp, MethodSymbol, normalize_type,
+                  get_default_vector, ShortLivedVariable, SubscriptedGlobal,
+                  FactoredVariable, MethodCall)
+from exprmisc import New
 from exprtools import parse
-from process import Assignment, ProcessGroup, While, Function, Return
+from groupby import GroupBy
+from links import LinkExpression, LinkGet, Aggregate
+from matching import Matching
+from process import (Assignment, ProcessGroup, While, Function, Return,
+                     all_nodes)
 from utils import (count_occurrences, field_str_to_type, size2str,
                    WarnOverrideDict, split_signature, argspec,
                    UserDeprecationWarning)
-from tfunc import ValueForPeriod
+from tfunc import ValueForPeriod, TimeFunction
+from writer import h5lock
 
 
 default_value_by_strtype = {"bool": False, "float": np.nan, 'int': -1}
 max_vars = 0
 
+# expression nodes which can be part of a factored common subexpression: they
+# are deterministic and their value for an individual does not depend on the
+# contextual filter
+CSE_NODE_TYPES = PURE_NODE_TYPES + (LinkGet, Aggregate)
+# nodes whose children are not evaluated in the context of the process (other
+# entity, period or subset of individuals). Common subexpressions are not
+# searched within them.
+CSE_OPAQUE_TYPES = (LinkExpression, TimeFunction, Matching, GroupBy, New,
+                    AlignmentAbsoluteValues, AssertRaises)
+# nodes which can change any variable or the number of individuals
+CSE_BARRIER_TYPES = (New, RemoveIndividuals, MethodCall, Breakpoint)
+
 # def compress_column(a, level):
 #    arr = bcolz.carray(a, cparams=bcolz.cparams(level))
 #    print "%d -> %d (%.2f)" % (arr.nbytes, arr.cbytes,
@@ -58,6 +80,163 @@ def global_symbols(globals_def):
     return symbols
 
 
+def is_cse_candidate(expr):
+    """
+    returns whether expr could be factored out of the expressions using it
+    """
+    if isinstance(expr, (Variable, GlobalVariable)) or \
+            not isinstance(expr, CSE_NODE_TYPES):
+        return False
+    has_variable = False
+    for node in all_nodes(expr):
+        if isinstance(node, Expr):
+            if not isinstance(node, CSE_NODE_TYPES) or \
+                    isinstance(node, (ShortLivedVariable, SubscriptedGlobal)):
+                return False
+            if isinstance(node, Variable):
+                has_variable = True
+    return has_variable
+
+
+def cse_candidates(expr):
+    """
+    yields all the subexpressions of expr which could be factored out
+    """
+    if isinstance(expr, Expr):
+        if is_cse_candidate(expr):
+            yield expr
+        if not isinstance(expr, CSE_OPAQUE_TYPES):
+            for node in cse_candidates(expr.children):
+                yield node
+    elif isinstance(expr, (tuple, list)):
+        for e in expr:
+            for node in cse_candidates(e):
+                yield node
+    elif isinstance(expr, slice):
+        for node in cse_candidates((expr.start, expr.stop, expr.step)):
+            yield node
+
+
+def cse_variable_names(expr):
+    """
+    returns the names of the variables (including link fields) the value of
+    expr depends on
+    """
+    names = set()
+    for node in all_nodes(expr):
+        if isinstance(node, Variable):
+            names.add(node.name)
+        elif isinstance(node, LinkExpression):
+            # noinspection PyProtectedMember
+            names.add(node.link._link_field)
+    return names
+
+
+def replace_subexpr(expr, old, new):
+    """
+    returns a copy of expr where all occurrences of old (outside of opaque
+    nodes) are replaced by new. Nodes which do not contain old are not copied.
+    """
+    if isinstance(expr, Expr):
+        if expr == old:
+            return new
+        if isinstance(expr, CSE_OPAQUE_TYPES):
+            return expr
+        d = expr.__dict__
+        changed = {}
+        for k in expr.__children__:
+            new_child = replace_subexpr(d[k], old, new)
+            if new_child is not d[k]:
+                changed[k] = new_child
+        if not changed:
+            return expr
+        # not using copy.copy because of Expr.__getattr__
+        res = object.__new__(expr.__class__)
+        res.__dict__.update(d)
+        res.__dict__.update(changed)
+        # drop values cached from the old children
+        res.__dict__.pop('_variables', None)
+        res.__dict__.pop('_elementwise', None)
+        return res
+    elif isinstance(expr, (tuple, list)):
+        res = [replace_subexpr(e, old, new) for e in expr]
+        if all(r is e for r, e in zip(res, expr)):
+            return expr
+        return type(expr)(res)
+    elif isinstance(expr, slice):
+        start, stop, step = replace_subexpr((expr.start, expr.stop, expr.step),
+                                            old, new)
+        return slice(start, stop, step)
+    else:
+        return expr
+
+
+def subexpr_occurrences(subprocesses):
+    """
+    returns {(subexpr, epoch, versions): [index of process]} for all the
+    subexpressions which could be factored out. Each assignment increments
+    the version of the assigned variable while processes which can change any
+    variable (function calls, new(), remove(), loops, ...) start a new
+    epoch, so that two occurrences with the same key have the same value.
+    """
+    versions = collections.defaultdict(int)
+    epoch = 0
+    occurrences = collections.defaultdict(list)
+    for i, (k, p) in enumerate(subprocesses):
+        if not isinstance(p, Assignment) or \
+                any(isinstance(node, CSE_BARRIER_TYPES)
+                    for node in all_nodes(p.expr)):
+            epoch += 1
+            continue
+        for subexpr in cse_candidates(p.expr):
+            names = cse_variable_names(subexpr)
+            key = (subexpr, epoch,
+                   tuple(sorted((name, versions[name]) for name in names)))
+            try:
+                hash(key)
+            except TypeError:
+                continue
+            occurrences[key].append(i)
+        if k is not None:
+            versions[k] += 1
+    return occurrences
+
+
+def factor_common_subexpressions(group):
+    """
+    factors out, in-place, the subexpressions which are computed several times
+    with the same value by the processes of group: they are computed once in
+    a (hidden) temporary variable, just before the first process using them.
+    Larger subexpressions are factored first.
+
+    Returns a list of (subexpr, number of occurrences).
+    """
+    def size(expr):
+        return sum(1 for node in all_nodes(expr) if isinstance(node, Expr))
+
+    factored = []
+    subprocesses = group.subprocesses
+    while True:
+        occurrences = subexpr_occurrences(subprocesses)
+        common = [(key, indices) for key, indices in occurrences.iteritems()
+                  if len(indices) > 1]
+        if not common:
+            return factored
+        key, indices = min(common,
+                           key=lambda (key, indices): (-size(key[0]),
+                                                       indices[0],
+                                                       str(key[0])))
+        subexpr = key[0]
+        name = '__cse%d' % len(factored)
+        variable = FactoredVariable(group.entity, name, subexpr)
+        for i in set(indices):
+            process = subprocesses[i][1]
+            process.expr = replace_subexpr(process.expr, subexpr, variable)
+        subprocesses.insert(indices[0],
+                            (name, Assignment(name, group.entity, subexpr)))
+        factored.append((subexpr, len(indices)))
+
+
 # This is an awful workaround for the fact that tables.Array does not support
 # fancy indexes with negative indices.
 # See https://github.com/PyTables/PyTables/issues/360
@@ -67,7 +246,8 @@ class DiskBackedArray(object):
 
     def __getitem__(self, item):
         # load the array entirely in memory before indexing it
-        return self.arr[:][item]
+        with h5lock:
+            return self.arr[:][item]
 
     def __getattr__(self, item):
         return getattr(self.arr, item)
@@ -198,6 +378,13 @@ class Entity(object):
         self.expectedrows = tables.parameters.EXPECTED_ROWS_TABLE
         self.table = None
         self.input_table = None
+        # when the input history is not copied to the output file, the first
+        # history_nrows rows of the output are read from history_table (the
+        # input table) instead, and the rows of table come after those.
+        self.history_table = None
+        self.history_nrows = 0
+        # BackgroundWriter used to write to table, if any
+        self.writer = None
 
         self.indexed_input_table = None
         self.indexed_output_table = None
@@ -220,7 +407,15 @@ class Entity(object):
         self.array = array
 
         self.lag_fields = []
-        self.array_lag = None
+        # {field_name: maximum number of periods it is lagged by}
+        self.lag_depths = {}
+        # in-memory copy of the lag fields for the last few periods
+        # {period: ColumnArray}
+        self.array_lags = {}
+
+        # running state of time functions (tavg, tsum, duration), by
+        # (function class, expression)
+        self.tfunc_states = {}
 
         self.num_tmp = 0
         self.temp_variables = {}
@@ -549,11 +744,27 @@ Please use this instead:
             if isinstance(p, ProcessGroup):
                 p.ssa(fields_versions)
 
-    def compute_lagged_fields(self, inspect_one_period=True):
+    def compute_lagged_fields(self, in_memory=True):
+        """
+        Returns {entity: {field_name: num_periods}} for all fields (of any
+        entity) used in lag expressions of this entity, with the maximum number
+        of periods they are lagged by.
+
+        If in_memory is True, only consider lag expressions which can be
+        computed from the last few periods kept in memory (that is those
+        lagging by a constant number of periods or by an unknown number of
+        periods, in which case only the last period is kept), otherwise, only
+        consider those which need to go back further than the last period.
+        """
         from tfunc import Lag
         from links import LinkGet
 
-        lag_vars = collections.defaultdict(set)
+        lag_vars = collections.defaultdict(dict)
+
+        def add_var(entity, name, num_periods):
+            entity_vars = lag_vars[entity]
+            entity_vars[name] = max(entity_vars.get(name, 0), num_periods)
+
         for p in self.processes.itervalues():
             for expr in p.expressions():
                 for node in expr.all_of((Lag, ValueForPeriod)):
@@ -573,24 +784,31 @@ Please use this instead:
 
                     # if num_periods is an Expr, we cannot really tell whether
                     # or not it is 1 or more, so we must always take the node
+                    # (but we can only keep the last period in memory)
                     if num_periods is not None and np.isscalar(num_periods):
-                        inspect_expr = (num_periods == 1) == inspect_one_period
+                        if in_memory:
+                            inspect_expr = (isinstance(num_periods, int) and
+                                            num_periods >= 1)
+                        else:
+                            inspect_expr = num_periods != 1
                     else:
                         # the safe thing is to take everything when not sure
                         inspect_expr = True
+                        num_periods = 1
 
                     if inspect_expr:
                         expr_node = node.args[0]
                         for v in expr_node.all_of(Variable):
                             if not isinstance(v, GlobalVariable):
-                                lag_vars[v.entity].add(v.name)
+                                add_var(v.entity, v.name, num_periods)
                         for lv in expr_node.all_of(LinkGet):
                             # noinspection PyProtectedMember
-                            lag_vars[lv.link._entity].add(lv.link._link_field)
+                            add_var(lv.link._entity, lv.link._link_field,
+                                    num_periods)
                             target_vars = list(lv.target_expr.all_of(Variable))
                             assert all(v.entity is not None for v in target_vars)
                             for v in target_vars:
-                                lag_vars[v.entity].add(v.name)
+                                add_var(v.entity, v.name, num_periods)
         return lag_vars
 
     def build_period_array(self, start_period):
@@ -606,12 +824,22 @@ Please use this instead:
 
     def load_period_data(self, period):
         if self.lag_fields:
-            # TODO: use ColumnArray here
-            # XXX: do we need np.empty? (but watch for alias problems)
-            self.array_lag = np.empty(len(self.array),
-                                      dtype=np.dtype(self.lag_fields))
-            for field, _ in self.lag_fields:
-                self.array_lag[field] = self.array[field]
+            # keep a copy of the lag fields of the period which just ended
+            self.array_lags[self.array_period] = \
+                ColumnArray([(field, self.array[field].copy())
+                             for field, _ in self.lag_fields])
+
+            # and drop the columns which are not needed anymore
+            lag_depths = self.lag_depths
+            for lag_period, lag_array in self.array_lags.items():
+                num_periods = period - lag_period
+                # 'id' has the maximum depth of all fields
+                if lag_depths['id'] < num_periods:
+                    del self.array_lags[lag_period]
+                    continue
+                for field in lag_array.dtype.names:
+                    if lag_depths[field] < num_periods:
+                        del lag_array[field]
 
         # if not self.indexed_input_table.has_period(period):
         #     # nothing needs to be done in that case
@@ -629,7 +857,8 @@ Please use this instead:
         # It would be nice to use ColumnArray.from_table and adapt merge_arrays
         # to produce a ColumnArray in all cases, but it is not a huge priority
         # for now
-        input_array = self.input_table.read(start, stop)
+        with h5lock:
+            input_array = self.input_table.read(start, stop)
 
         self.array, self.id_to_rownum = \
             merge_arrays(self.array, input_array, result_fields='array1',
@@ -669,10 +898,19 @@ Please use this instead:
         self.output_index[period] = self.id_to_rownum
 
         # also flush it to disk
+        self.write_index(period, self.id_to_rownum)
+
+    def write_index(self, period, id_to_rownum):
         # noinspection PyProtectedMember
         h5file = self.output_index_node._v_file
-        h5file.create_array(self.output_index_node, "_%d" % period,
-                            self.id_to_rownum, "Period %d index" % period)
+        name, title = "_%d" % period, "Period %d index" % period
+        # only chunked arrays can be compressed (and they cannot be empty)
+        if self.output_index_node._v_filters.complevel and len(id_to_rownum):
+            h5file.create_carray(self.output_index_node, name,
+                                 obj=id_to_rownum, title=title)
+        else:
+            h5file.create_array(self.output_index_node, name, id_to_rownum,
+                                title)
 
         # if an old index exists (this is not the case for the first period!),
         # point to the one on the disk, instead of the one in memory,
@@ -699,12 +937,74 @@ Please use this instead:
         if period in self.output_rows:
             raise Exception("trying to modify already simulated rows")
 
-        if self.table is not None:
-            startrow = self.table.nrows
+        if self.table is None:
+            return
+
+        if self.writer is None:
+            startrow = self.history_nrows + self.table.nrows
             self.array.append_to_table(self.table)
-            self.output_rows[period] = (startrow, self.table.nrows)
+            self.output_rows[period] = (startrow, startrow + len(self.array))
             self.flush_index(period)
             self.table.flush()
+        else:
+            # hand a copy of the data over to the writer thread, so that the
+            # next period can be simulated while it is being written
+            array = ColumnArray(self.array)
+            # the table can still lack the rows of previous periods
+            startrow = max([stop for _, stop in self.output_rows.itervalues()]
+                           or [0])
+            self.output_rows[period] = (startrow, startrow + len(array))
+            self.output_index[period] = self.id_to_rownum
+            self.writer.submit(self.write_period_data, period, array,
+                               self.id_to_rownum)
+
+    def write_period_data(self, period, array, id_to_rownum):
+        """
+        writes data for a period to the output table. This is called from
+        the writer thread when writing in the background.
+        """
+        startrow, stoprow = self.output_rows[period]
+        assert self.history_nrows + self.table.nrows == startrow
+        array.append_to_table(self.table)
+        assert self.history_nrows + self.table.nrows == stoprow
+        self.write_index(period, id_to_rownum)
+        self.table.flush()
+
+    def read_output(self, start, stop, field=None):
+        """
+        reads rows from the output table, waiting for all pending writes to
+        be done if needed.
+        """
+        if self.writer is not None:
+            self.writer.wait()
+        history_nrows = self.history_nrows
+        if start >= history_nrows:
+            return self.table.read(start=start - history_nrows,
+                                   stop=stop - history_nrows, field=field)
+        history = self.read_history(start, min(stop, history_nrows), field)
+        if stop <= history_nrows:
+            return history
+        return np.concatenate((history,
+                               self.table.read(start=0,
+                                               stop=stop - history_nrows,
+                                               field=field)))
+
+    def read_history(self, start, stop, field=None):
+        """
+        reads rows from the input table, with the columns of the output table
+        """
+        output_dtype = self.fields.in_output.dtype
+        default_values = self.fields.default_values
+        table = self.history_table
+        if field is None:
+            return add_and_drop_fields(table.read(start=start, stop=stop),
+                                       output_dtype, default_values)
+        elif field in table.dtype.names:
+            data = table.read(start=start, stop=stop, field=field)
+            return data.astype(output_dtype[field], copy=False)
+        else:
+            return get_default_vector(stop - start, output_dtype[field],
+                                      default_values.get(field))
 
     #     def compress_period_data(self, level):
     #     compressed = bcolz.ctable(self.array, cparams=bcolz.cparams(level))
@@ -712,57 +1012,26 @@ Please use this instead:
 
     def optimize_processes(self):
         """
-        Common subexpression elimination
+        Common subexpression elimination: subexpressions which are computed
+        several times with the same value within a function are factored out
+        in hidden temporary variables, so that they are computed only once.
+        Each function is optimized independently and the body of loops is left
+        untouched.
+
+        Returns a list of (function name, subexpr, number of occurrences).
         """
-        # XXX:
-        # * we either need to do SSA first, or for each assignment process,
-        #   "forget" all expressions containing the assigned variable
-        #   doing it using SSA seems cleaner, but in the end it shouldn't
-        #   change much. If we do not do SSA, we will need to "forget" about
-        #   expressions which contain an assigned variable at *each step* of
-        #   the process, including when simply counting the number of occurrence
-        #   of expressions. In that case we also need to iterate on the
-        #   processes in the same order than the simulation!
-        # * I don't know if it is a good idea to optimize cross-functions.
-        #   On one hand it offers much more possibilities for optimizations
-        #   but, on the other hand the optimization pass might just take too
-        #   much time... If we do not do it globally, we should move the method
-        #   to ProcessGroup instead. But let's try it cross-functions first.
-        # * cross-functions might get tricky when we take function calls
-        #   into account.
-
-        # TODO:
-        # * it will be simpler and better to do this in two passes: first
-        #   find duplicated expr and number of occurrences of each expr, then
-        #   proceed with the factorization
-        expr_count = collections.Counter()
-        for p in self.processes.itervalues():
-            for expr in p.expressions():
-                for subexpr in expr.traverse():
-                    if isinstance(subexpr, Expr) and \
-                            not isinstance(subexpr, Variable):
-                        expr_count[subexpr] += 1
-        print()
-        print("most common expressions")
-        print("=" * 20)
-        print(expr_count.most_common(100))
-
-        # if count(larger) <= count(smaller) <= count(larger) + 1: kill smaller
-        # if count(smaller) > count(larger) + 1: do both (larger uses smaller)
-
-        # seen = {}
-        # for p in self.processes.itervalues():
-        #     for expr in p.expressions():
-        #         for subexpr in expr.traverse():
-        #             if subexpr in seen:
-        #                 original = seen[subexpr]
-        #                 # 1) add an assignment process before the process of
-        #                 # the "original" expression to compute a temporary
-        #                 # variable
-        #                 # 2) modify "original" expr to use the temp var
-        #                 # 3) modify the current expr to use the temp var
-        #             else:
-        #                 seen[subexpr] = subexpr
+        factored = []
+        for name, process in sorted(self.processes.iteritems()):
+            if not isinstance(process, Function):
+                continue
+            group = process.code
+            # eg dump() without argument
+            if any(isinstance(node, Expr) and node.uses_all_variables
+                   for node in all_nodes(list(group.expressions()))):
+                continue
+            for subexpr, count in factor_common_subexpressions(group):
+                factored.append((name, subexpr, count))
+        return factored
 
     def __repr__(self):
         return "<Entity '%s'>" % self.name
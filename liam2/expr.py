@@ -7,6 +7,8 @@ from collections import Counter
 
 import numpy as np
 
+import config
+import profiler
 from cache import Cache
 from context import EntityContext, EvaluationContext
 from utils import (LabeledArray, ExplainTypeError, safe_take, IrregularNDArray,
@@ -132,6 +134,61 @@ def as_string(expr):
         return repr(expr)
 
 
+def is_constant(value):
+    """
+    returns whether value is a scalar which can be written as-is in the
+    expressions given to numexpr
+    """
+    return type(value) in (bool, int, long, float)
+
+
+def fold(expr):
+    """
+    Constant folding: returns the value of expr if it is computed by numexpr
+    (see Expr.foldable) and all its arguments are constants, or expr itself
+    otherwise.
+    """
+    if not isinstance(expr, Expr) or not expr.foldable:
+        return expr
+    for node in expr.traverse():
+        # strings are the names of keyword arguments
+        if node is not expr and not is_constant(node) and \
+                not isinstance(node, basestring):
+            return expr
+
+    # numexpr computes operations on constants using Python semantics (eg
+    # ~True == -2), so we give it the constants as (0d) arrays, with the type
+    # numexpr would use for them, instead.
+    local_dict = {}
+
+    def as_variable(value):
+        if isinstance(value, tuple):
+            return tuple(as_variable(v) for v in value)
+        elif isinstance(value, basestring):
+            return value
+        if type(value) is int and -2 ** 31 <= value < 2 ** 31:
+            value = np.int32(value)
+        name = '__constant_%d' % len(local_dict)
+        local_dict[name] = np.array(value)
+        return Variable(None, name)
+
+    # not using copy.copy because of Expr.__getattr__
+    node = object.__new__(expr.__class__)
+    node.__dict__.update(expr.__dict__)
+    for k in expr.__children__:
+        node.__dict__[k] = as_variable(expr.__dict__[k])
+    constants = {'nan': float('nan'), 'inf': float('inf')}
+    try:
+        value = evaluate(node.as_string(), local_dict, constants,
+                         truediv='auto')
+    except Exception:
+        # any error will be reported when the expression is evaluated
+        return expr
+    if isinstance(value, np.ndarray) and not value.shape:
+        value = np.asscalar(value)
+    return value if is_constant(value) else expr
+
+
 def traverse_expr(expr):
     if isinstance(expr, Expr):
         for node in expr.traverse():
@@ -215,19 +272,9 @@ def expr_eval(expr, context):
                 if var.name not in globals_names and var not in context:
                     raise Exception("variable '%s' is unknown (it is either "
                                     "not defined or not computed yet)" % var)
+            if profiler.enabled():
+                return profiler.profiled_call(expr, expr.evaluate, context)
             return expr.evaluate(context)
-
-            # there are several flaws with this approach:
-            # 1) I don't get action times (csv et al)
-            # 2) these are cumulative times (they include child expr/processes)
-            #    we might want to store the timings in a tree (based on call
-            #    stack depth???) so that I could rebuild both cumulative and
-            #    "real" timings.
-            # 3) the sum of timings is wrong since children/nested expr times
-            #    count both for themselves and for all their parents
-    #        time, res = gettime(expr.evaluate, context)
-    #        timings[expr.__class__.__name__] += time
-    #        return res
         elif isinstance(expr, list):
             return [expr_eval(e, context) for e in expr]
         elif isinstance(expr, tuple):
@@ -260,6 +307,21 @@ class Expr(object):
     # isinstance(v, Expr)
     __children__ = ()
     num_tmp = 0
+    # whether the value of this node for each individual only depends on the
+    # value of its children for that same individual. Expressions made only
+    # of such nodes can be evaluated by blocks of individuals.
+    elementwise = False
+    # whether the value of this node for each individual only depends on the
+    # data of that individual (including the individuals its links point to),
+    # so that it can be computed for any subset of individuals. This is
+    # implied by elementwise.
+    rowwise = False
+    # whether this node can use variables which are not among its children
+    # (eg dump() without argument or variables named in a file)
+    uses_all_variables = False
+    # whether this node can be computed in advance (by numexpr) when all its
+    # children are constants (see fold)
+    foldable = False
 
     def __init__(self):
         raise NotImplementedError()
@@ -286,6 +348,67 @@ class Expr(object):
                         "displayed but it contains: '%s'." % str(self))
 
     def evaluate(self, context):
+        block_size = config.block_size
+        if block_size and self.is_elementwise():
+            entity_data = context.entity_data
+            # value_for_period can evaluate expressions for several periods
+            # at once, in which case the period is an array
+            if isinstance(entity_data, EntityContext) and \
+                    np.isscalar(context.period) and \
+                    entity_data.is_array_period and \
+                    len(entity_data) > block_size:
+                return self.evaluate_blocks(context, block_size)
+        return self.evaluate_simple(context)
+
+    def is_elementwise(self):
+        if not hasattr(self, '_elementwise'):
+            self._elementwise = all(
+                node.elementwise if isinstance(node, Expr)
+                else node is None or np.isscalar(node)
+                for node in self.traverse())
+        return self._elementwise
+
+    def evaluate_blocks(self, context, block_size):
+        """
+        evaluates an element-wise expression by blocks of block_size
+        individuals, writing the result of each block in a preallocated
+        array. Temporary variables (for the parts of the expression which
+        numexpr cannot compute) are only created for one block at a time, which
+        limits the memory used to evaluate complex expressions on large
+        populations.
+        """
+        length = len(context)
+        columns = {}
+        constants = {}
+        for name in set(v.name for v in self.all_of(Variable)):
+            value = context[name]
+            if isinstance(value, np.ndarray) and value.shape:
+                if isinstance(value, LabeledArray) or value.ndim > 1 or \
+                        len(value) != length:
+                    # not a column
+                    return self.evaluate_simple(context)
+                columns[name] = value
+            else:
+                constants[name] = value
+        if not columns:
+            # the expression evaluates to a single value
+            return self.evaluate_simple(context)
+
+        result = None
+        for start in range(0, length, block_size):
+            stop = min(start + block_size, length)
+            block_data = {name: column[start:stop]
+                          for name, column in columns.iteritems()}
+            block_data.update(constants)
+            block_data['__len__'] = stop - start
+            block_value = self.evaluate_simple(
+                context.clone(entity_data=block_data))
+            if result is None:
+                result = np.empty(length, dtype=np.asarray(block_value).dtype)
+            result[start:stop] = block_value
+        return result
+
+    def evaluate_simple(self, context):
         # period = context.period
         #
         # if isinstance(period, np.ndarray):
@@ -307,6 +430,9 @@ class Expr(object):
         simple_expr = self.as_simple_expr(context)
         if isinstance(simple_expr, Variable) and simple_expr.name in context:
             return context[simple_expr.name]
+        # the whole expression was folded to a constant
+        if not isinstance(simple_expr, Expr):
+            return simple_expr
 
         # check for labeled arrays, to work around the fact that numexpr
         # does not preserve ndarray subclasses.
@@ -525,7 +651,11 @@ class EvaluableExpression(Expr):
         raise NotImplementedError()
 
     def as_simple_expr(self, context):
-        return self.add_tmp_var(context, self.evaluate(context))
+        if profiler.enabled():
+            value = profiler.profiled_call(self, self.evaluate, context)
+        else:
+            value = self.evaluate(context)
+        return self.add_tmp_var(context, value)
 
 
 def non_scalar_array(a):
@@ -929,13 +1059,16 @@ class DynamicFunctionCall(GenericFunctionCall):
 
 class UnaryOp(Expr):
     __children__ = ('expr',)
+    elementwise = True
+    foldable = True
 
     def __init__(self, op, expr):
         self.op = op
         self.expr = expr
 
     def as_simple_expr(self, context):
-        return self.__class__(self.op, as_simple_expr(self.expr, context))
+        expr = as_simple_expr(self.expr, context)
+        return fold(self.__class__(self.op, expr))
 
     def as_string(self):
         return "(%s%s)" % (self.op, as_string(self.expr))
@@ -952,6 +1085,8 @@ class UnaryOp(Expr):
 
 class BinaryOp(Expr):
     __children__ = ('expr1', 'expr2')
+    elementwise = True
+    foldable = True
 
     def __init__(self, op, expr1, expr2):
         self.op = op
@@ -961,7 +1096,7 @@ class BinaryOp(Expr):
     def as_simple_expr(self, context):
         expr1 = as_simple_expr(self.expr1, context)
         expr2 = as_simple_expr(self.expr2, context)
-        return self.__class__(self.op, expr1, expr2)
+        return fold(self.__class__(self.op, expr1, expr2))
 
     # We can't simply use __str__ because of where vs if
     def as_string(self):
@@ -1011,6 +1146,7 @@ class ComparisonOp(BinaryOp):
 
 class Variable(Expr):
     __children__ = ()
+    elementwise = True
 
     def __init__(self, entity, name, dtype=None):
         # from entities import Entity
@@ -1042,6 +1178,28 @@ class ShortLivedVariable(Variable):
     pass
 
 
+class FactoredVariable(Variable):
+    """
+    Temporary variable holding the value of a common subexpression (see
+    Entity.optimize_processes). It is displayed as the expression it replaces,
+    so that messages (of assertions, qshow, ...) are unchanged.
+    """
+    def __init__(self, entity, name, expr):
+        Variable.__init__(self, entity, name)
+        self._expr = expr
+
+    def __str__(self):
+        return str(self._expr)
+
+    def dtype(self, context):
+        # the variables used in the expression might not be available anymore
+        # (see ProcessGroup.dead_locals)
+        if context is not None and self.name in context:
+            return gettype(context[self.name])
+        else:
+            return getdtype(self._expr, context)
+
+
 # class GlobalVariable(Variable):
 class GlobalVariable(EvaluableExpression):
     __children__ = ()
@@ -1057,6 +1215,11 @@ class GlobalVariable(EvaluableExpression):
         else:
             return "%s.%s" % (self.tablename, self.name)
 
+    # a global evaluates to a single value (for the current period)
+    @property
+    def elementwise(self):
+        return self.name is not None
+
     def get_tmp_varname(self, context):
         period = self._eval_key(context)
         if isinstance(period, int):
@@ -1067,6 +1230,19 @@ class GlobalVariable(EvaluableExpression):
     def _eval_key(self, context):
         return context.period
 
+    def as_simple_expr(self, context):
+        value = self.evaluate(context)
+        # the value of a global does not change during a period, so scalar
+        # values are given to numexpr as constants instead of variables, which
+        # allows to fold them with other constants (see fold). Integers are
+        # still given as variables because numexpr uses 32 bit integers for
+        # small integer constants and booleans because numexpr simplifies
+        # where() with a constant condition to one of its branches, which
+        # can be a scalar.
+        if isinstance(value, (float, np.floating)):
+            return float(value)
+        return self.add_tmp_var(context, value)
+
     def evaluate(self, context):
         globals_data = context.global_tables
         globals_table = globals_data[self.tablename]
@@ -1159,6 +1335,7 @@ class GlobalVariable(EvaluableExpression):
 
 class SubscriptedGlobal(GlobalVariable):
     __children__ = ('key',)
+    elementwise = False
 
     def __init__(self, tablename, name, key, dtype):
         GlobalVariable.__init__(self, tablename, name, dtype)
@@ -1174,6 +1351,8 @@ class SubscriptedGlobal(GlobalVariable):
 # TODO: this class shouldn't be needed. GlobalArray should be handled in the
 # context
 class GlobalArray(Variable):
+    elementwise = False
+
     def __init__(self, name, dtype=None):
         Variable.__init__(self, None, name, dtype)
 
@@ -8,9 +8,10 @@ import numpy as np
 import config
 from context import context_length
 from expr import (FunctionExpr, not_hashable,
-                  getdtype, as_simple_expr, as_string,
+                  getdtype, as_simple_expr, as_string, fold,
                   get_default_value, ispresent, LogicalOp, AbstractFunction,
                   always, FillArgSpecMeta)
+from random_streams import np_random, drawing_for
 from utils import classproperty, argspec, split_signature
 
 
@@ -180,6 +181,21 @@ class NumpyCreateArray(NumpyFunction):
 
 
 class NumpyRandom(NumpyCreateArray):
+    @classmethod
+    def get_compute_func(cls):
+        # use the random stream of the current process (if any) instead of
+        # the global numpy random state
+        func = cls.np_func
+        if func is None:
+            return None
+        return getattr(np_random(), func.__name__)
+
+    def evaluate(self, context):
+        args, kwargs = self._eval_args(context)
+        # counter-based random numbers are drawn for each individual id
+        with drawing_for(context.get('id')):
+            return self.compute(context, *args, **kwargs)
+
     def _eval_args(self, context):
         args, kwargs = NumpyCreateArray._eval_args(self, context)
         if 'size' in self.argspec.args:
@@ -200,10 +216,12 @@ class NumpyRandom(NumpyCreateArray):
     def compute(self, context, *args, **kwargs):
         if config.debug and config.log_level == "processes":
             print()
-            print("random sequence position before:", np.random.get_state()[2])
+            print("random sequence position before:",
+                  np_random().get_state()[2])
         res = super(NumpyRandom, self).compute(context, *args, **kwargs)
         if config.debug and config.log_level == "processes":
-            print("random sequence position after:", np.random.get_state()[2])
+            print("random sequence position after:",
+                  np_random().get_state()[2])
         return res
 
 
@@ -253,10 +271,12 @@ class NumexprFunction(AbstractFunction):
     """For functions which are present as-is in numexpr"""
     # argspec need to be given manually for each function
     argspec = None
+    elementwise = True
+    foldable = True
 
     def as_simple_expr(self, context):
         args, kwargs = as_simple_expr((self.args, self.kwargs), context)
-        return self.__class__(*args, **dict(kwargs))
+        return fold(self.__class__(*args, **dict(kwargs)))
 
     def as_string(self):
         args, kwargs = as_string((self.args, self.kwargs))
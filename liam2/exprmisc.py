@@ -8,21 +8,25 @@ import random
 import numpy as np
 
 import config
-from expr import (Variable, UnaryOp, BinaryOp, ComparisonOp, DivisionOp,
+from expr import (Expr, EvaluableExpression, Variable, GlobalVariable,
+                  UnaryOp, BinaryOp, ComparisonOp, DivisionOp,
                   LogicalOp, getdtype, coerce_types, expr_eval, as_simple_expr,
-                  as_string, collect_variables,
+                  as_string, collect_variables, fold, is_constant,
                   get_default_array, get_default_vector, FunctionExpr,
                   always, firstarg_dtype, expr_cache)
 from exprbases import (FilteredExpression, CompoundExpression, NumexprFunction,
                        TableExpression, NumpyChangeArray)
 from context import context_length
 from importer import load_ndarray, load_table
+from random_streams import current_stream
 from utils import PrettyTable, argspec
 
 
 # TODO: implement functions in expr to generate "Expr" nodes at the python level
 # less painful
 class Min(CompoundExpression):
+    elementwise = True
+
     def build_expr(self, context, *args):
         assert len(args) >= 2
 
@@ -85,6 +89,8 @@ class Min(CompoundExpression):
 
 
 class Max(CompoundExpression):
+    elementwise = True
+
     def build_expr(self, context, *args):
         assert len(args) >= 2
 
@@ -98,19 +104,29 @@ class Max(CompoundExpression):
 
 
 class Logit(CompoundExpression):
+    elementwise = True
+
     def build_expr(self, context, expr):
         # log(x / (1 - x))
         return Log(DivisionOp('/', expr, BinaryOp('-', 1.0, expr)))
 
+    dtype = always(float)
+
 
 class Logistic(CompoundExpression):
+    elementwise = True
+
     def build_expr(self, context, expr):
         # 1 / (1 + exp(-x))
         return DivisionOp('/', 1.0,
                           BinaryOp('+', 1.0, Exp(UnaryOp('-', expr))))
 
+    dtype = always(float)
+
 
 class ZeroClip(CompoundExpression):
+    elementwise = True
+
     def build_expr(self, context, expr, expr_min, expr_max):
         # if(minv <= x <= maxv, x, 0)
         return Where(LogicalOp('&', ComparisonOp('>=', expr, expr_min),
@@ -134,6 +150,7 @@ class ZeroClip(CompoundExpression):
 # 10 loops, best of 3: 94.1 ms per loop
 class Clip(NumpyChangeArray):
     np_func = np.clip
+    elementwise = True
 
 
 class Sort(NumpyChangeArray):
@@ -146,9 +163,12 @@ class Sort(NumpyChangeArray):
 class Round(NumpyChangeArray):
     np_func = np.round
     dtype = firstarg_dtype
+    elementwise = True
 
 
 class Trunc(FunctionExpr):
+    elementwise = True
+
     # TODO: check that the dtype is correct at compilation time (__init__ is too
     # early since we do not have the context yet)
     # assert getdtype(self.args[0], context) == float
@@ -302,7 +322,7 @@ class New(FilteredExpression):
 
         add_individuals(target_context, children)
 
-        expr_cache.invalidate(context.period, context.entity_name)
+        expr_cache.invalidate(context.period, target_entity.name)
 
         # result is the ids of the new individuals corresponding to the source
         # entity
@@ -335,6 +355,10 @@ class Dump(TableExpression):
     kwonlyargs = {'filter': None, 'missing': None, 'header': True,
                   'limit': None}
 
+    @property
+    def uses_all_variables(self):
+        return not self.args
+
     def compute(self, context, *args, **kwargs):
         filter_value = kwargs.pop('filter', None)
         missing = kwargs.pop('missing', None)
@@ -416,6 +440,10 @@ class Dump(TableExpression):
 class Where(NumexprFunction):
     funcname = 'if'
     argspec = argspec('cond, iftrue, iffalse')
+    # when the condition selects less than this fraction of individuals for a
+    # branch which needs temporary variables (links, round(), ...), that
+    # branch is only computed for the selected individuals
+    selective_threshold = 0.5
 
     @property
     def cond(self):
@@ -430,7 +458,16 @@ class Where(NumexprFunction):
         return self.args[2]
 
     def as_simple_expr(self, context):
-        cond = as_simple_expr(self.cond, context)
+        cond_value = None
+        if self.is_selective(self.iftrue) or self.is_selective(self.iffalse):
+            cond_value = expr_eval(self.cond, context)
+            if isinstance(cond_value, np.ndarray) and cond_value.ndim == 1 \
+                    and len(cond_value) == context_length(context):
+                cond = self.add_tmp_var(context, cond_value)
+            else:
+                cond_value = None
+        if cond_value is None:
+            cond = as_simple_expr(self.cond, context)
 
         # filter is stored as an unevaluated expression
         context_filter = context.filter_expr
@@ -440,7 +477,7 @@ class Where(NumexprFunction):
         else:
             # filter = filter and cond
             local_ctx.filter_expr = LogicalOp('&', context_filter, self.cond)
-        iftrue = as_simple_expr(self.iftrue, local_ctx)
+        iftrue = self.branch_as_simple_expr(self.iftrue, cond_value, local_ctx)
 
         if context_filter is None:
             local_ctx.filter_expr = UnaryOp('~', self.cond)
@@ -448,8 +485,57 @@ class Where(NumexprFunction):
             # filter = filter and not cond
             local_ctx.filter_expr = LogicalOp('&', context_filter,
                                               UnaryOp('~', self.cond))
-        iffalse = as_simple_expr(self.iffalse, local_ctx)
-        return Where(cond, iftrue, iffalse)
+        if cond_value is not None:
+            cond_value = ~cond_value
+        iffalse = self.branch_as_simple_expr(self.iffalse, cond_value,
+                                             local_ctx)
+        expr = fold(Where(cond, iftrue, iffalse))
+        if isinstance(expr, Where) and is_constant(cond):
+            # numexpr would simplify where(True, age, 0) to age but
+            # where(False, age, 0) to a scalar 0 instead of one 0 per
+            # individual. Giving it the condition as a (0d) variable avoids
+            # that.
+            expr = Where(self.add_tmp_var(context, np.array(cond)), iftrue,
+                         iffalse)
+        return expr
+
+    @staticmethod
+    def is_selective(expr):
+        """
+        returns whether expr needs temporary variables and can be computed
+        for only a subset of individuals
+        """
+        if not isinstance(expr, Expr):
+            return False
+        needs_tmp_var = False
+        for node in expr.traverse():
+            if isinstance(node, Expr):
+                if not (node.elementwise or node.rowwise):
+                    return False
+                if isinstance(node, EvaluableExpression) and \
+                        not isinstance(node, GlobalVariable):
+                    needs_tmp_var = True
+        return needs_tmp_var
+
+    def branch_as_simple_expr(self, expr, selected, context):
+        """
+        selected is None or a boolean array of the individuals for which the
+        value of expr is used
+        """
+        if selected is not None and self.is_selective(expr):
+            indices = selected.nonzero()[0]
+            if len(indices) < len(selected) * self.selective_threshold:
+                keys = set(v.name for v in expr.all_of(Variable))
+                sub_context = context.subset(indices, keys,
+                                             context.filter_expr)
+                value = expr_eval(expr, sub_context)
+                if isinstance(value, np.ndarray) and value.shape:
+                    # the values for the other individuals are not used
+                    result = np.empty(len(selected), dtype=value.dtype)
+                    result[indices] = value
+                    value = result
+                return self.add_tmp_var(context, value)
+        return as_simple_expr(expr, context)
 
     def as_string(self):
         args = as_string((self.cond, self.iftrue, self.iffalse))
@@ -460,50 +546,22 @@ class Where(NumexprFunction):
         return coerce_types(context, self.iftrue, self.iffalse)
 
 
-def _plus(a, b):
-    return BinaryOp('+', a, b)
-
-
-def _mul(a, b):
-    return BinaryOp('*', a, b)
+class ExtExpr(EvaluableExpression):
+    """
+    linear expression whose coefficients are read from a csv file. The file
+    must have a "fields" dimension, whose labels are the names of the
+    variables (or "constant"). Any other dimension must be named after a
+    (categorical) variable of the entity (eg gender or region_id): the
+    coefficients used for each individual are those of the row for its values
+    of those variables.
+    """
+    __children__ = ()
+    uses_all_variables = True
 
-
-class ExtExpr(CompoundExpression):
     def __init__(self, fname):
+        self.fname = fname
         data = load_ndarray(os.path.join(config.input_directory, fname))
 
-        # TODO: handle more dimensions. For that we need to evaluate a
-        # different expr depending on the values for the other dimensions
-        # we will need to either
-        # 1) create awful expressions with lots of nested if() (X*Y*Z)
-        # OR
-        # 2) use groupby (or partition_nd)
-        # the problem with groupby is that once we have one vector of values
-        # for each group, we have to recombine them into a single vector
-        # result = np.empty(context_length(context), dtype=expr.dtype)
-        # groups = partition_nd(filtered_columns, True, possible_values)
-        # if not groups:
-        #    return
-        # contexts = [filtered_context.subset(indices, expr_vars, not_hashable)
-        #             for indices in groups]
-        # data = [expr_eval(expr, c) for c in contexts]
-        # for group_indices, group_values in zip(groups, data):
-        #     result[group_indices] = group_values
-        # 3) use a lookup for each individual & coef (we can only envision
-        # this during the evaluation of the larger expression if done via numba,
-        # otherwise it will be too slow
-        # expr = age * AGECOEF[gender, xyz] + eduach * EDUCOEF[gender, xyz]
-        # 4) compute the coefs separately
-        # 4a) via nested if()
-        # AGECOEF = if(gender, if(workstate == 1, a, if(workstate == 2, b, c)
-        #                      if(workstate == 1, a, if(workstate == 2, b, c))
-        # EDUCOEF = ...
-        # expr = age * AGECOEF + eduach * EDUCOEF
-        # 4b) via lookup
-        # AGECOEF = AGECOEFS[gender, workstate]
-        # EDUCOEF = EDUCOEFS[gender, workstate]
-        # expr = age * AGECOEF + eduach * EDUCOEF
-
         # Note, in general, we could make
         # EDUCOEFS (sans rien) equivalent to EDUCOEFS[:, :, period] s'il y a
         #  une dimension period en 3eme position
@@ -513,30 +571,67 @@ class ExtExpr(CompoundExpression):
         # to index by (autoindex: period) for periodic
 
         fields_dim = data.dim_names.index('fields')
-        fields_axis = data.axes[fields_dim]
-        self.names = list(fields_axis.labels)
-        self.coefs = list(data)
-        # needed for compatibility with CompoundExpression
-        self.args = []
-        self.kwargs = []
-
-    def build_expr(self, context):
+        self._names = list(data.pvalues[fields_dim])
+        other_dims = [i for i in range(data.ndim) if i != fields_dim]
+        self._dims = [data.dim_names[i] for i in other_dims]
+        self._dims_pvalues = [np.asarray(data.pvalues[i]) for i in other_dims]
+        # one row of coefficients per combination of values of the other
+        # dimensions ("strata"), one column per field
+        coefs = np.asarray(data, dtype=float)
+        coefs = np.rollaxis(coefs, fields_dim, coefs.ndim)
+        self._coefs = coefs.reshape(-1, len(self._names))
+
+    def __repr__(self):
+        return "extexpr(%r)" % self.fname
+
+    def strata(self, context):
+        """
+        returns the index of the row of coefficients to use for each
+        individual
+        """
+        indices = []
+        for dim, pvalues in zip(self._dims, self._dims_pvalues):
+            values = expr_eval(Variable(context.entity, dim), context)
+            sorter = np.argsort(pvalues)
+            pos = np.searchsorted(pvalues, values, sorter=sorter)
+            idx = sorter[np.minimum(pos, len(pvalues) - 1)]
+            unknown = pvalues[idx] != values
+            if np.any(unknown):
+                raise Exception("%s: no coefficients for %s == %s"
+                                % (self.fname, dim,
+                                   np.asarray(values)[unknown][0]))
+            indices.append(idx)
+        shape = [len(pvalues) for pvalues in self._dims_pvalues]
+        return np.ravel_multi_index(indices, shape)
+
+    def evaluate(self, context):
+        # instead of building a (numexpr) expression, which is limited to 32
+        # variables, we sum the terms one at a time, in the order of the file.
+        # When there are other dimensions, the coefficients are gathered for
+        # each individual one field at a time, so that we never need
+        # a (num_individuals x num_fields) array of coefficients.
+        if self._dims:
+            strata = self.strata(context)
         res = None
-        for name, coef in zip(self.names, self.coefs):
+        for i, name in enumerate(self._names):
+            coef = self._coefs[:, i]
+            coef = coef[strata] if self._dims else coef[0]
             # XXX: parse expressions instead of only simple Variable?
             if name != 'constant':
-                # cond_dims = self.cond_dims
-                # cond_exprs = [Variable(context.entity, d) for d in cond_dims]
-                # coef = GlobalArray('__xyz')[name, *cond_exprs]
-                term = _mul(Variable(context.entity, name), coef)
+                term = expr_eval(Variable(context.entity, name), context) * coef
             else:
                 term = coef
             if res is None:
                 res = term
+            elif isinstance(res, np.ndarray) and res.shape:
+                # res is always a temporary array at this point
+                res += term
             else:
-                res = _plus(res, term)
+                res = res + term
         return res
 
+    dtype = always(float)
+
 
 class Seed(FunctionExpr):
     def compute(self, context, seed=None):
@@ -545,8 +640,12 @@ class Seed(FunctionExpr):
             print("using fixed random seed: %d" % seed)
         else:
             print("resetting random seed")
-        random.seed(seed)
-        np.random.seed(seed)
+        stream = current_stream()
+        if stream is not None:
+            stream.seed(seed)
+        else:
+            random.seed(seed)
+            np.random.seed(seed)
 
 
 class Array(FunctionExpr):
@@ -1,12 +1,14 @@
 # encoding: utf-8
 from __future__ import division, print_function
 
+from itertools import islice
+
 import numpy as np
 
 import config
-from expr import firstarg_dtype, ComparisonOp, Variable, expr_eval
+from expr import firstarg_dtype, expr_eval, non_scalar_array
 from exprbases import NumpyRandom, make_np_class, make_np_classes
-from exprmisc import Where
+from random_streams import np_random
 from utils import argspec
 
 
@@ -38,47 +40,60 @@ class Choice(NumpyRandom):
             assert len(p) == len(a)
             assert all(len(px) == size for px in p)
             assert len(a) >= 2
-
-            # I have not found a way to do this without an explicit loop as
-            # np.digitize only supports a 1d array for bins. What we do is
-            # worse than a linear "search" since we always evaluate all
-            # possibilities (there is no shortcut when the value is found).
-            # It might be faster to rewrite this using numba + np.digitize
-            # for each individual (assuming it has a low setup overhead).
-            # if isinstance(p, list) and any(isinstance(px, la.LArray) for px in p):
-            #     p = [np.asarray(px) for px in p]
-            ap = np.asarray(p)
-            cdf = ap.cumsum(axis=0)
-
-            # copied & adapted from numpy/random/mtrand/mtrand.pyx
-            atol = np.sqrt(np.finfo(np.float64).eps)
-            if np.issubdtype(ap.dtype, np.floating):
-                atol = max(atol, np.sqrt(np.finfo(ap.dtype).eps))
-
-            if np.any(np.abs(cdf[-1] - 1.) > atol):
-                raise ValueError("probabilities do not sum to 1")
-
-            cdf /= cdf[-1]
-
-            # the goal is to build something like:
-            # if(u < proba1, outcome1,
-            #    if(u < proba2, outcome2,
-            #       outcome3))
-
-            data = {'u': np.random.uniform(size=size)}
-            expr = a[-1]
-            # iterate in reverse and skip last
-            pairs = zip(cdf[-2::-1], a[-2::-1])
-            for i, (proba_x, outcome_x) in enumerate(pairs):
-                data['p%d' % i] = proba_x
-                expr = Where(ComparisonOp('<', Variable(None, 'u'),
-                                          Variable(None, 'p%d' % i)),
-                             outcome_x, expr)
-            local_ctx = context.clone(fresh_data=True, entity_data=data)
-            return expr.evaluate(local_ctx)
+            return self.choice_per_individual(a, p, size)
         else:
             return NumpyRandom.compute(self, context, a, size, replace, p)
 
+    @staticmethod
+    def choice_per_individual(a, p, size):
+        """
+        chooses one of the outcomes in a for each individual, using different
+        probabilities for each individual (p is a sequence of arrays, one per
+        outcome).
+
+        The chosen outcome is the number of cumulative probabilities (divided
+        by their total) which are lower or equal to a uniform random number.
+        Cumulative probabilities are computed and compared one outcome at a
+        time, so that at most a few temporary arrays of one value per
+        individual are needed, whatever the number of outcomes.
+        """
+        # we sum the probabilities in the same order as cumsum would do, so
+        # that the result is exactly the same as when using the (much larger)
+        # full cumulative probability matrix
+        total = np.zeros(size)
+        for px in p:
+            total += px
+
+        # copied & adapted from numpy/random/mtrand/mtrand.pyx
+        atol = np.sqrt(np.finfo(np.float64).eps)
+        for px in p:
+            dtype = np.asarray(px).dtype
+            if np.issubdtype(dtype, np.floating):
+                atol = max(atol, np.sqrt(np.finfo(dtype).eps))
+        if np.any(np.abs(total - 1.) > atol):
+            raise ValueError("probabilities do not sum to 1")
+
+        u = np_random().uniform(size=size)
+        cdf = np.zeros(size)
+        indices = np.zeros(size, dtype=np.intp)
+        # the last cumulative probability is always 1, so the last outcome
+        # does not need a comparison
+        for px in islice(p, len(p) - 1):
+            cdf += px
+            indices += u >= cdf / total
+
+        if all(np.isscalar(ax) for ax in a):
+            return np.asarray(a)[indices]
+        else:
+            # some outcomes are arrays (one value per individual): we fill
+            # the result one outcome at a time instead of stacking them all
+            dtype = np.result_type(*[np.asarray(ax).dtype for ax in a])
+            result = np.empty(size, dtype=dtype)
+            for i, ax in enumerate(a):
+                chosen = indices == i
+                result[chosen] = ax[chosen] if non_scalar_array(ax) else ax
+            return result
+
     dtype = firstarg_dtype
 
 # need to be explicitly defined because used internally
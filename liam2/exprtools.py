@@ -4,7 +4,7 @@ from __future__ import division, print_function
 import ast
 import types
 
-from expr import UnaryOp, BinaryOp, LogicalOp, ComparisonOp
+from expr import UnaryOp, BinaryOp, LogicalOp, ComparisonOp, fold
 from utils import add_context
 
 import actions
@@ -189,7 +189,7 @@ class UnaryOpNode(Node):
         self.node = node
 
     def to_ast(self, context):
-        return UnaryOp(self.op, to_ast(self.node, context))
+        return fold(UnaryOp(self.op, to_ast(self.node, context)))
 
 
 class BinaryOpNode(Node):
@@ -201,9 +201,9 @@ class BinaryOpNode(Node):
         self.expr2 = expr2
 
     def to_ast(self, context):
-        return self.ast_class(self.op,
-                              to_ast(self.expr1, context),
-                              to_ast(self.expr2, context))
+        return fold(self.ast_class(self.op,
+                                   to_ast(self.expr1, context),
+                                   to_ast(self.expr2, context)))
 
 
 class LogicalOpNode(BinaryOpNode):
@@ -260,7 +260,7 @@ class CallNode(Node):
         else:
             local_context = context
         args, kwargs = to_ast((self.args, self.kwargs), local_context)
-        return callable_ast(*args, **kwargs)
+        return fold(callable_ast(*args, **kwargs))
 
     def __str__(self):
         return '%s(%s, %s)' % (self.callable_, self.args, self.kwargs)
@@ -2,15 +2,16 @@
 from __future__ import print_function
 
 import csv
+import multiprocessing
 import os.path
 import re
-from itertools import islice, chain
+import shutil
+import tempfile
+import time
+from collections import deque
+from itertools import chain, izip
 
 import numpy as np
-try:
-    import bcolz
-except ImportError:
-    bcolz = None
 import tables
 import yaml
 
@@ -18,8 +19,8 @@ from expr import get_default_array
 from utils import (validate_dict, merge_dicts, merge_items, invert_dict,
                    countlines, skip_comment_cells, strip_rows, PrettyTable,
                    unique, duplicates, unique_duplicate, prod,
-                   field_str_to_type, fields_yaml_to_type, fromiter,
-                   LabeledArray)
+                   field_str_to_type, fields_yaml_to_type, LabeledArray,
+                   TextProgressBar, time2str)
 
 
 MB = 2.0 ** 20
@@ -105,6 +106,147 @@ def guess_type(v):
             return str
 
 
+# the np.char functions call the corresponding Python method for each string,
+# which is slow, so we work on the bytes of the strings instead for the few
+# operations we need.
+def char_codes(values):
+    """
+    returns the bytes of an array of strings as a 2d array of uint8
+    (one row per string, padded with zeros)
+
+    >>> char_codes(np.array(['Ab', 'z', '']))
+    array([[ 65,  98],
+           [122,   0],
+           [  0,   0]], dtype=uint8)
+    """
+    values = np.ascontiguousarray(values)
+    return values.view(np.uint8).reshape(len(values), values.dtype.itemsize)
+
+
+def str_lower(values):
+    """
+    >>> str_lower(np.array(['TRUE', 'False', 'a1B']))
+    array(['true', 'false', 'a1b'], dtype='|S5')
+    """
+    codes = char_codes(values).copy()
+    codes[(codes >= 65) & (codes <= 90)] += 32
+    return codes.view(values.dtype).ravel()
+
+
+def str_isdigit(values):
+    """
+    same as np.char.isdigit: whether each (non empty) string contains only
+    digits
+
+    >>> str_isdigit(np.array(['12', '1a', '', ' 1', '-1', '007']))
+    array([ True, False, False, False, False,  True])
+    """
+    codes = char_codes(values)
+    isdigit = ((codes >= 48) & (codes <= 57)) | (codes == 0)
+    return isdigit.all(axis=1) & (codes[:, 0] != 0)
+
+
+def digits_to_int(values):
+    """
+    converts an array of strings containing only digits to int
+
+    >>> digits_to_int(np.array(['12', '7', '007', '123456789']))
+    array([       12,         7,         7, 123456789])
+    """
+    result = np.zeros(len(values), dtype=int)
+    for column in char_codes(values).T:
+        isdigit = column != 0
+        result[isdigit] *= 10
+        result[isdigit] += column[isdigit] - 48
+    return result
+
+
+def guess_column_type(values):
+    """
+    vectorized version of guess_type: returns the type of a column given as
+    an array of strings, or None if all its values are empty
+
+    >>> guess_column_type(np.array(['0', '1', 'True', 'FALSE', '']))
+    <type 'bool'>
+    >>> guess_column_type(np.array(['0', '1', '2', '--']))
+    <type 'int'>
+    >>> guess_column_type(np.array(['1', '-1']))
+    <type 'float'>
+    >>> guess_column_type(np.array(['1', 'abc']))
+    <type 'str'>
+    >>> guess_column_type(np.array(['', '--'])) is None
+    True
+
+    It gives the same type as guess_type for each value:
+
+    >>> cells = ['0', '1', '2', '-3', '+3', ' 4 ', '1e3', 'nan', 'inf', '',
+    ...          '--', 'abc', 'True', '12345678901234567890']
+    >>> [c for c in cells if guess_column_type(np.array([c])) != guess_type(c)]
+    []
+    """
+    values = values[(values != '') & (values != '--')]
+    if not len(values):
+        return None
+    lower = str_lower(values)
+    isbool = ((lower == '0') | (lower == '1') |
+              (lower == 'false') | (lower == 'true'))
+    if isbool.all():
+        return bool
+    others = values[~isbool]
+    if str_isdigit(others).all():
+        return int
+    try:
+        others.astype(float)
+        return float
+    except ValueError:
+        return str
+
+
+def convert_column(values, type_):
+    """
+    vectorized version of the converters: converts an array of strings to
+    type_. Empty and '--' cells are missing values.
+
+    >>> convert_column(np.array(['1', '', '--', '42']), int)
+    array([ 1, -1, -1, 42])
+    >>> convert_column(np.array(['1.5', '', 'nan', '-inf', ' 2 ']), float)
+    array([ 1.5,  nan,  nan, -inf,  2. ])
+    >>> convert_column(np.array(['1', '0', 'TRUE', 'false']), bool)
+    array([ True, False,  True, False])
+
+    int columns with signs, spaces or (possibly) too many digits to use
+    digits_to_int are converted by numpy:
+
+    >>> convert_column(np.array(['-3', '+3', ' 10 ']), int)
+    array([-3,  3, 10])
+    >>> convert_column(np.array(['7', '1234567890123456789']), int)
+    array([                  7, 1234567890123456789])
+    >>> convert_column(np.array(['99999999999999999999']), int)
+    Traceback (most recent call last):
+    ...
+    OverflowError: Python int too large to convert to C long
+    >>> cells = ['12', '', '007', '--', '-3', '1234567890123456789']
+    >>> list(convert_column(np.array(cells), int)) == map(to_int, cells)
+    True
+    """
+    if type_ is str:
+        return values
+    elif type_ is bool:
+        lower = str_lower(values)
+        return (lower == '1') | (lower == 'true')
+    missing = (values == '') | (values == '--')
+    if missing.any():
+        result = np.empty(len(values), dtype=type_)
+        result[missing] = -1 if type_ is int else NaN
+        result[~missing] = convert_column(values[~missing], type_)
+        return result
+    # longer strings could overflow
+    if type_ is int and values.dtype.itemsize <= 18 and \
+            str_isdigit(values).all():
+        return digits_to_int(values)
+    return values.astype(type_)
+
+
 def detect_column_type(iterable):
     iterator = iter(iterable)
     coltype = 0
@@ -118,21 +260,24 @@ def detect_column_type(iterable):
     return [None, bool, int, float, str][coltype]
 
 
-# it is possible to express detect_column_types in terms of
-# split_columns_as_iterators and detect_column_type, but it is both more
-# complicated and slower, so let's keep this seemingly duplicate code here.
-def detect_column_types(iterable):
-    iterator = iter(iterable)
-    header = iterator.next()
-    numcolumns = len(header)
-    coltypes = [0] * numcolumns
+def column_type_codes(cells):
+    """
+    returns the type code (see detect_column_types) of each column of a 2d
+    array of strings (rows x columns)
+    """
     type2code = {None: 0, bool: 1, int: 2, float: 3, str: 4}
-    for row in iterator:
-        if len(row) != numcolumns:
-            raise Exception("all rows do not have the same number of columns")
-        for column, value in enumerate(row):
-            coltypes[column] = max(coltypes[column],
-                                   type2code[guess_type(value)])
+    return [type2code[guess_column_type(column)] for column in cells.T]
+
+
+def detect_column_types(header, chunks_codes):
+    """
+    header is the list of column names and chunks_codes an iterable of lists
+    of type codes (one code per column for each chunk of the file)
+    """
+    coltypes = [0] * len(header)
+    for codes in chunks_codes:
+        coltypes = [max(coltype, code)
+                    for coltype, code in zip(coltypes, codes)]
     for i, colname in enumerate(header):
         coltype = coltypes[i]
         if coltype == 0:
@@ -157,6 +302,127 @@ def transpose_table(data):
             for colnum in range(numcols)]
 
 
+def split_cells(text, numcolumns, reader_kwargs):
+    """
+    splits a block of complete lines of a csv file into a 2d array of strings
+    (rows x columns)
+    """
+    delimiter = reader_kwargs['delimiter']
+    if reader_kwargs['quotechar'] in text:
+        # let the csv module handle quoted cells
+        rows = list(csv.reader(text.splitlines(), **reader_kwargs))
+        for row in rows:
+            if len(row) != numcolumns:
+                raise Exception("invalid row length (%d != %d): %s"
+                                % (len(row), numcolumns, row))
+        return np.array(rows, dtype=str)
+
+    if '\r' in text:
+        text = text.replace('\r', '')
+    # count the delimiters on each line
+    chars = np.frombuffer(text, dtype=np.uint8)
+    isnewline = chars == 10
+    linestarts = np.concatenate(([0], np.flatnonzero(isnewline) + 1))
+    linestarts = linestarts[linestarts < len(chars)]
+    isdelimiter = chars == ord(delimiter)
+    rowlengths = np.add.reduceat(isdelimiter, linestarts, dtype=int) + 1
+    invalid = rowlengths != numcolumns
+    if invalid.any():
+        rownum = invalid.nonzero()[0][0]
+        line = text[linestarts[rownum]:].split('\n', 1)[0]
+        raise Exception("invalid row length (%d != %d): %s"
+                        % (rowlengths[rownum], numcolumns, line))
+    # knowing the length of the longest cell in advance makes creating the
+    # array of cells much faster
+    cellbounds = np.concatenate(([-1],
+                                 np.flatnonzero(isdelimiter | isnewline),
+                                 [len(chars)]))
+    maxlength = max(np.diff(cellbounds).max() - 1, 1)
+    if text.endswith('\n'):
+        text = text[:-1]
+    cells = text.replace('\n', delimiter).split(delimiter)
+    cells = np.fromiter(cells, dtype='S%d' % maxlength, count=len(cells))
+    return cells.reshape(len(linestarts), numcolumns)
+
+
+def convert_cells(cells, fields, positions):
+    """
+    converts a 2d array of strings (rows x columns) to a structured array
+    """
+    chunk = np.empty(len(cells), dtype=np.dtype(fields))
+    for (name, type_), pos in zip(fields, positions):
+        chunk[name] = convert_column(cells[:, pos], type_)
+    return chunk
+
+
+def read_cells(fpath, start, stop, numcolumns, reader_kwargs):
+    with open(fpath, "rb") as f:
+        f.seek(start)
+        text = f.read(stop - start)
+    return split_cells(text, numcolumns, reader_kwargs)
+
+
+# the functions below are run in worker processes when importing with
+# several processes, so they take a single (picklable) argument
+def read_block_type_codes(block):
+    return column_type_codes(read_cells(*block))
+
+
+def read_block_array(args):
+    block, fields, positions = args
+    return convert_cells(read_cells(*block), fields, positions)
+
+
+def read_arrays(files, fields_per_file, pool=None, buffersize=10 * MB):
+    """
+    reads several csv files (CSV objects) at once, by blocks of about
+    buffersize bytes. When using a pool of processes, blocks of all the files
+    are read in parallel.
+    """
+    jobs = []
+    for i, (f, fields) in enumerate(zip(files, fields_per_file)):
+        if f.transposed is None:
+            print(" - reading", f.fpath)
+            jobs.extend((i, job) for job in f.read_jobs(fields, buffersize))
+    chunks_per_file = [[] for _ in files]
+    results = imap_ordered(read_block_array, [job for _, job in jobs], pool)
+    for (i, _), chunk in izip(jobs, results):
+        chunks_per_file[i].append(chunk)
+
+    arrays = []
+    for f, fields, chunks in zip(files, fields_per_file, chunks_per_file):
+        if fields is None:
+            fields = f.fields
+        if f.transposed is None:
+            arrays.append(chunks_to_array(fields, chunks, f.numlines))
+        else:
+            arrays.append(f.as_array(fields))
+    return arrays
+
+
+def imap_ordered(func, iterable, pool=None):
+    """
+    like itertools.imap but runs func in pool (a multiprocessing.Pool), if
+    any. Results are returned in order, and only a few calls per process are
+    started in advance, so that results do not pile up in memory if they are
+    consumed more slowly than they are produced.
+    """
+    if pool is None:
+        for args in iterable:
+            yield func(args)
+        return
+
+    # noinspection PyProtectedMember
+    maxpending = 2 * pool._processes
+    pending = deque()
+    for args in iterable:
+        if len(pending) >= maxpending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (args,)))
+    while pending:
+        yield pending.popleft().get()
+
+
 def eval_with_template(s, template_context):
     return eval(s.format(**template_context), {'__builtins__': None})
 
@@ -164,15 +430,22 @@ def eval_with_template(s, template_context):
 class CSV(object):
     eval_re = re.compile('eval\((.*)\)')
 
-    def __init__(self, fpath, newnames=None, delimiter=None, transpose=False):
+    def __init__(self, fpath, newnames=None, delimiter=None, transpose=False,
+                 pool=None):
         f = open(fpath, "rb")
         if delimiter is None:
             dialect = csv.Sniffer().sniff(f.read(1024))
 #            dialect = csv.Sniffer().sniff(f.read(1024), ',:|\t')
             f.seek(0)
-            data_stream = csv.reader(f, dialect)
+            # we keep the format parameters instead of the dialect (which is
+            # a class) because we need to send them to other processes
+            reader_kwargs = dict((name, getattr(dialect, name))
+                                 for name in ('delimiter', 'quotechar',
+                                              'escapechar', 'doublequote',
+                                              'skipinitialspace', 'quoting'))
         else:
-            data_stream = csv.reader(f, delimiter=delimiter)
+            reader_kwargs = {'delimiter': delimiter, 'quotechar': '"'}
+        data_stream = csv.reader(f, **reader_kwargs)
         if transpose:
             transposed = transpose_table(list(data_stream))
             data_stream = iter(transposed)
@@ -190,6 +463,9 @@ class CSV(object):
                                                      {'basename': basename})
         self.newnames = newnames
         self.transposed = transposed
+        self.reader_kwargs = reader_kwargs
+        # multiprocessing.Pool used to read the file, if any
+        self.pool = pool
         self.f = f
         self.data_stream = data_stream
         self._fields = None
@@ -228,7 +504,14 @@ class CSV(object):
     def fields(self):
         if self._fields is None:
             self.rewind()
-            fields = detect_column_types(self.data_stream)
+            header = self.next()
+            if self.transposed is not None:
+                chunks_codes = [column_type_codes(cells)
+                                for cells in self._transposed_cells()]
+            else:
+                chunks_codes = imap_ordered(read_block_type_codes,
+                                            self.blocks(), self.pool)
+            fields = detect_column_types(header, chunks_codes)
             if self.newnames is not None:
                 fields = [(self.newnames.get(name, name), type_)
                           for name, type_ in fields]
@@ -244,6 +527,44 @@ class CSV(object):
                 self._numlines = countlines(self.fpath) - 1
         return self._numlines
 
+    def _positions(self, fields):
+        available = self.field_names
+        missing = set(name for name, _ in fields) - set(available)
+        if missing:
+            raise Exception("%s does not contain any field(s) named: %s"
+                            % (self.fpath, ", ".join(missing)))
+        return [available.index(name) for name, _ in fields]
+
+    def _transposed_cells(self):
+        rows = self.transposed[1:]
+        return [np.array(rows, dtype=str)] if rows else []
+
+    def blocks(self, buffersize=10 * MB):
+        """
+        splits the file (except the header line) in blocks of complete lines
+        of about buffersize bytes. Returns a list of arguments for read_cells.
+        """
+        numcolumns = len(self.field_names)
+        size = os.path.getsize(self.fpath)
+        f = self.f
+        # we cannot use self.data_stream past this point (file iteration and
+        # readline cannot be mixed), so it is only valid again after a rewind
+        f.seek(0)
+        f.readline()
+        start = f.tell()
+        blocks = []
+        while start < size:
+            if start + buffersize < size:
+                f.seek(start + int(buffersize) - 1)
+                f.readline()
+                stop = f.tell()
+            else:
+                stop = size
+            blocks.append((self.fpath, start, stop, numcolumns,
+                           self.reader_kwargs))
+            start = stop
+        return blocks
+
     def read(self, fields=None):
         """imports one Xsv file with all columns
            * columns can be in any order (they will be reordered if needed)
@@ -254,24 +575,46 @@ class CSV(object):
             fields = self.fields
             positions = None
         else:
-            available = self.field_names
-            missing = set(name for name, _ in fields) - set(available)
-            if missing:
-                raise Exception("%s does not contain any field(s) named: %s"
-                                % (self.fpath, ", ".join(missing)))
-            positions = [available.index(name) for name, _ in fields]
+            positions = self._positions(fields)
         self.rewind()
         self.next()
         return convert(self.data_stream, fields, positions)
 
+    def read_chunks(self, fields=None, buffersize=10 * MB):
+        """
+        same as read but returns an iterator of arrays (of about buffersize
+        bytes of the file each) instead of an iterator of rows. Values are
+        converted a whole column at a time, which is much faster.
+        """
+        print(" - reading", self.fpath)
+        if self.transposed is not None:
+            if fields is None:
+                fields = self.fields
+            positions = self._positions(fields)
+            return iter([convert_cells(cells, fields, positions)
+                         for cells in self._transposed_cells()])
+        return imap_ordered(read_block_array,
+                            self.read_jobs(fields, buffersize), self.pool)
+
+    def read_jobs(self, fields=None, buffersize=10 * MB):
+        """
+        returns the list of arguments for read_block_array to read the file
+        (which must not be transposed)
+        """
+        assert self.transposed is None
+        if fields is None:
+            fields = self.fields
+        positions = self._positions(fields)
+        return [(block, fields, positions)
+                for block in self.blocks(buffersize)]
+
     def as_array(self, fields=None):
         if fields is None:
             fields = self.fields
 
         # csv file is assumed to be in the correct order (ie by period then id)
-        datastream = self.read(fields)
-        return fromiter(datastream, dtype=np.dtype(fields),
-                        count=self.numlines)
+        return chunks_to_array(fields, self.read_chunks(fields),
+                               self.numlines)
 
 
 def complete_path(prefix, path):
@@ -282,7 +625,7 @@ def complete_path(prefix, path):
         return os.path.join(prefix, path)
 
 
-def compression_str2filter(compression):
+def compression_str2filter(compression, shuffle=True):
     if compression is not None:
         if '-' in compression:
             complib, complevel = compression.split('-')
@@ -291,61 +634,56 @@ def compression_str2filter(compression):
             complib, complevel = compression, 5
 
         return ("(using %s level %d compression)" % (complib, complevel),
-                tables.Filters(complevel=complevel, complib=complib))
+                tables.Filters(complevel=complevel, complib=complib,
+                               shuffle=shuffle))
     else:
         return "uncompressed", None
 
 
-def stream_to_array(fields, datastream, numlines=None, invert=()):
-    # make sure datastream is an iterator, not a list, otherwise it could
-    # loop indefinitely as it will never be consumed.
-    # Note that, contrary to what I thought, we shouldn't make a special case
-    # for that as np.fromiter(islice(iter(l), max_rows)) is faster than
-    # np.array(l[:max_rows])
-    datastream = iter(datastream)
+def chunks_to_array(fields, chunks, numlines=None, invert=()):
+    """
+    concatenates an iterable of arrays. If numlines is given, only the first
+    numlines rows are used.
+    """
     dtype = np.dtype(fields)
-    count = -1 if numlines is None else numlines
-    array = fromiter(datastream, dtype=dtype, count=count)
+    if numlines is None:
+        chunks = list(chunks)
+        array = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+    else:
+        array = np.empty(numlines, dtype=dtype)
+        start = 0
+        for chunk in chunks:
+            if start == numlines:
+                break
+            chunk = chunk[:numlines - start]
+            array[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        if start < numlines:
+            raise ValueError("iterator too short")
     for field in invert:
         array[field] = ~array[field]
     return array
 
 
-def stream_to_table(h5file, node, name, fields, datastream, numlines=None,
-                    title=None, invert=(), buffersize=10 * 2 ** 20,
-                    compression=None):
-    # make sure datastream is an iterator, not a list, otherwise it could
-    # loop indefinitely as it will never be consumed.
-    # Note that, contrary to what I thought, we shouldn't make a special case
-    # for that as np.fromiter(islice(iter(l), max_rows)) is faster than
-    # np.array(l[:max_rows])
-    datastream = iter(datastream)
+def chunks_to_table(h5file, node, name, fields, chunks, numlines=None,
+                    title=None, invert=(), compression=None):
     msg, filters = compression_str2filter(compression)
-    print(" - storing %s..." % msg)
+    print(" - storing %s..." % msg, end=' ')
     dtype = np.dtype(fields)
     table = h5file.create_table(node, name, dtype, title=title, filters=filters)
-    # buffered load
-    max_buffer_rows = buffersize // dtype.itemsize
-    while True:
-        dataslice = islice(datastream, max_buffer_rows)
-        if numlines is not None:
-            if numlines <= 0:
-                break
-            buffer_rows = min(numlines, max_buffer_rows)
-            # ideally, we should preallocate an empty buffer and reuse it,
-            # but that does not seem to be supported by numpy
-            array = fromiter(dataslice, dtype=dtype, count=buffer_rows)
-            numlines -= buffer_rows
-        else:
-            array = fromiter(dataslice, dtype=dtype)
-            if not len(array):
-                break
-
+    progress_bar = TextProgressBar(numlines) if numlines else None
+    start_time = time.time()
+    for array in chunks:
         for field in invert:
             array[field] = ~array[field]
         table.append(array)
         table.flush()
-
+        if progress_bar is not None:
+            progress_bar.update(table.nrows)
+    elapsed = time.time() - start_time
+    rows_per_sec = str(int(table.nrows / elapsed)) if elapsed else 'inf'
+    print("done (%d rows, %s elapsed, %s rows/s)."
+          % (table.nrows, time2str(elapsed), rows_per_sec))
     return table
 
 
@@ -373,105 +711,239 @@ def array_to_disk_array(node, name, array, title='', compression=None):
 
 
 def union1d(arrays):
-    """arrays is an iterable returning arrays"""
-    result = arrays.next()
-    for array in arrays:
-        result = np.union1d(result, array)
-    return result
+    """
+    arrays is an iterable returning arrays. For structured arrays, the result
+    is sorted by the first field, then the second, etc.
+    """
+    result = np.concatenate(list(arrays))
+    names = result.dtype.names
+    if names is None:
+        return np.unique(result)
+    # sorting structured arrays directly is much slower
+    result = result[np.lexsort([result[name] for name in reversed(names)])]
+    isnew = np.ones(len(result), dtype=bool)
+    isnew[1:] = np.any([result[name][1:] != result[name][:-1]
+                        for name in names], axis=0)
+    return result[isnew]
 
 
 def interpolate(target, arrays, id_periods, fields):
+    """
+    sets the values of target (which has one row per (period, id) in
+    id_periods) from the values in arrays. The fields given are interpolated:
+    the value of each data point is also used for the rows of the same id in
+    the following periods, until the next data point for that id in the same
+    array.
+    """
     print(" * indexing...")
+    # we work on the rows of target sorted by id then period, using a single
+    # integer key for each (id, period) pair
     periods = np.unique(id_periods['period'])
-    max_id = np.max(id_periods['id'])
-
-    row_for_id = {}
-    for period in periods:
-        # this might seem very wasteful but when compressed through
-        # bcolz it is much smaller than an (id, rownum) dict, while
-        # being only a bit slower
-        row_for_id[period] = np.full(max_id + 1, -1, dtype=int)
-
-    numrows = len(id_periods)
-    lastrow_for_id = {}
-
-    # compressing this with bcolz yield interesting compression but
-    # is really too slow to use afterwards because access is
-    # not sequential at all.
-    nextrow_for_id = np.full(numrows, -1, dtype=int)
-    for rownum, (period, record_id) in enumerate(id_periods):
-        row_for_id[period][record_id] = rownum
-
-        # this assumes id_periods are ordered by period, which
-        # is implicitly the case because of union1d
-        lastrow = lastrow_for_id.get(record_id)
-        if lastrow is not None:
-            nextrow_for_id[lastrow] = rownum
-        lastrow_for_id[record_id] = rownum
-    del lastrow_for_id
-
-    size = sum(row_for_id[period].nbytes for period in periods)
-
-    if bcolz is not None:
-        print(" * compressing index (%.2f Mb)..." % (size / MB), end=' ')
-        for period in periods:
-            row_for_id[period] = bcolz.carray(row_for_id[period])
-        csize = sum(row_for_id[period].cbytes for period in periods)
-        print("done. (%.2f Mb)" % (csize / MB))
-    else:
-        print('bcolz package not found (bcolz is required to use compression '
-              'during interpolate)')
+    numperiods = len(periods)
+
+    def id_period_keys(array):
+        period_idx = np.searchsorted(periods, array['period'])
+        return array['id'].astype(np.int64) * numperiods + period_idx
+
+    target_keys = id_period_keys(id_periods)
+    # target rows in (id, period) order
+    order = np.argsort(target_keys, kind='mergesort')
+    sorted_keys = target_keys[order]
+    sorted_ids = id_periods['id'][order]
+    del target_keys
 
     print(" * interpolating...")
     for values in arrays:
-        # sort it by id, then period
-        values.sort(order=('id', 'period'))
-
-        input_stream = iter(values)
+        if not len(values):
+            continue
+        values_keys = id_period_keys(values)
+        values_order = np.argsort(values_keys, kind='mergesort')
+        values = values[values_order]
+        # position (in sorted_keys) of the row of each data point
+        positions = np.searchsorted(sorted_keys, values_keys[values_order])
 
-        # eg we get:
-        # 10, 2001, 5324.0
-        # 10, 2004, 6200.0
-        # 10, 2005, 7300.0
-        prev_row = input_stream.next()
         fields_to_set = \
-            [name for name in prev_row.dtype.names
+            [name for name in values.dtype.names
              if name in target.dtype.names and name not in ('id', 'period')]
         fields_to_interpolate = [name for name in fields_to_set
                                  if name in fields]
         fields_to_copy = [name for name in fields_to_set
                           if name not in fields]
-        # compute row in target array
-        # 10, 2001, 5324.0 -> rowtofill = 154
-        # 10, 2004, 6200.0
-        # 10, 2005, 7300.0
-        rowtofill = row_for_id[prev_row['period']][prev_row['id']]
-        for row in input_stream:
-            target_row = target[rowtofill]
-            for fname in fields_to_copy:
-                target_row[fname] = prev_row[fname]
-
-            # 10, 2001, 5324.0 -> rowtofill = 154
-            # 10, 2004, 6200.0 -> rownum = 180
-            # 10, 2005, 7300.0
-            rownum = row_for_id[row['period']][row['id']]
-            # fill the row corresponding to the previous data point at
-            # id, period (rowtofill) *and* all the rows (in the target
-            # array) in between that point and this one (rownum)
-            while rowtofill != -1 and rowtofill != rownum:
-                target_row = target[rowtofill]
-                for fname in fields_to_interpolate:
-                    target_row[fname] = prev_row[fname]
-                rowtofill = nextrow_for_id[rowtofill]
-
-            rowtofill = rownum
-            prev_row = row
-
-        while rowtofill != -1:
-            target_row = target[rowtofill]
+
+        target_rows = order[positions]
+        for fname in fields_to_copy:
+            target[fname][target_rows] = values[fname]
+
+        if fields_to_interpolate:
+            # index (in values) of the data point at each position, or -1
+            source = np.full(len(sorted_keys), -1, dtype=int)
+            source[positions] = np.arange(len(values))
+            # forward-fill the positions of the data points...
+            last_position = np.where(source != -1,
+                                     np.arange(len(sorted_keys)), -1)
+            np.maximum.accumulate(last_position, out=last_position)
+            # ... but only within each id
+            tofill = last_position != -1
+            tofill[tofill] = sorted_ids[last_position[tofill]] == \
+                sorted_ids[tofill]
+            source_rows = source[last_position[tofill]]
+            target_rows = order[tofill]
             for fname in fields_to_interpolate:
-                target_row[fname] = prev_row[fname]
-            rowtofill = nextrow_for_id[rowtofill]
+                target[fname][target_rows] = values[fname][source_rows]
+
+
+# keys of (period, id) pairs for out-of-core imports. ids must fit in 32 bits.
+ID_BITS = 32
+
+
+def period_id_keys(array):
+    """
+    returns a single int64 key for each (period, id) pair of array. Sorting
+    the keys sorts the pairs by period, then id.
+    """
+    ids = array['id']
+    if len(ids) and (ids.min() < 0 or ids.max() >= 2 ** ID_BITS):
+        raise Exception("ids must be between 0 and %d to import files out of "
+                        "core" % (2 ** ID_BITS - 1))
+    return (array['period'].astype(np.int64) << ID_BITS) + ids
+
+
+def chunks_to_sorted_table(h5file, name, fields, chunks):
+    """
+    stores chunks (arrays with at least the period and id fields) in a new
+    table of h5file, with an extra _key column (see period_id_keys) on which a
+    completely sorted index is created, so that the rows can be read back in
+    (period, id) order without loading them all in memory.
+    Returns the table and the largest id.
+    """
+    dtype = np.dtype(fields + [('_key', np.int64)])
+    table = h5file.create_table('/', name, dtype)
+    max_id = -1
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        array = np.empty(len(chunk), dtype=dtype)
+        for fname, _ in fields:
+            array[fname] = chunk[fname]
+        array['_key'] = period_id_keys(chunk)
+        table.append(array)
+        max_id = max(max_id, chunk['id'].max())
+    table.flush()
+    # the index is built out of core (in temporary files in the directory
+    # of h5file)
+    table.cols._key.create_csindex()
+    return table, max_id
+
+
+def iter_sorted_chunks(table, buffersize=10 * MB):
+    """
+    yields the rows of a table created by chunks_to_sorted_table, in
+    (period, id) order, by chunks of about buffersize bytes
+    """
+    chunksize = max(int(buffersize // table.rowsize), 1)
+    numrows = table.nrows
+    for start in range(0, numrows, chunksize):
+        # read_sorted does not support stop > nrows (it never returns)
+        yield table.read_sorted('_key', checkCSI=True, start=start,
+                                stop=min(start + chunksize, numrows))
+
+
+def merge_sorted_tables(h5file, tables_, target_fields, max_id, fields,
+                        buffersize=10 * MB):
+    """
+    merges tables created by chunks_to_sorted_table into arrays of
+    target_fields, with one row for each (period, id) pair present in any of
+    the tables, in (period, id) order. This is the out-of-core equivalent of
+    union1d + interpolate: only one chunk of each table and, for each
+    interpolated field (given in fields), one value per id are kept in memory.
+    h5file is closed and removed once all rows have been returned.
+    """
+    target_dtype = np.dtype(target_fields)
+    try:
+        readers = [iter_sorted_chunks(table, buffersize) for table in tables_]
+        buffers = [table.read(0, 0) for table in tables_]
+
+        fields_to_copy = []
+        interpolated = []
+        for table in tables_:
+            fields_to_set = [name for name in table.colnames
+                             if name in target_dtype.names and
+                             name not in ('id', 'period')]
+            fields_to_copy.append([name for name in fields_to_set
+                                   if name not in fields])
+            # last value of each interpolated field for each id, and
+            # whether that id had any value yet
+            last_values = dict((name, np.empty(max_id + 1,
+                                               dtype=target_dtype[name]))
+                               for name in fields_to_set if name in fields)
+            if last_values:
+                last_values = (np.zeros(max_id + 1, dtype=bool), last_values)
+            else:
+                last_values = None
+            interpolated.append(last_values)
+
+        while True:
+            for i, reader in enumerate(readers):
+                if reader is not None and not len(buffers[i]):
+                    buffers[i] = next(reader, buffers[i])
+                    if not len(buffers[i]):
+                        readers[i] = None
+            active = [buf for buf, reader in zip(buffers, readers)
+                      if reader is not None]
+            if not active:
+                break
+
+            # all the rows up to the smallest last key of the buffers are
+            # available. The others must wait for the next chunk of the
+            # table the smallest key comes from.
+            bound = min(buf['_key'][-1] for buf in active)
+            parts = []
+            for i, buf in enumerate(buffers):
+                n = np.searchsorted(buf['_key'], bound, side='right')
+                parts.append(buf[:n])
+                buffers[i] = buf[n:]
+
+            keys = np.unique(np.concatenate([part['_key'] for part in parts]))
+            target = get_default_array(len(keys), target_dtype)
+            target['period'] = keys >> ID_BITS
+            target['id'] = keys & (2 ** ID_BITS - 1)
+
+            # target rows are sorted by period, so we can process each period
+            # in turn (they are contiguous)
+            periods, starts = np.unique(target['period'], return_index=True)
+            stops = np.append(starts[1:], len(target))
+            period_keys = periods.astype(np.int64) << ID_BITS
+
+            for part, to_copy, last_values in izip(parts, fields_to_copy,
+                                                   interpolated):
+                positions = np.searchsorted(keys, part['_key'])
+                for fname in to_copy:
+                    target[fname][positions] = part[fname]
+
+                # even without any data point in this chunk, the rows of
+                # target must get the last values of previous chunks
+                if last_values is None:
+                    continue
+                has_value, values = last_values
+                part_starts = np.searchsorted(part['_key'], period_keys)
+                part_stops = np.searchsorted(part['_key'],
+                                             period_keys + 2 ** ID_BITS)
+                for start, stop, part_start, part_stop in \
+                        izip(starts, stops, part_starts, part_stops):
+                    ids = part['id'][part_start:part_stop]
+                    has_value[ids] = True
+                    for fname, fvalues in values.iteritems():
+                        fvalues[ids] = part[fname][part_start:part_stop]
+                    target_ids = target['id'][start:stop]
+                    tofill = has_value[target_ids]
+                    ids_tofill = target_ids[tofill]
+                    for fname, fvalues in values.iteritems():
+                        target[fname][start:stop][tofill] = fvalues[ids_tofill]
+            yield target
+    finally:
+        h5path = h5file.filename
+        h5file.close()
+        os.remove(h5path)
 
 
 def load_ndarray(fpath, celltype=None):
@@ -556,7 +1028,12 @@ def load_table(fpath, fields=None, newnames=None, delimiter=None, transpose=Fals
     return array
 
 
-def load_def(localdir, ent_name, section_def, required_fields):
+def load_def(localdir, ent_name, section_def, required_fields,
+             buffersize=10 * MB, pool=None, tmp_dir=None):
+    """
+    When tmp_dir is given, several files are merged out of core, using
+    temporary files in tmp_dir (this is only supported for entities).
+    """
     if 'type' in section_def and 'fields' in section_def:
         raise Exception("invalid structure for '%s': "
                         "type and fields sections are mutually exclusive"
@@ -607,20 +1084,17 @@ def load_def(localdir, ent_name, section_def, required_fields):
         csv_filename = section_def.get('path', ent_name + ".csv")
         csv_filepath = complete_path(localdir, csv_filename)
         csv_file = CSV(csv_filepath, newnames,
-                       delimiter=',', transpose=transpose)
-        stream = csv_file.read(fields)
+                       delimiter=',', transpose=transpose, pool=pool)
         if fields is None:
             fields = csv_file.fields
+        chunks = csv_file.read_chunks(fields, buffersize)
         if interpolate_def is not None:
             raise Exception('interpolate is currently only supported with '
                             'multiple files')
-        return 'table', (fields, csv_file.numlines, stream, csv_file)
+        return 'table', (fields, csv_file.numlines, chunks, csv_file)
     else:
         # we have to load all files, merge them and return a stream out of that
-        print(" * computing number of rows...")
-
-        # 1) only load required fields
-        default_args = dict(newnames=newnames, transpose=transpose)
+        default_args = dict(newnames=newnames, transpose=transpose, pool=pool)
         if isinstance(files_def, dict):
             files_items = files_def.items()
         elif isinstance(files_def, list) and files_def:
@@ -644,10 +1118,14 @@ def load_def(localdir, ent_name, section_def, required_fields):
             f = CSV(complete_path(localdir, path),
                     **merge_dicts(default_args, kwargs))
             files.append(f)
-        id_periods = union1d(f.as_array(required_fields) for f in files)
+        required_names = set(name for name, _ in required_fields)
+        for f in files:
+            missing = required_names - set(f.field_names)
+            if missing:
+                raise Exception("%s does not contain any field(s) named: %s"
+                                % (f.fpath, ", ".join(missing)))
 
         print(" * reading files...")
-        # 2) load all fields
         if fields is None:
             target_fields = merge_items(*[f.fields for f in files])
             fields_per_file = [None for _ in files]
@@ -662,20 +1140,6 @@ def load_def(localdir, ent_name, section_def, required_fields):
                 raise Exception("the following fields were not found in any "
                                 "file: %s" % ", ".join(missing))
 
-        total_lines = len(id_periods)
-
-        # allocate main array
-        target = get_default_array(total_lines, np.dtype(target_fields))
-        target['period'] = id_periods['period']
-        target['id'] = id_periods['id']
-
-        arrays = [f.as_array(fields_to_load)
-                  for f, fields_to_load in zip(files, fields_per_file)]
-
-        # close all files
-        for f in files:
-            f.close()
-
         # FIXME: interpolation currently only interpolates missing data points,
         # not data points with their value equal the missing value
         # corresponding to the field type. This can only be fixed once
@@ -690,8 +1154,57 @@ def load_def(localdir, ent_name, section_def, required_fields):
         else:
             to_interpolate = []
 
+        if tmp_dir is not None:
+            assert [name for name, _ in required_fields] == ['period', 'id']
+            h5file = tables.open_file(os.path.join(tmp_dir, ent_name + '.h5'),
+                                      mode='w')
+            try:
+                tables_ = []
+                max_id = -1
+                for i, (f, file_fields) in enumerate(zip(files,
+                                                         fields_per_file)):
+                    if file_fields is None:
+                        file_fields = f.fields
+                    chunks = f.read_chunks(file_fields, buffersize)
+                    print(" - sorting...")
+                    table, file_max_id = \
+                        chunks_to_sorted_table(h5file, 'file%d' % i,
+                                               file_fields, chunks)
+                    f.close()
+                    tables_.append(table)
+                    max_id = max(max_id, file_max_id)
+            except Exception:
+                h5file.close()
+                raise
+            print(" * merging files...")
+            chunks = merge_sorted_tables(h5file, tables_, target_fields,
+                                         max_id, to_interpolate, buffersize)
+            # the number of rows is not known in advance
+            return 'table', (target_fields, None, chunks, None)
+
+        arrays = read_arrays(files, fields_per_file, pool, buffersize)
+
+        # close all files
+        for f in files:
+            f.close()
+
+        print(" * computing number of rows...")
+
+        def id_period_array(array):
+            result = np.empty(len(array), dtype=np.dtype(required_fields))
+            for name, _ in required_fields:
+                result[name] = array[name]
+            return result
+        id_periods = union1d(id_period_array(array) for array in arrays)
+        total_lines = len(id_periods)
+
+        # allocate main array
+        target = get_default_array(total_lines, np.dtype(target_fields))
+        target['period'] = id_periods['period']
+        target['id'] = id_periods['id']
+
         interpolate(target, arrays, id_periods, to_interpolate)
-        return 'table', (target_fields, total_lines, iter(target), None)
+        return 'table', (target_fields, total_lines, [target], None)
 
 
 def csv2h5(fpath, buffersize=10 * 2 ** 20):
@@ -701,6 +1214,8 @@ def csv2h5(fpath, buffersize=10 * 2 ** 20):
     yaml_layout = {
         '#output': str,
         'compression': str,
+        'processes': int,
+        'out_of_core': bool,
         'globals': {
             'periodic': {
                 'path': str,
@@ -762,10 +1277,23 @@ def csv2h5(fpath, buffersize=10 * 2 ** 20):
 
     h5_filename = content['output']
     compression = content.get('compression')
+    processes = content.get('processes', 1)
     h5_filepath = complete_path(localdir, h5_filename)
     print("Importing in", h5_filepath)
+    tmp_dir = None
+    pool = None
     h5file = None
     try:
+        if content.get('out_of_core', False):
+            # the temporary files can be as large as the input files, so we
+            # create them next to the output file rather than in the system
+            # temporary directory (which is often much smaller, or in memory)
+            tmp_dir = tempfile.mkdtemp(prefix='liam2-', suffix='-tmp',
+                                       dir=os.path.dirname(h5_filepath))
+        # files are parsed in worker processes but only this process writes
+        # to the output file. The pool must be created before opening it.
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
         h5file = tables.open_file(h5_filepath, mode="w", title="CSV import")
 
         globals_def = content.get('globals', {})
@@ -781,18 +1309,18 @@ def csv2h5(fpath, buffersize=10 * 2 ** 20):
                     if global_name == 'periodic' else []
 
                 kind, info = load_def(localdir, global_name,
-                                      global_def, req_fields)
+                                      global_def, req_fields, buffersize,
+                                      pool)
                 if kind == 'ndarray':
                     array_to_disk_array(const_node, global_name, info,
                                         title=global_name,
                                         compression=compression)
                 else:
                     assert kind == 'table'
-                    fields, numlines, datastream, csvfile = info
-                    stream_to_table(h5file, const_node, global_name, fields,
-                                    datastream, numlines,
+                    fields, numlines, chunks, csvfile = info
+                    chunks_to_table(h5file, const_node, global_name, fields,
+                                    chunks, numlines,
                                     title="%s table" % global_name,
-                                    buffersize=buffersize,
                                     # FIXME: handle invert
                                     compression=compression)
                     if csvfile is not None:
@@ -806,19 +1334,26 @@ def csv2h5(fpath, buffersize=10 * 2 ** 20):
             print()
             print(" %s" % ent_name)
             kind, info = load_def(localdir, ent_name,
-                                  entity_def, [('period', int), ('id', int)])
+                                  entity_def, [('period', int), ('id', int)],
+                                  buffersize, pool, tmp_dir)
             assert kind == "table"
-            fields, numlines, datastream, csvfile = info
+            fields, numlines, chunks, csvfile = info
 
-            stream_to_table(h5file, ent_node, ent_name, fields,
-                            datastream, numlines,
+            chunks_to_table(h5file, ent_node, ent_name, fields,
+                            chunks, numlines,
                             title="%s table" % ent_name,
                             invert=entity_def.get('invert', []),
-                            buffersize=buffersize, compression=compression)
+                            compression=compression)
             if csvfile is not None:
                 csvfile.close()
     finally:
+        if pool is not None:
+            # all results have been consumed at this point (unless we failed)
+            pool.terminate()
+            pool.join()
         if h5file is not None:
             h5file.close()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
     print()
     print("done.")
@@ -157,6 +157,7 @@ class LinkExpression(FunctionExpr):
 class LinkGet(LinkExpression):
     funcname = "get"
     no_eval = ('target_expr',)
+    rowwise = True
 
     def traverse(self):
         # XXX: don't we also need the fields within the target expression?
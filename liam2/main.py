@@ -136,7 +136,9 @@ def simulate(args):
                                       log_level=args.loglevel,
                                       assertions=args.assertions,
                                       autodump=args.autodump,
-                                      autodiff=args.autodiff)
+                                      autodiff=args.autodiff,
+                                      optimize=args.optimize,
+                                      profile=args.profile)
 
     simulation.run(args.interactive)
 #    import cProfile as profile
@@ -297,6 +299,11 @@ def main():
     parser_run.add_argument('--autodiff', help='path of the autodiff file')
     parser_run.add_argument('--assertions', choices=['raise', 'warn', 'skip'],
                             help='determines behavior of assertions')
+    parser_run.add_argument('--optimize', action='store_const', const=True,
+                            help='compute common subexpressions only once')
+    parser_run.add_argument('--profile', action='store_const', const=True,
+                            help='record the time spent in each process and '
+                                 'expression')
 
     # create the parser for the "import" command
     parser_import = subparsers.add_parser('import', help='import data')
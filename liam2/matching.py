@@ -2,11 +2,11 @@
 from __future__ import print_function
 
 import numpy as np
-import random
 
 from expr import expr_eval, always, expr_cache
 from exprbases import FilteredExpression
 from context import context_length, context_delete, context_subset, context_keep
+from random_streams import py_random
 from utils import loop_wh_progress
 # FIXME: should be optional
 from cpartition import group_indices_nd
@@ -210,7 +210,7 @@ class SequentialMatching(Matching):
                 raise StopIteration
 
             if pool_size is not None and set2_size > pool_size:
-                pool = random.sample(xrange(set2_size), pool_size)
+                pool = py_random().sample(xrange(set2_size), pool_size)
                 local_ctx = context_subset(matching_ctx, pool)
             else:
                 local_ctx = matching_ctx.copy()
@@ -0,0 +1,174 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import Queue
+import sys
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import aggregates
+import config
+from exprbases import NumpyRandom
+from expr import (Expr, Variable, GlobalVariable, SubscriptedExpr,
+                  MethodCall)
+from links import Link, LinkExpression, Many2One
+from process import Assignment, ProcessGroup, While, Function, Return, all_nodes
+
+
+# expression nodes (besides element-wise ones) which only read variables and
+# do not modify any global state, so that they can be evaluated concurrently
+# with processes of other entities
+THREAD_SAFE_NODE_TYPES = (Variable, GlobalVariable, SubscriptedExpr,
+                          LinkExpression, MethodCall,
+                          aggregates.All, aggregates.Any, aggregates.Count,
+                          aggregates.Min, aggregates.Max, aggregates.Sum,
+                          aggregates.Average, aggregates.Std,
+                          aggregates.Median, aggregates.Percentile,
+                          aggregates.Gini)
+
+
+def process_access(process, calls=None):
+    """
+    returns (reads, writes), the sets of variables (as (entity name,
+    variable name) pairs) process reads and writes, or None if process can
+    have other side effects (modifying the number of individuals, writing to
+    a file, drawing random numbers, ...) and thus cannot run concurrently with
+    any other process.
+    """
+    if calls is None:
+        calls = set()
+    entity_name = process.entity.name
+    reads, writes = set(), set()
+    if isinstance(process, Function):
+        if process in calls:
+            # recursive function
+            return None
+        calls = calls | {process}
+        expressions = [process.result]
+        subprocesses = [process.code] if process.code is not None else []
+    elif isinstance(process, ProcessGroup):
+        expressions = []
+        subprocesses = [p for _, p in process.subprocesses]
+    elif isinstance(process, While):
+        expressions = [process.cond]
+        subprocesses = [process.code]
+    elif isinstance(process, Assignment):
+        if process.name is not None:
+            writes.add((entity_name, process.name))
+        expressions = [process.expr]
+        subprocesses = []
+    elif isinstance(process, Return):
+        expressions = [process.result_expr]
+        subprocesses = []
+    else:
+        return None
+
+    for p in subprocesses:
+        access = process_access(p, calls)
+        if access is None:
+            return None
+        reads |= access[0]
+        writes |= access[1]
+
+    for node in all_nodes(expressions):
+        if isinstance(node, Expr):
+            if not (node.elementwise or node.rowwise or
+                    isinstance(node, THREAD_SAFE_NODE_TYPES)):
+                # each process has its own random stream
+                if not (config.random_streams and
+                        isinstance(node, NumpyRandom)):
+                    return None
+            if isinstance(node, MethodCall):
+                # methods of other entities modify the local variables of
+                # that entity
+                if node.entity is not process.entity:
+                    return None
+                access = process_access(node.entity.processes[node.name],
+                                        calls)
+                if access is None:
+                    return None
+                reads |= access[0]
+                writes |= access[1]
+            elif isinstance(node, Variable) and \
+                    not isinstance(node, GlobalVariable):
+                entity = node.entity
+                reads.add((entity.name if entity is not None else entity_name,
+                           node.name))
+        elif isinstance(node, Link):
+            # noinspection PyProtectedMember
+            if isinstance(node, Many2One):
+                # noinspection PyProtectedMember
+                reads.add((node._entity.name, node._link_field))
+            else:
+                # noinspection PyProtectedMember
+                reads.add((node._target_entity_name, node._link_field))
+    return reads, writes
+
+
+def process_dependencies(processes):
+    """
+    returns, for each process of the list, the set of the indices of the
+    (earlier) processes which must be completed before it can start. Processes
+    of the same entity always depend on each other.
+    """
+    accesses = [process_access(p) for p in processes]
+    dependencies = []
+    for i, (process, access) in enumerate(zip(processes, accesses)):
+        depends_on = set()
+        for j in range(i):
+            other, other_access = processes[j], accesses[j]
+            if (access is None or other_access is None or
+                    process.entity is other.entity):
+                depends_on.add(j)
+                continue
+            reads, writes = access
+            other_reads, other_writes = other_access
+            if (writes & (other_reads | other_writes) or
+                    reads & other_writes):
+                depends_on.add(j)
+        dependencies.append(depends_on)
+    return dependencies
+
+
+def run_concurrently(tasks, dependencies, num_threads):
+    """
+    runs tasks (callables without argument) in a pool of num_threads threads.
+    A task starts as soon as all the tasks it depends on are completed.
+    Yields the result of each task, in the order of tasks, as soon as it is
+    available (and all results before it have been yielded). If a task
+    raises an exception, the tasks already started are completed, then the
+    exception is raised.
+    """
+    done = Queue.Queue()
+
+    def run_task(i):
+        # numpy error handling is per thread
+        np.seterr(divide='ignore', invalid='ignore')
+        try:
+            done.put((i, tasks[i](), None))
+        except Exception:
+            done.put((i, None, sys.exc_info()))
+
+    pool = ThreadPool(num_threads)
+    started, completed = set(), set()
+    results = {}
+    next_idx = 0
+    try:
+        while next_idx < len(tasks):
+            for i in range(len(tasks)):
+                if i not in started and dependencies[i] <= completed:
+                    started.add(i)
+                    pool.apply_async(run_task, (i,))
+            # using a timeout so that the wait can be interrupted (Ctrl-C)
+            i, result, exc_info = done.get(True, 1e9)
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            completed.add(i)
+            results[i] = result
+            while next_idx in results:
+                yield results.pop(next_idx)
+                next_idx += 1
+    finally:
+        pool.close()
+        pool.join()
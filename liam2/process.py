@@ -9,10 +9,34 @@ import config
 from diff_h5 import diff_array
 from data import append_carray_to_table, ColumnArray
 from expr import Expr, Variable, type_to_idx, idx_to_type, expr_eval, expr_cache
-from context import EntityContext
+from context import EntityContext, context_length
+from writer import h5lock
+import profiler
 import utils
 
 
+def all_nodes(expr):
+    """
+    yields all nodes (including non-Expr leaves) of expr. Contrary to
+    Expr.traverse(), this also yields the nodes which are not traversed by some
+    expressions (eg the arguments of link methods and matching()).
+    """
+    if isinstance(expr, Expr):
+        yield expr
+        for child in expr.children:
+            for node in all_nodes(child):
+                yield node
+    elif isinstance(expr, (tuple, list)):
+        for e in expr:
+            for node in all_nodes(e):
+                yield node
+    elif isinstance(expr, slice):
+        for node in all_nodes((expr.start, expr.stop, expr.step)):
+            yield node
+    else:
+        yield expr
+
+
 class BreakpointException(Exception):
     pass
 
@@ -150,6 +174,14 @@ class ProcessGroup(Process):
         self.calls = collections.Counter()
         self.purge = purge
         self.versions = {}
+        # names of the variables which are used after the group has run (eg
+        # by the result expression of a function). None means local variables
+        # are kept until the end of the function, which is necessary in loops.
+        self.live_at_exit = None
+        self._dead_locals = None
+        # peak memory used by the temporary variables of the entity after any
+        # of the processes of the group
+        self.peak_temp_mem = 0
 
     def run_guarded(self, context):
         period = context.period
@@ -158,15 +190,17 @@ class ProcessGroup(Process):
             print()
 
         try:
-            for k, v in self.subprocesses:
+            for i, (k, v) in enumerate(self.subprocesses):
                 if config.log_level == "processes":
                     print("    *", end=' ')
                     if k is not None:
                         print(k, end=' ')
-                    utils.timed(v.run_guarded, context)
+                    utils.timed(self._run_subprocess, i, k, v, context)
                 else:
-                    v.run_guarded(context)
+                    self._run_subprocess(i, k, v, context)
                     #            print "done."
+                self._update_peak_temp_mem()
+                self._release_dead_locals(i, context)
                 context.simulation.start_console(context)
         finally:
             if config.autodump is not None:
@@ -178,6 +212,80 @@ class ProcessGroup(Process):
             if self.purge:
                 self.entity.purge_locals()
 
+    def _run_subprocess(self, i, name, process, context):
+        if profiler.enabled():
+            # unnamed processes (eg show()) are identified by their position
+            label = name if name is not None else '#%d' % (i + 1)
+            with profiler.profiled(label, context_length(context)):
+                process.run_guarded(context)
+        else:
+            process.run_guarded(context)
+
+    def _update_peak_temp_mem(self):
+        temp_mem = sum(v.nbytes for v in self.entity.temp_variables.itervalues()
+                       if isinstance(v, np.ndarray))
+        self.peak_temp_mem = max(self.peak_temp_mem, temp_mem)
+
+    def _release_dead_locals(self, i, context):
+        # the variables are needed to dump/compare them or to inspect them
+        # in the console
+        if (config.autodump is not None or config.autodiff is not None or
+                context.simulation.stepbystep):
+            return
+        temp_variables = self.entity.temp_variables
+        for name in self.dead_locals.get(i, ()):
+            temp_variables.pop(name, None)
+
+    @property
+    def dead_locals(self):
+        """
+        {process index: [names of the local variables which are not used
+        anymore after that process]}. Local variables are variables assigned
+        in the group which are neither fields nor global temporaries.
+        """
+        if self._dead_locals is None:
+            self._dead_locals = self._compute_dead_locals()
+        return self._dead_locals
+
+    def _compute_dead_locals(self):
+        if self.live_at_exit is None:
+            return {}
+        global_vars = set(self.entity.variables.keys())
+        local_vars = set(k for k, p in self.subprocesses
+                         if isinstance(p, Assignment) and k is not None and
+                         k not in global_vars)
+        local_vars -= self.live_at_exit
+
+        # index of the last process using or assigning each variable
+        last_use = {}
+        for i, (k, p) in enumerate(self.subprocesses):
+            # expressions() only yields Expr but these can also be tuples
+            if isinstance(p, Assignment):
+                expressions = [p.expr]
+            elif isinstance(p, Return):
+                expressions = [p.result_expr]
+            else:
+                expressions = p.expressions()
+            for expr in expressions:
+                for node in all_nodes(expr):
+                    if isinstance(node, Expr):
+                        # eg dump() without argument
+                        if node.uses_all_variables:
+                            return {}
+                        if isinstance(node, Variable):
+                            last_use[node.name] = i
+                    elif isinstance(node, basestring):
+                        # some functions take variable names as strings (eg
+                        # the error_var argument of cont_regr)
+                        last_use[node] = i
+            if k in local_vars:
+                last_use[k] = i
+
+        dead_locals = collections.defaultdict(list)
+        for name in local_vars:
+            dead_locals[last_use[name]].append(name)
+        return dict(dead_locals)
+
     @property
     def predictors(self):
         return [v.name for _, v in self.subprocesses
@@ -217,15 +325,15 @@ class ProcessGroup(Process):
         h5file = config.autodump_file
         name = self._tablename(period)
         dtype = np.dtype([(k, v.dtype) for k, v in fields])
-        table = h5file.create_table('/{}'.format(period), name, dtype,
-                                    createparents=True)
-
         fnames = [k for k, _ in fields]
         print("writing {} to {}/{}/{} ...".format(', '.join(fnames),
                                                   fname, period, name))
 
         entity_context = EntityContext(context, self.entity, {'period': period})
-        append_carray_to_table(entity_context, table, numrows)
+        with h5lock:
+            table = h5file.create_table('/{}'.format(period), name, dtype,
+                                        createparents=True)
+            append_carray_to_table(entity_context, table, numrows)
         print("done.")
 
     def _autodiff(self, period, showdiffs=10, raiseondiff=False):
@@ -237,9 +345,13 @@ class ProcessGroup(Process):
         h5file = config.autodump_file
         tablepath = '/p{}/{}'.format(period, self._tablename(period))
         print("comparing with {}{} ...".format(fname, tablepath))
-        if tablepath in h5file:
-            table = h5file.getNode(tablepath)
-            disk_array = ColumnArray.from_table(table, stop=numrows)
+        with h5lock:
+            if tablepath in h5file:
+                disk_array = ColumnArray.from_table(h5file.getNode(tablepath),
+                                                    stop=numrows)
+            else:
+                disk_array = None
+        if disk_array is not None:
             diff_array(disk_array, ColumnArray(fields), showdiffs, raiseondiff)
         else:
             print("  SKIPPED (could not find table)")
@@ -318,6 +430,10 @@ class Function(Process):
         assert result is None or isinstance(result, Expr)
         self.result = result
 
+        if code is not None:
+            code.live_at_exit = set(v.name for v in result.all_of(Variable)) \
+                if result is not None else set()
+
     def run_guarded(self, context, *args, **kwargs):
         # XXX: wouldn't some form of cascading context make all this junk much
         # cleaner? Context(globalvars, localvars) (globalvars contain both
@@ -0,0 +1,198 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class ProfileNode(object):
+    """
+    node of the call tree recorded by the profiler. Each node corresponds to a
+    process, a step of a function or an expression, within its parent. Times
+    are cumulative (they include the time spent in children nodes).
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.time = 0.0
+        # number of individuals processed (or values returned)
+        self.rows = 0
+        # size of the arrays returned
+        self.bytes = 0
+        self.children = OrderedDict()
+
+    def child(self, name):
+        node = self.children.get(name)
+        if node is None:
+            node = ProfileNode(name)
+            self.children[name] = node
+        return node
+
+    @property
+    def self_time(self):
+        """
+        time spent in this node itself (excluding its children)
+
+        >>> node = ProfileNode('a')
+        >>> node.time = 3.0
+        >>> node.child('b').time = 2.0
+        >>> node.self_time
+        1.0
+        """
+        children_time = sum(c.time for c in self.children.itervalues())
+        return max(self.time - children_time, 0.0)
+
+    def add_result(self, value):
+        if isinstance(value, np.ndarray):
+            self.rows += len(value) if value.shape else 1
+            self.bytes += value.nbytes
+        elif value is not None:
+            self.rows += 1
+
+    def as_dict(self):
+        children = [child.as_dict() for child in self.children.itervalues()]
+        return OrderedDict([('name', self.name),
+                            ('calls', self.calls),
+                            ('time', self.time),
+                            ('self_time', self.self_time),
+                            ('rows', self.rows),
+                            ('bytes', self.bytes),
+                            ('children', children)])
+
+    def walk(self, path=()):
+        """yields (path, node) for all nodes below this one"""
+        for child in self.children.itervalues():
+            child_path = path + (child.name,)
+            yield child_path, child
+            for res in child.walk(child_path):
+                yield res
+
+    def collapsed_stacks(self):
+        """
+        yields one line per node, in the "collapsed stack" format used by
+        flamegraph tools: the names of the nodes from the root separated by
+        semicolons, then the self time of the node (in microseconds).
+
+        >>> root = ProfileNode('<root>')
+        >>> root.child('a').time = 0.003
+        >>> root.child('a').child('b; c').time = 0.001
+        >>> for line in root.collapsed_stacks():
+        ...     print(line)
+        a 2000
+        a;b, c 1000
+        """
+        for path, node in self.walk():
+            names = [stack_name(name) for name in path]
+            yield "%s %d" % (';'.join(names), round(node.self_time * 1e6))
+
+
+def stack_name(name):
+    # semicolons separate frames and the last space separates the count
+    return ' '.join(name.replace(';', ',').split())
+
+
+_root = None
+_stack = []
+
+
+def start():
+    """starts recording a new call tree"""
+    global _root
+    _root = ProfileNode('<root>')
+    del _stack[:]
+    _stack.append(_root)
+
+
+def stop():
+    """stops recording and returns the root of the call tree"""
+    global _root
+    root = _root
+    _root = None
+    del _stack[:]
+    if root is not None:
+        root.calls = 1
+        root.time = sum(child.time for child in root.children.itervalues())
+    return root
+
+
+def enabled():
+    return _root is not None
+
+
+@contextmanager
+def profiled(name, rows=0):
+    """
+    records the time spent in the with block in a node named name (converted
+    to a string) below the current node. Does nothing if the profiler is not
+    enabled. The profiler only records what happens in the main thread, so
+    processes must not be run concurrently while profiling.
+    """
+    if _root is None:
+        yield None
+        return
+    node = _stack[-1].child(str(name))
+    node.rows += rows
+    _stack.append(node)
+    start_time = time.time()
+    try:
+        yield node
+    finally:
+        node.time += time.time() - start_time
+        node.calls += 1
+        _stack.pop()
+
+
+def profiled_call(name, func, *args, **kwargs):
+    """
+    calls func(*args, **kwargs) within profiled(name) and records the size of
+    its result
+    """
+    with profiled(name) as node:
+        res = func(*args, **kwargs)
+    if node is not None:
+        node.add_result(res)
+    return res
+
+
+def save(root, json_path, stacks_path):
+    with open(json_path, 'w') as f:
+        json.dump(root.as_dict(), f, indent=1)
+    with open(stacks_path, 'w') as f:
+        for line in root.collapsed_stacks():
+            f.write(line + '\n')
+
+
+def top_self_times(root, count):
+    """
+    returns the count nodes with the largest self time, as (name, time)
+    pairs. Each name includes the names of the process and function steps
+    containing the node. Names which are equal once shortened get a suffix.
+
+    >>> root = ProfileNode('<root>')
+    >>> root.child('a' * 70).time = 0.1
+    >>> root.child('a' * 69 + 'b').time = 0.2
+    >>> for name, time in top_self_times(root, 2):
+    ...     print(name[54:], time)
+    aaa... (2) 0.2
+    aaa... 0.1
+    """
+    times = []
+    num_seen = {}
+    for path, node in root.walk():
+        name = ' > '.join(short_name(part) for part in path)
+        num = num_seen.get(name, 0) + 1
+        num_seen[name] = num
+        if num > 1:
+            name = '%s (%d)' % (name, num)
+        times.append((name, node.self_time))
+    times.sort(key=lambda item: item[1], reverse=True)
+    return times[:count]
+
+
+def short_name(name, maxlen=60):
+    name = stack_name(name)
+    return name if len(name) <= maxlen else name[:maxlen - 3] + '...'
@@ -0,0 +1,205 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import hashlib
+import random
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+_current = threading.local()
+
+
+class RandomStream(object):
+    """
+    an independent source of random numbers: a numpy RandomState (or a
+    CommonRandomState if common is True) and a Python Random seeded with the
+    same seed.
+    """
+    def __init__(self, seed=None, common=False):
+        self.np = CommonRandomState(seed) if common \
+            else np.random.RandomState(seed)
+        self.py = random.Random(seed)
+
+    def seed(self, seed=None):
+        self.np.seed(seed)
+        self.py.seed(seed)
+
+
+def stream_seed(*keys):
+    """
+    returns a seed (an integer between 0 and 2 ** 32 - 1) derived from keys.
+    The same keys always give the same seed, and (almost always) different
+    keys give unrelated seeds.
+
+    >>> stream_seed(0, 2002, 'person', 'ageing')
+    944068416
+    >>> stream_seed(0, 2002, 'person', 'ageing') == stream_seed(0, 2003,
+    ...                                                          'person',
+    ...                                                          'ageing')
+    False
+    """
+    digest = hashlib.md5(repr(keys)).hexdigest()
+    return int(digest[:8], 16)
+
+
+def counter_uniform(key, counters):
+    """
+    returns uniform floats in [0, 1), one for each counter. Each number only
+    depends on key and on the corresponding counter.
+
+    >>> u = counter_uniform(42, np.array([0, 1, 2, 3]))
+    >>> bool(((u >= 0) & (u < 1)).all())
+    True
+    >>> bool((counter_uniform(42, np.array([2, 3])) == u[2:]).all())
+    True
+    """
+    # SplitMix64 finalizer applied to key + counter * golden ratio
+    # (overflows wrap around, which is what we want)
+    x = np.asarray(counters).astype(np.uint64)
+    x = x * np.uint64(0x9E3779B97F4A7C15) + np.uint64(key)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    # keep the 53 most significant bits (the precision of a float64)
+    return (x >> np.uint64(11)) * (1.0 / 2 ** 53)
+
+
+class CommonRandomState(object):
+    """
+    counter-based replacement for numpy's RandomState. The numbers drawn for an
+    individual only depend on the seed, the function, the number of previous
+    calls to that function and the id of the individual (see drawing_for) but
+    not on the other individuals. This makes it possible to use common random
+    numbers in variants of a model. Functions which are not implemented here
+    use a normal RandomState.
+    """
+    def __init__(self, seed=None):
+        self.ids = None
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self.key = seed
+        self.calls = defaultdict(int)
+        self.fallback = np.random.RandomState(seed)
+
+    def __getattr__(self, key):
+        return getattr(self.fallback, key)
+
+    def _counters(self, size):
+        ids = self.ids
+        if size is None:
+            return 0
+        elif ids is not None and np.isscalar(size) and size == len(ids):
+            return ids
+        else:
+            return np.arange(np.prod(size)).reshape(size)
+
+    def _uniforms(self, funcname, size, num=1):
+        """returns num independent uniform draws in [0, 1)"""
+        self.calls[funcname] += 1
+        counters = self._counters(size)
+        res = [counter_uniform(stream_seed(self.key, funcname,
+                                           self.calls[funcname], i), counters)
+               for i in range(num)]
+        if size is None:
+            res = [float(u) for u in res]
+        return res
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        u, = self._uniforms('uniform', size)
+        return low + (high - low) * u
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        u1, u2 = self._uniforms('normal', size, 2)
+        # Box-Muller transform (1 - u1 is in ]0, 1])
+        z = np.sqrt(-2 * np.log1p(-u1)) * np.cos(2 * np.pi * u2)
+        return loc + scale * z
+
+    def randint(self, low, high=None, size=None):
+        if high is None:
+            low, high = 0, low
+        u, = self._uniforms('randint', size)
+        return (low + np.floor(u * (high - low))).astype(int)
+
+    def choice(self, a, size=None, replace=True, p=None):
+        if not replace:
+            return self.fallback.choice(a, size, replace, p)
+        values = np.arange(a) if np.isscalar(a) else np.asarray(a)
+        u, = self._uniforms('choice', size)
+        if p is None:
+            indices = np.floor(u * len(values)).astype(int)
+        else:
+            cdf = np.cumsum(p, dtype=float)
+            if abs(cdf[-1] - 1.) > np.sqrt(np.finfo(np.float64).eps):
+                raise ValueError("probabilities do not sum to 1")
+            cdf /= cdf[-1]
+            indices = np.minimum(cdf.searchsorted(u, side='right'),
+                                 len(values) - 1)
+        return values[indices]
+
+
+@contextmanager
+def drawing_for(ids):
+    """
+    within the with block, the counter-based random numbers of the current
+    thread (if any) are drawn for the individuals with the given ids
+    """
+    state = np_random()
+    if not isinstance(state, CommonRandomState):
+        yield
+        return
+    previous = state.ids
+    state.ids = ids
+    try:
+        yield
+    finally:
+        state.ids = previous
+
+
+@contextmanager
+def using_stream(stream):
+    """
+    makes stream the source of random numbers of the current thread within
+    the with block. If stream is None, the current source is kept.
+    """
+    if stream is None:
+        yield
+        return
+    previous = getattr(_current, 'stream', None)
+    _current.stream = stream
+    try:
+        yield
+    finally:
+        _current.stream = previous
+
+
+def current_stream():
+    """returns the stream of the current thread (None if there is none)"""
+    return getattr(_current, 'stream', None)
+
+
+def np_random():
+    """
+    returns the numpy RandomState to use in the current thread (the global
+    numpy one if no stream is active)
+    """
+    stream = getattr(_current, 'stream', None)
+    # np.random.mtrand._rand is what the np.random.* functions use
+    return stream.np if stream is not None else np.random.mtrand._rand
+
+
+def py_random():
+    """
+    returns the Python Random to use in the current thread (the random module
+    if no stream is active)
+    """
+    stream = getattr(_current, 'stream', None)
+    return stream.py if stream is not None else random
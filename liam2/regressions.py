@@ -3,7 +3,7 @@ from __future__ import print_function
 
 from alignment import Alignment
 from expr import (Expr, Variable, BinaryOp, ComparisonOp, missing_values,
-                  getdtype, always)
+                  getdtype, always, as_simple_expr)
 from exprbases import CompoundExpression
 from exprmisc import Exp, Max, Where, Logit, Logistic, ExtExpr
 from exprrandom import Normal, Uniform
@@ -26,20 +26,29 @@ class Regression(CompoundExpression):
 class LogitScore(CompoundExpression):
     funcname = 'logit_score'
 
-    def build_expr(self, context, expr):
+    @staticmethod
+    def score_terms(context, expr):
+        """
+        returns (expr, u) where u is a (temporary) variable containing uniform
+        random numbers and expr is the linear predictor (or None if there is
+        none).
+        """
         if isinstance(expr, basestring):
             # assume it is a filename
             expr = ExtExpr(expr)
-
-        u = Uniform()
         # expr in (0, 0.0, False, '')
         if not isinstance(expr, Expr) and not expr:
-            expr = u
-        else:
-            epsilon = Logit(u)
-            # expr = logistic(expr - epsilon)
-            expr = Logistic(BinaryOp('-', expr, epsilon))
-        return expr
+            expr = None
+        # u is used several times in the expressions below so it must be
+        # computed beforehand
+        return expr, as_simple_expr(Uniform(), context)
+
+    def build_expr(self, context, expr):
+        expr, u = self.score_terms(context, expr)
+        if expr is None:
+            return u
+        # logistic(expr - logit(u))
+        return Logistic(BinaryOp('-', expr, Logit(u)))
 
     dtype = always(float)
 
@@ -48,12 +57,17 @@ class LogitRegr(Regression):
     funcname = 'logit_regr'
 
     def build_expr(self, context, expr, filter=None, align=None):
-        score_expr = LogitScore(expr)
         if align is not None:
             # we do not need add_filter because Alignment already handles it
-            return Alignment(score_expr, align, filter=filter)
+            return Alignment(LogitScore(expr), align, filter=filter)
+        expr, u = LogitScore.score_terms(context, expr)
+        if expr is None:
+            regr_expr = ComparisonOp('>', u, 0.5)
         else:
-            return self.add_filter(ComparisonOp('>', score_expr, 0.5), filter)
+            # logistic(expr - logit(u)) > 0.5 is equivalent to
+            # expr > logit(u), which does not need to compute the score
+            regr_expr = ComparisonOp('>', expr, Logit(u))
+        return self.add_filter(regr_expr, filter)
 
     dtype = always(bool)
 
@@ -6,6 +6,7 @@ import time
 import os.path
 import operator
 from collections import defaultdict
+from itertools import izip
 import random
 import warnings
 
@@ -14,9 +15,13 @@ import tables
 import yaml
 
 from context import EvaluationContext
-from data import VoidSource, H5Source, H5Sink
+from data import data_sources, H5Sink
 from entities import Entity, global_symbols
-from utils import (time2str, timed, gettime, validate_dict,
+from parallel import process_dependencies, run_concurrently
+import profiler
+from random_streams import RandomStream, stream_seed, using_stream
+from process import Function
+from utils import (time2str, size2str, timed, gettime, validate_dict,
                    expand_wild, multi_get, multi_set,
                    merge_dicts, merge_items,
                    field_str_to_type, fields_yaml_to_type,
@@ -57,6 +62,24 @@ def show_top_processes(process_time, count):
     show_top_times('processes', process_times, count)
 
 
+def show_top_temp_memory(entities, count):
+    """
+    shows the functions with the largest peak memory used by temporary
+    variables
+    """
+    peaks = [('%s.%s' % (entity.name, name), process.code.peak_temp_mem)
+             for entity in entities
+             for name, process in entity.processes.iteritems()
+             if isinstance(process, Function) and process.code is not None]
+    peaks = sorted([(name, mem) for name, mem in peaks if mem],
+                   key=operator.itemgetter(1), reverse=True)
+    if not peaks:
+        return
+    print("top %d functions by peak temporary memory:" % count)
+    for name, mem in peaks[:count]:
+        print(" - %s: %s" % (name, size2str(mem)))
+
+
 def show_top_expr(count=None):
     show_top_times('expressions', expr.timings.most_common(count), count)
 
@@ -154,17 +177,28 @@ class Simulation(object):
             },
             '#output': {
                 'path': str,
-                'file': str
+                'file': str,
+                'background_write': bool,
+                'compression': str,
+                'shuffle': bool,
+                'chunk_size': int,
+                'history': str,  # Or('copy', 'link')
             },
             'logging': {
                 'timings': bool,
                 'level': str,  # Or('periods', 'functions', 'processes')
+                'profile': bool,
             },
             '#periods': int,
             '#start_period': int,
             'skip_shows': bool,
             'timings': bool,    # deprecated
             'assertions': str,  # Or('raise', 'warn', 'skip')
+            'block_size': int,
+            'threads': int,
+            'random_streams': bool,
+            'common_random_numbers': bool,
+            'optimize': bool,
             'default_entity': str,
             'autodump': None,
             'autodiff': None,
@@ -174,7 +208,9 @@ class Simulation(object):
 
     def __init__(self, globals_def, periods, start_period, init_processes,
                  processes, entities, input_method, input_path, output_path,
-                 default_entity=None, runs=1, minimal_output=False):
+                 default_entity=None, runs=1, minimal_output=False,
+                 background_write=False, compression=None, shuffle=True,
+                 chunk_size=None, history='copy'):
         """
 
         Parameters
@@ -191,6 +227,22 @@ class Simulation(object):
         default_entity
         runs
         minimal_output
+        background_write : bool
+            whether to write output data in a separate thread, while the next
+            period is being simulated
+        compression : str, optional
+            compression library and level to use for the output file (eg
+            'zlib-5' or 'blosc:lz4-5'). Defaults to None (no compression).
+        shuffle : bool
+            whether to use the shuffle filter when compressing. Defaults to
+            True.
+        chunk_size : int, optional
+            number of rows per chunk of the entity tables in the output file.
+            Defaults to None (let PyTables choose).
+        history : {'copy', 'link'}
+            whether the data of the periods before start_period is copied
+            from the input file to the output file or only linked to.
+            Defaults to 'copy'.
         """
         if 'periodic' in globals_def:
             declared_fields = globals_def['periodic']['fields']
@@ -207,16 +259,13 @@ class Simulation(object):
         self.processes = processes
         self.entities = entities
 
-        if input_method == 'h5':
-            data_source = H5Source(input_path)
-        elif input_method == 'void':
-            data_source = VoidSource()
-        else:
+        if input_method not in data_sources:
             raise ValueError("'%s' is an invalid value for 'method'. It should "
-                             "be either 'h5' or 'void'")
-
-        self.data_source = data_source
-        self.data_sink = H5Sink(output_path)
+                             "be one of: %s"
+                             % (input_method, ', '.join(sorted(data_sources))))
+        self.data_source = data_sources[input_method](input_path)
+        self.data_sink = H5Sink(output_path, background_write, compression,
+                                shuffle, chunk_size, history)
         self.default_entity = default_entity
 
         self.stepbystep = False
@@ -230,7 +279,7 @@ class Simulation(object):
                  start_period=None, periods=None, seed=None,
                  skip_shows=None, skip_timings=None, log_level=None,
                  assertions=None, autodump=None, autodiff=None,
-                 runs=None):
+                 runs=None, optimize=None, profile=None):
         content = yaml.load(yaml_str)
         expand_periodic_fields(content)
         content = handle_imports(content, simulation_dir)
@@ -257,6 +306,13 @@ class Simulation(object):
             print("using fixed random seed: %d" % seed)
             random.seed(seed)
             np.random.seed(seed)
+        config.random_seed = seed
+        config.random_streams = simulation_def.get('random_streams', False)
+        config.common_random_numbers = \
+            simulation_def.get('common_random_numbers', False)
+        if config.common_random_numbers:
+            # common random numbers are drawn from per-process streams
+            config.random_streams = True
 
         if periods is None:
             periods = simulation_def['periods']
@@ -270,6 +326,8 @@ class Simulation(object):
             assertions = simulation_def.get('assertions', config.assertions)
         # TODO: check that the value is one of "raise", "skip", "warn"
         config.assertions = assertions
+        config.block_size = simulation_def.get('block_size')
+        config.threads = simulation_def.get('threads', 1)
 
         logging_def = simulation_def.get('logging', {})
         if log_level is None:
@@ -293,6 +351,10 @@ class Simulation(object):
             show_timings = not skip_timings
         config.show_timings = show_timings
 
+        if profile is None:
+            profile = logging_def.get('profile', False)
+        config.profile = profile
+
         if autodump is None:
             autodump = simulation_def.get('autodump')
         if autodump is True:
@@ -359,35 +421,49 @@ class Simulation(object):
         parsing_context.update((entity.name, entity.all_symbols(global_context))
                                for entity in entities.itervalues())
         # compute the lag variable for each entity (an entity can cause fields from
-        # other entities to be added via links)
-        # dict of sets
-        lag_vars_by_entity = defaultdict(set)
+        # other entities to be added via links) and the number of periods they
+        # need to be kept in memory
+        # dict of dicts
+        lag_vars_by_entity = defaultdict(dict)
         for entity in entities.itervalues():
             parsing_context['__entity__'] = entity.name
             entity.parse_processes(parsing_context)
             entity_lag_vars = entity.compute_lagged_fields()
-            for e in entity_lag_vars:
-                lag_vars_by_entity[e.name] |= entity_lag_vars[e]
-
-        # store that in entity.lag_fields and create entity.array_lag
+            for e, e_lag_vars in entity_lag_vars.iteritems():
+                lag_depths = lag_vars_by_entity[e.name]
+                for name, num_periods in e_lag_vars.iteritems():
+                    lag_depths[name] = max(lag_depths.get(name, 0),
+                                           num_periods)
+
+        if optimize is None:
+            optimize = simulation_def.get('optimize', False)
+        if optimize:
+            print("factoring common subexpressions...")
+            for entity in sorted(entities.values(), key=lambda e: e.name):
+                factored = entity.optimize_processes()
+                for func_name, subexpr, count in factored:
+                    print(" * %s.%s: %s (%d occurrences)"
+                          % (entity.name, func_name, subexpr, count))
+
+        # store that in entity.lag_fields and entity.lag_depths
         for entity in entities.itervalues():
-            entity_lag_vars = lag_vars_by_entity[entity.name]
-            if entity_lag_vars:
+            lag_depths = lag_vars_by_entity[entity.name]
+            if lag_depths:
                 # make sure we have an 'id' column, and that it comes first
                 # (makes debugging easier). 'id' is always necessary for lag
                 # expressions to be able to "expand" the vector of values to the
                 # "current" individuals.
-                entity_lag_vars.discard('id')
-                sorted_vars = ['id'] + sorted(entity_lag_vars)
+                lag_depths['id'] = max(lag_depths.values())
+                sorted_vars = ['id'] + sorted(set(lag_depths) - {'id'})
                 field_type = dict(entity.fields.name_types)
                 lag_fields = [(v, field_type[v]) for v in sorted_vars]
-                # FIXME: this should be initialized to the data from
-                # start_period - 2, if any so that we can use lag() in an init
-                # process
-                entity.array_lag = np.empty(0, dtype=np.dtype(lag_fields))
+                # FIXME: entity.array_lags should be initialized to the data
+                # from start_period - 2, if any so that we can use lag() in an
+                # init process
             else:
                 lag_fields = []
             entity.lag_fields = lag_fields
+            entity.lag_depths = lag_depths
 
         # compute minimal fields for each entity and set all which are not
         # minimal to output=False
@@ -395,9 +471,9 @@ class Simulation(object):
             min_fields_by_entity = defaultdict(set)
             for entity in entities.itervalues():
                 entity_lag_vars = entity.compute_lagged_fields(
-                    inspect_one_period=False)
+                    in_memory=False)
                 for e in entity_lag_vars:
-                    min_fields_by_entity[e.name] |= entity_lag_vars[e]
+                    min_fields_by_entity[e.name] |= set(entity_lag_vars[e])
             for entity in entities.itervalues():
                 minimal_fields = min_fields_by_entity[entity.name]
                 if minimal_fields:
@@ -453,9 +529,16 @@ class Simulation(object):
 
         if runs is None:
             runs = simulation_def.get('runs', 1)
+        background_write = output_def.get('background_write', False)
+        compression = output_def.get('compression')
+        shuffle = output_def.get('shuffle', True)
+        chunk_size = output_def.get('chunk_size')
+        history = output_def.get('history', 'copy')
         return Simulation(globals_def, periods, start_period, init_processes,
                           processes, entities_list, input_method, input_path,
-                          output_path, default_entity, runs, minimal_output)
+                          output_path, default_entity, runs, minimal_output,
+                          background_write, compression, shuffle, chunk_size,
+                          history)
 
     @classmethod
     def from_yaml(cls, fpath,
@@ -464,7 +547,7 @@ class Simulation(object):
                   start_period=None, periods=None, seed=None,
                   skip_shows=None, skip_timings=None, log_level=None,
                   assertions=None, autodump=None, autodiff=None,
-                  runs=None):
+                  runs=None, optimize=None, profile=None):
         with open(fpath) as f:
             return cls.from_str(f, os.path.dirname(os.path.abspath(fpath)),
                                 input_dir, input_file,
@@ -472,7 +555,7 @@ class Simulation(object):
                                 start_period, periods, seed,
                                 skip_shows, skip_timings, log_level,
                                 assertions, autodump, autodiff,
-                                runs)
+                                runs, optimize, profile)
 
     def load(self):
         return timed(self.data_source.load, self.globals_def, self.entities_map)
@@ -513,7 +596,8 @@ class Simulation(object):
                 fname, _ = config.autodiff
                 mode = 'r'
             fpath = os.path.join(config.output_directory, fname)
-            h5_autodump = tables.open_file(fpath, mode=mode)
+            h5_autodump = tables.open_file(fpath, mode=mode,
+                                           filters=self.data_sink.filters)
             config.autodump_file = h5_autodump
         else:
             h5_autodump = None
@@ -525,6 +609,107 @@ class Simulation(object):
         period_objects = {}
         eval_ctx = EvaluationContext(self, self.entities_map, globals_data)
 
+        # processes only run concurrently when their output does not need to
+        # be interleaved with the "processes" log or autodump/autodiff and
+        # when they are not profiled
+        concurrent = (config.threads > 1 and
+                      config.log_level != "processes" and
+                      not config.autodump and not config.autodiff and
+                      not config.profile)
+        if concurrent:
+            dependencies = {
+                id(processes): process_dependencies([p for p, _ in processes])
+                for processes in (self.init_processes, self.processes)}
+
+        if config.random_streams:
+            # the random streams of all processes are derived from this seed
+            streams_seed = config.random_seed
+            if streams_seed is None:
+                streams_seed = np.random.randint(2 ** 31)
+
+        def process_streams(period, processes):
+            """
+            returns the random stream of each process (None for all processes
+            if random streams are not used). The stream of a process only
+            depends on the seed, the run, the period and the process itself,
+            so that adding or removing other processes does not change it.
+            """
+            if not config.random_streams:
+                return [None] * len(processes)
+            occurrences = defaultdict(int)
+            streams = []
+            for process, _ in processes:
+                key = (process.entity.name, process.name)
+                # the same process can be run several times in a period
+                occurrences[key] += 1
+                seed = stream_seed(streams_seed, run_num, period,
+                                   process.entity.name, process.name,
+                                   occurrences[key])
+                streams.append(RandomStream(seed,
+                                            config.common_random_numbers))
+            return streams
+
+        def run_processes_concurrently(period_idx, period, processes):
+            def make_task(process, periodicity, stream):
+                def task():
+                    if period_idx % periodicity != 0:
+                        return None
+                    ctx = eval_ctx.clone(entity_name=process.entity.name)
+                    with using_stream(stream):
+                        elapsed, _ = gettime(process.run_guarded, ctx)
+                    return elapsed
+                return task
+
+            streams = process_streams(period, processes)
+            tasks = [make_task(process, periodicity, stream)
+                     for (process, periodicity), stream in izip(processes,
+                                                                streams)]
+            results = run_concurrently(tasks, dependencies[id(processes)],
+                                       config.threads)
+            num_processes = len(processes)
+            for p_num, (process_def, elapsed) in enumerate(izip(processes,
+                                                                results),
+                                                           start=1):
+                process, _ = process_def
+                if config.log_level == "functions":
+                    print("- %d/%d" % (p_num, num_processes), process.name,
+                          end=' ')
+                    print("...", end=' ')
+                    if elapsed is None:
+                        print("skipped (periodicity)")
+                process_time[process.name] += elapsed or 0
+                if config.log_level == "functions":
+                    if config.show_timings:
+                        print("done (%s elapsed)." % time2str(elapsed or 0))
+                    else:
+                        print("done.")
+                self.start_console(eval_ctx)
+
+        def process_label(process):
+            return '%s.%s' % (process.entity.name, process.name)
+
+        def load_period_data(period, entities):
+            if config.log_level in ("functions", "processes"):
+                print("- loading input data")
+                for entity in entities:
+                    print("  *", entity.name, "...", end=' ')
+                    timed(entity.load_period_data, period)
+                    print("    -> %d individuals" % len(entity.array))
+            else:
+                for entity in entities:
+                    entity.load_period_data(period)
+
+        def store_period_data(period, entities):
+            if config.log_level in ("functions", "processes"):
+                print("- storing period data")
+                for entity in entities:
+                    print("  *", entity.name, "...", end=' ')
+                    timed(entity.store_period_data, period)
+                    print("    -> %d individuals" % len(entity.array))
+            else:
+                for entity in entities:
+                    entity.store_period_data(period)
+
         def simulate_period(period_idx, period, processes, entities,
                             init=False):
             period_start_time = time.time()
@@ -541,21 +726,17 @@ class Simulation(object):
                     print("  * %s: %d individuals" % (entity.name,
                                                       len(entity.array)))
             else:
-                if config.log_level in ("functions", "processes"):
-                    print("- loading input data")
-                    for entity in entities:
-                        print("  *", entity.name, "...", end=' ')
-                        timed(entity.load_period_data, period)
-                        print("    -> %d individuals" % len(entity.array))
-                else:
-                    for entity in entities:
-                        entity.load_period_data(period)
+                with profiler.profiled('load period data'):
+                    load_period_data(period, entities)
             for entity in entities:
                 entity.array_period = period
                 entity.array['period'] = period
 
-            if processes:
+            if processes and concurrent and not self.stepbystep:
+                run_processes_concurrently(period_idx, period, processes)
+            elif processes:
                 num_processes = len(processes)
+                streams = process_streams(period, processes)
                 for p_num, process_def in enumerate(processes, start=1):
                     process, periodicity = process_def
 
@@ -567,7 +748,11 @@ class Simulation(object):
                               end=' ')
                         print("...", end=' ')
                     if period_idx % periodicity == 0:
-                        elapsed, _ = gettime(process.run_guarded, eval_ctx)
+                        with using_stream(streams[p_num - 1]), \
+                                profiler.profiled(process_label(process),
+                                                  len(process.entity.array)):
+                            elapsed, _ = gettime(process.run_guarded,
+                                                 eval_ctx)
                     else:
                         elapsed = 0
                         if config.log_level in ("functions", "processes"):
@@ -581,15 +766,10 @@ class Simulation(object):
                             print("done.")
                     self.start_console(eval_ctx)
 
-            if config.log_level in ("functions", "processes"):
-                print("- storing period data")
-                for entity in entities:
-                    print("  *", entity.name, "...", end=' ')
-                    timed(entity.store_period_data, period)
-                    print("    -> %d individuals" % len(entity.array))
-            else:
-                for entity in entities:
-                    entity.store_period_data(period)
+            with profiler.profiled('store period data'):
+                store_period_data(period, entities)
+            # cache entries are only valid for the current period
+            expr.expr_cache.clear()
 #            print " - compressing period data"
 #            for entity in entities:
 #                print "  *", entity.name, "...",
@@ -623,6 +803,8 @@ class Simulation(object):
  starting simulation
 =====================""")
         try:
+            if config.profile:
+                profiler.start()
             simulate_period(0, self.start_period - 1, self.init_processes,
                             self.entities, init=True)
             main_start_time = time.time()
@@ -631,6 +813,8 @@ class Simulation(object):
             for period_idx, period in enumerate(periods):
                 simulate_period(period_idx, period,
                                 self.processes, self.entities)
+            # wait for the data of the last period(s) to be written
+            self.data_sink.flush()
 
             total_objects = sum(period_objects[period] for period in periods)
             avg_objects = str(total_objects // self.periods) \
@@ -650,6 +834,10 @@ class Simulation(object):
 """ % (time2str(time.time() - start_time), avg_objects, ind_per_sec))
 
             show_top_processes(process_time, 10)
+            show_top_temp_memory(self.entities, 10)
+            self.data_sink.show_sizes()
+            if config.profile:
+                self.save_profile(profiler.stop(), run_num)
 #            if config.debug:
 #                show_top_expr()
 
@@ -668,6 +856,7 @@ class Simulation(object):
                 c.run()
 
         finally:
+            profiler.stop()
             self.close()
             if h5_autodump is not None:
                 h5_autodump.close()
@@ -681,6 +870,19 @@ class Simulation(object):
                     print("WARNING: could not delete temporary directory: %r"
                           % dirname)
 
+    def save_profile(self, root, run_num):
+        """
+        writes the call tree recorded by the profiler to profile.json and
+        profile.folded (collapsed stacks) in the output directory and shows
+        the nodes with the largest self time
+        """
+        fname = 'profile_%d' % run_num if self.runs > 1 else 'profile'
+        fpath = os.path.join(config.output_directory, fname)
+        profiler.save(root, fpath + '.json', fpath + '.folded')
+        show_top_times('nodes by self time', profiler.top_self_times(root, 10),
+                       10)
+        print("profile written to '%s.json' and '%s.folded'" % (fpath, fpath))
+
     def run(self, run_console=False):
         for i in range(int(self.runs)):
             self.run_single(run_console, i)
@@ -692,5 +894,7 @@ class Simulation(object):
             self.stepbystep = res == "step"
 
     def close(self):
-        self.data_source.close()
+        # the sink must be closed first, because it might still be writing
+        # in the background
         self.data_sink.close()
+        self.data_source.close()
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import json
 import os
 import pkg_resources
 from itertools import chain
 
+import pytest
+import tables
+
 from liam2.simulation import Simulation
 from liam2.importer import csv2h5
+from liam2.utils import array_nan_equal
 
 use_travis = os.environ.get('USE_TRAVIS', None) == 'true'
 
@@ -45,6 +50,302 @@ def test_functional():
         yield run_file, test_file
 
 
+def run_model(yaml_str):
+    """
+    runs a model given as a string, using the data of the functional tests,
+    and returns the path of its output file
+    """
+    simulation = Simulation.from_str(yaml_str,
+                                     os.path.join(test_root, 'functional'),
+                                     output_dir=os.path.join(test_root,
+                                                             'output'))
+    simulation.run()
+    return simulation.data_sink.output_path
+
+
+def read_entity(fpath, entity_name):
+    with tables.open_file(fpath) as h5file:
+        return h5file.get_node('/entities', entity_name).read()
+
+
+def tables_equal(table1, table2):
+    return (table1.dtype == table2.dtype and len(table1) == len(table2) and
+            all(array_nan_equal(table1[name], table2[name])
+                for name in table1.dtype.names))
+
+
+random_streams_model = """
+entities:
+    household:
+        fields:
+            - hh_u:     {{type: float, initialdata: False}}
+
+        processes:
+            draw:
+                - hh_u: uniform()
+
+    person:
+        fields:
+            - age:      int
+            - u:        {{type: float, initialdata: False}}
+            - n:        {{type: float, initialdata: False}}
+
+        processes:
+            draw:
+                - u: uniform()
+
+            other_draw:
+                - n: normal()
+
+simulation:
+    processes:
+{processes}
+
+    start_period: 2002
+    periods: 2
+    random_seed: 0
+    random_streams: {random_streams}
+    threads: {threads}
+
+    input:
+        file: small.h5
+
+    output:
+        path: output
+        file: {output_file}
+"""
+
+
+def run_random_streams_model(output_file, processes, random_streams=True,
+                             threads=1):
+    processes = '\n'.join('        - %s' % p for p in processes)
+    yaml_str = random_streams_model.format(processes=processes,
+                                           random_streams=random_streams,
+                                           threads=threads,
+                                           output_file=output_file)
+    fpath = run_model(yaml_str)
+    return read_entity(fpath, 'person'), read_entity(fpath, 'household')
+
+
+def test_random_streams_inserted_process():
+    # inserting a process drawing random numbers before another process does
+    # not change the numbers drawn by the latter
+    base = ['person: [draw]', 'household: [draw]']
+    inserted = ['person: [other_draw, draw]', 'household: [draw]']
+    person, household = run_random_streams_model('rs_base.h5', base)
+    person2, household2 = run_random_streams_model('rs_inserted.h5',
+                                                   inserted)
+    assert array_nan_equal(person['u'], person2['u'])
+    assert array_nan_equal(household['hh_u'], household2['hh_u'])
+
+    # ... while it does without random streams
+    person, _ = run_random_streams_model('rs_base_nostreams.h5', base,
+                                         random_streams=False)
+    person2, _ = run_random_streams_model('rs_inserted_nostreams.h5',
+                                          inserted, random_streams=False)
+    assert not array_nan_equal(person['u'], person2['u'])
+
+
+def test_random_streams_threads():
+    # the results do not depend on whether processes are run concurrently
+    processes = ['person: [draw]', 'household: [draw]', 'person: [other_draw]']
+    person, household = run_random_streams_model('rs_threads1.h5', processes,
+                                                 threads=1)
+    person2, household2 = run_random_streams_model('rs_threads2.h5',
+                                                   processes, threads=2)
+    assert tables_equal(person, person2)
+    assert tables_equal(household, household2)
+
+
+import_model = """
+output: {output_file}
+{options}
+
+globals:
+    ARRAY:
+        path: {data_dir}/param/mig.csv
+        type: float
+
+    othertable_noperiod:
+        path: {data_dir}/param/othertable.csv
+        fields:
+            - INTFIELD: int
+            - FLOATFIELD: float
+
+entities:
+    household:
+        path: {data_dir}/param/household.csv
+
+    person:
+        fields:
+            - dead:       bool
+            - age:        int
+            - gender:     bool
+            - work:       bool
+            - partner_id: int
+            - hh_id:      int
+            - f_id:       int
+            - m_id:       int
+
+        newnames:
+            value: eval('{{basename}}'[2:])
+            time: period
+            co_alive: dead
+
+        files:
+            - {data_dir}/param/person.csv
+            - {data_dir}/param/p_age.txt
+            - {data_dir}/param/p_work.txt
+
+        interpolate:
+            work: previous_value
+
+        invert: [dead]
+"""
+
+
+def run_import(output_file, buffersize=10 * 2 ** 20, **options):
+    """
+    imports the csv files of the functional tests to output_file (in the test
+    output directory), using the import options given, and returns the
+    content of all its nodes as a {path: array} dict
+    """
+    output_dir = os.path.join(test_root, 'output')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    options = '\n'.join('%s: %s' % item for item in sorted(options.items()))
+    yaml_str = import_model.format(output_file=output_file, options=options,
+                                   data_dir=os.path.join(test_root,
+                                                         'functional'))
+    import_file = os.path.join(output_dir,
+                               os.path.splitext(output_file)[0] + '.yml')
+    with open(import_file, 'w') as f:
+        f.write(yaml_str)
+    csv2h5(import_file, buffersize)
+    with tables.open_file(os.path.join(output_dir, output_file)) as h5file:
+        return dict((node._v_pathname, node.read())
+                    for node in h5file.walk_nodes('/', 'Leaf'))
+
+
+def assert_imports_equal(nodes1, nodes2):
+    assert sorted(nodes1.keys()) == sorted(nodes2.keys())
+    for path, array1 in nodes1.items():
+        array2 = nodes2[path]
+        if array1.dtype.names is not None:
+            assert tables_equal(array1, array2), path
+        else:
+            assert array1.dtype == array2.dtype, path
+            assert array_nan_equal(array1, array2), path
+
+
+def test_import_last_rows():
+    # the values of the last row of each file used to be lost (except for
+    # interpolated fields) when merging several files
+    person = run_import('import_last_rows.h5')['/entities/person']
+    person = person[person['period'] == 2001]
+    # last row of param/person.csv
+    row = person[person['id'] == 6301]
+    assert row['partner_id'] == [3473]
+    assert row['hh_id'] == [1627]
+    assert not row['dead']
+    # last row of param/p_age.txt
+    row = person[person['id'] == 6500]
+    assert row['age'] == [19]
+
+
+def test_import_out_of_core():
+    # merging the files of an entity on disk gives the same result as merging
+    # them in memory
+    in_memory = run_import('import_in_memory.h5')
+    out_of_core = run_import('import_out_of_core.h5', out_of_core=True)
+    assert '/entities/person' in in_memory
+    assert_imports_equal(in_memory, out_of_core)
+
+
+def test_import_processes():
+    # importing with several processes gives the same result as a sequential
+    # import. Small blocks are used so that each file is split in many blocks.
+    sequential = run_import('import_sequential.h5')
+    parallel = run_import('import_processes.h5', buffersize=16 * 1024,
+                          processes=2)
+    assert_imports_equal(sequential, parallel)
+
+
+unknown_category_model = """
+entities:
+    person:
+        fields:
+            - age:      int
+            - gender:   bool
+
+        processes:
+            test:
+                - value: extexpr('regr_test_unknown.csv')
+
+simulation:
+    processes:
+        - person: [test]
+
+    start_period: 2002
+    periods: 1
+
+    input:
+        file: small.h5
+
+    output:
+        path: output
+        file: extexpr.h5
+"""
+
+
+def test_extexpr_unknown_category():
+    # regr_test_unknown.csv only has coefficients for gender == False
+    with pytest.raises(Exception, match=r"regr_test_unknown\.csv: no "
+                                        r"coefficients for gender == True"):
+        run_model(unknown_category_model)
+
+
+def profile_nodes(node):
+    yield node
+    for child in node['children']:
+        for res in profile_nodes(child):
+            yield res
+
+
+def test_profile():
+    output_dir = os.path.join(test_root, 'output')
+    simulation = Simulation.from_yaml(os.path.join(test_root, 'functional',
+                                                   'profile.yml'),
+                                      output_dir=output_dir)
+    simulation.run()
+
+    with open(os.path.join(output_dir, 'profile.json')) as f:
+        root = json.load(f)
+    nodes = list(profile_nodes(root))
+    names = [node['name'] for node in nodes]
+    for name in ('person.ageing', 'person.scores', 'compute_score()',
+                 'household.size', 'load period data', 'store period data'):
+        assert name in names
+    for node in nodes:
+        assert node['calls'] >= 1
+        children_time = sum(child['time'] for child in node['children'])
+        # self time + time of children == cumulative time
+        assert abs(node['self_time'] + children_time - node['time']) < 1e-6
+    assert root['time'] == sum(child['time'] for child in root['children'])
+
+    # one line per node (except the root) with its self time in microseconds
+    with open(os.path.join(output_dir, 'profile.folded')) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == len(nodes) - 1
+    total_us = 0
+    for line in lines:
+        stack, self_time = line.rsplit(' ', 1)
+        assert stack
+        total_us += int(self_time)
+    # each line is rounded to the microsecond
+    assert abs(total_us - root['time'] * 1e6) <= len(lines)
+
+
 def test_examples():
     # No pyqt4 on travis
     need_qt = ('demo02.yml', 'demo03.yml', 'demo04.yml', 'demo06.yml')
@@ -0,0 +1,61 @@
+import random
+
+import numpy as np
+
+import align_link
+from align_link import align_link_nd, py_align_households
+from calign import align_households
+
+
+def random_case(seed, shape, num_persons, num_households):
+    """
+    returns the arguments of align_link_nd for a random population. Some
+    households have several members in the same bin and some have no
+    (candidate) member at all.
+    """
+    rng = np.random.RandomState(seed)
+    fcols_labels = [rng.randint(0, size, num_persons) for size in shape]
+    # household of each member (in hh_members order). The first household
+    # has three members and the last one has none.
+    hh_id = np.sort(rng.randint(1, num_households - 1, num_persons))
+    hh_id[:3] = 0
+    hh_members = rng.permutation(num_persons)
+    # the members of the first household have the same labels
+    for labels in fcols_labels:
+        labels[hh_members[1:3]] = labels[hh_members[0]]
+    hh_indptr = np.concatenate(([0], np.cumsum(np.bincount(
+        hh_id, minlength=num_households))))
+    bins = np.ravel_multi_index(fcols_labels, shape)
+    num_candidates = np.bincount(bins, minlength=np.prod(shape))
+    num_candidates = num_candidates.reshape(shape)
+    # some bins need more individuals than there are candidates
+    need = rng.randint(0, 5, shape) * num_candidates // 3
+    scores = rng.uniform(size=num_households)
+    return scores, need, num_candidates, hh_indptr, hh_members, fcols_labels
+
+
+def align_with(kernel, seed, args, secondary_axis):
+    orig_kernel = align_link.align_households
+    align_link.align_households = kernel
+    try:
+        random.seed(seed)
+        return align_link_nd(*args, secondary_axis=secondary_axis)
+    finally:
+        align_link.align_households = orig_kernel
+
+
+def test_python_and_c_kernels():
+    for seed in range(20):
+        args = random_case(seed, (3, 4), 200, 80)
+        hh_indptr, hh_members = args[3], args[4]
+        bins = np.ravel_multi_index(args[5], (3, 4))[hh_members]
+        first_hh_bins = bins[hh_indptr[0]:hh_indptr[1]]
+        assert len(first_hh_bins) == 3 and len(set(first_hh_bins)) == 1
+        for secondary_axis in (None, 0, 1):
+            c_aligned, c_still_needed = \
+                align_with(align_households, seed, args, secondary_axis)
+            py_aligned, py_still_needed = \
+                align_with(py_align_households, seed, args, secondary_axis)
+            assert np.any(c_aligned)
+            assert np.array_equal(c_aligned, py_aligned)
+            assert np.array_equal(c_still_needed, py_still_needed)
@@ -3,12 +3,22 @@ from __future__ import print_function
 
 import numpy as np
 
-from context import context_length
-from expr import (expr_eval, getdtype, hasvalue, FunctionExpr, always,
+from context import context_length, empty_context
+from expr import (Expr, Variable, UnaryOp, BinaryOp, expr_eval, getdtype,
+                  hasvalue, traverse_expr, FunctionExpr, always,
                   firstarg_dtype, get_default_value)
+from exprbases import NumexprFunction
+from exprmisc import Trunc, Round
 from utils import safe_put
 
 
+# expression nodes which compute the value for each row only from the values
+# of that row. Expressions made exclusively of those can be evaluated on the
+# rows of several periods at once.
+ROWWISE_NODE_TYPES = (Variable, UnaryOp, BinaryOp, NumexprFunction, Trunc,
+                      Round)
+
+
 class TimeFunction(FunctionExpr):
     no_eval = ('expr',)
 
@@ -51,6 +61,75 @@ class TimeFunction(FunctionExpr):
         else:
             return result
 
+    @staticmethod
+    def values_for_periods(expr, periods, context):
+        """
+        Returns a list of (period, ids, values) for each period in periods
+        (consecutive and sorted). When possible, each field used in expr is
+        read in one go for all those periods (rows of consecutive periods are
+        contiguous in the output table) and expr is evaluated only once.
+        """
+        data = TimeFunction.read_periods(expr, periods, context)
+        if data is not None:
+            values = expr_eval(expr, context.clone(entity_data=data))
+            # constant expressions are not expanded
+            if isinstance(values, np.ndarray) and \
+                    values.shape == (context_length(data),):
+                ids = data['id']
+                output_rows = context.entity.output_rows
+                first_row = output_rows[periods[0]][0]
+                result = []
+                for period in periods:
+                    start, stop = output_rows[period]
+                    start, stop = start - first_row, stop - first_row
+                    result.append((period, ids[start:stop],
+                                   values[start:stop]))
+                return result
+
+        # evaluate period by period
+        return [(period,) + TimeFunction.value_for_period(expr, period,
+                                                          context, fill=None)
+                for period in periods]
+
+    @staticmethod
+    def read_periods(expr, periods, context):
+        """
+        Returns the data (a dict of columns) of all rows of periods needed to
+        evaluate expr or None if expr cannot be evaluated on several periods at
+        once.
+        """
+        entity = context.entity
+        table = entity.table
+        if len(periods) < 2 or table is None:
+            return None
+
+        fields = {'id'}
+        for node in traverse_expr(expr):
+            if not isinstance(node, Expr):
+                continue
+            if not isinstance(node, ROWWISE_NODE_TYPES):
+                return None
+            if isinstance(node, Variable):
+                if (node.entity is not entity or
+                        node.name not in table.dtype.fields):
+                    return None
+                fields.add(node.name)
+
+        # all periods must be present and contiguous in the output table
+        output_rows = entity.output_rows
+        if any(period not in output_rows for period in periods):
+            return None
+        bounds = [output_rows[period] for period in periods]
+        if any(stop != next_start
+               for (_, stop), (next_start, _) in zip(bounds[:-1], bounds[1:])):
+            return None
+
+        start, stop = bounds[0][0], bounds[-1][1]
+        data = empty_context(stop - start)
+        for name in fields:
+            data[name] = entity.read_output(start, stop, name)
+        return data
+
 
 class ValueForPeriod(TimeFunction):
     funcname = 'value_for_period'
@@ -73,39 +152,100 @@ class Lag(TimeFunction):
     dtype = firstarg_dtype
 
 
-class Duration(TimeFunction):
-    no_eval = ('bool_expr',)
+class TimeFunctionState(object):
+    """
+    Running state of a time function: arrays, indexed by id and initialized to
+    zero, which summarize all periods up to (and including) period.
+    """
+    def __init__(self, period, **arrays):
+        self.period = period
+        self.arrays = arrays
+
+    def __getitem__(self, key):
+        return self.arrays[key]
 
-    def compute(self, context, bool_expr):
+    def grow(self, size):
+        """
+        makes sure all arrays can be indexed by ids < size
+        """
+        for name, arr in self.arrays.items():
+            if len(arr) < size:
+                # grow more than strictly necessary to avoid reallocating
+                # every period
+                newarr = np.zeros(max(size, len(arr) * 2), dtype=arr.dtype)
+                newarr[:len(arr)] = arr
+                self.arrays[name] = newarr
+
+
+class IncrementalTimeFunction(TimeFunction):
+    """
+    Base class for time functions aggregating the values of an expression over
+    all past periods (since the base period of the entity). Instead of reading
+    all those periods back on each call, a running state is kept (on the
+    entity) for each expression and only the periods simulated since the last
+    call are added to it.
+    """
+    def compute(self, context, expr):
         entity = context.entity
+        period = context.period
+
+        key = (self.__class__, expr)
+        state = entity.tfunc_states.get(key)
+        if state is None or state.period >= period:
+            # first call or going back in time (e.g. in the console): start
+            # over from the base period
+            state = TimeFunctionState(entity.base_period - 1,
+                                      **self.state_arrays(context, expr))
+            entity.tfunc_states[key] = state
+
+        past_periods = range(state.period + 1, period)
+        for past_period, ids, values in self.values_for_periods(expr,
+                                                                past_periods,
+                                                                context):
+            if len(ids):
+                state.grow(ids.max() + 1)
+                self.update_state(state, past_period, ids, values)
+            state.period = past_period
 
-        baseperiod = entity.base_period
-        period = context.period - 1
-        value = expr_eval(bool_expr, context)
+        ids = entity.array['id']
+        if len(ids):
+            state.grow(ids.max() + 1)
+        return self.state_result(state, context, expr, ids)
 
-        # using a full int so that the "store" type check works
-        result = value.astype(np.int)
-        res_size = len(entity.array)
-        last_period_true = np.full(res_size, period + 1, dtype=np.int)
-
-        id_to_rownum = context.id_to_rownum
-        still_running = value.copy()
-        while np.any(still_running) and period >= baseperiod:
-            ids, values = self.value_for_period(bool_expr, period, context,
-                                                fill=None)
-            missing = np.ones(res_size, dtype=bool)
-            period_value = np.zeros(res_size, dtype=bool)
-            if len(ids):
-                value_rows = id_to_rownum[ids]
-                safe_put(missing, value_rows, False)
-                safe_put(period_value, value_rows, values)
+    def state_arrays(self, context, expr):
+        """
+        returns {name: empty array} for the arrays making up the state
+        """
+        raise NotImplementedError()
+
+    def update_state(self, state, period, ids, values):
+        raise NotImplementedError()
 
-            value = still_running & period_value
-            result += value * (last_period_true - period)
+    def state_result(self, state, context, expr, ids):
+        raise NotImplementedError()
 
-            still_running &= period_value | missing
-            last_period_true[period_value] = period
-            period -= 1
+
+class Duration(IncrementalTimeFunction):
+    def state_arrays(self, context, bool_expr):
+        # for each id: whether the expression was True the last period the
+        # individual was present and since when it has been uninterruptedly
+        # True (periods where the individual is absent do not interrupt it)
+        return {'running': np.zeros(0, dtype=bool),
+                'run_start': np.zeros(0, dtype=int)}
+
+    def update_state(self, state, period, ids, values):
+        running = state['running']
+        new_run = values & ~running[ids]
+        state['run_start'][ids[new_run]] = period
+        running[ids] = values
+
+    def state_result(self, state, context, bool_expr, ids):
+        value = expr_eval(bool_expr, context)
+        # using a full int so that the "store" type check works
+        result = value.astype(np.int)
+        was_running = value & state['running'][ids]
+        run_start = state['run_start'][ids]
+        result[was_running] += context.period - run_start[was_running]
         return result
 
     # TODO: move the check to __init__ and use dtype = always(int)
@@ -114,85 +254,51 @@ class Duration(TimeFunction):
         return int
 
 
-class TimeAverage(TimeFunction):
+class TimeAverage(IncrementalTimeFunction):
     funcname = 'tavg'
 
-    def compute(self, context, expr):
-        entity = context.entity
-
-        baseperiod = entity.base_period
-        period = context.period - 1
-
-        res_size = len(entity.array)
-
-        num_values = np.zeros(res_size, dtype=np.int)
-        # current period
-        last_period_wh_value = np.full(res_size, context.period, dtype=np.int)
-
-        sum_values = np.zeros(res_size, dtype=np.float)
-        id_to_rownum = context.id_to_rownum
-        while period >= baseperiod:
-            ids, values = self.value_for_period(expr, period, context,
-                                                fill=None)
-
-            # filter out lines which are present because there was a value for
-            # that individual at that period but not for that column
-            acceptable_rows = hasvalue(values)
-            acceptable_ids = ids[acceptable_rows]
-            if len(acceptable_ids):
-                acceptable_values = values[acceptable_rows]
-
-                value_rows = id_to_rownum[acceptable_ids]
-
-                has_value = np.zeros(res_size, dtype=bool)
-                safe_put(has_value, value_rows, True)
-
-                period_value = np.zeros(res_size, dtype=np.float)
-                safe_put(period_value, value_rows, acceptable_values)
-
-                num_values += has_value * (last_period_wh_value - period)
-                sum_values += period_value
-                last_period_wh_value[has_value] = period
-            period -= 1
-        return sum_values / num_values
+    def state_arrays(self, context, expr):
+        # for each id: the sum of values and the first period with a value
+        return {'sum': np.zeros(0, dtype=np.float),
+                'has_value': np.zeros(0, dtype=bool),
+                'first_period': np.zeros(0, dtype=int)}
+
+    def update_state(self, state, period, ids, values):
+        # filter out lines which are present because there was a value for
+        # that individual at that period but not for that column
+        acceptable_rows = hasvalue(values)
+        acceptable_ids = ids[acceptable_rows]
+        state['sum'][acceptable_ids] += values[acceptable_rows]
+
+        has_value = state['has_value']
+        first_value_ids = acceptable_ids[~has_value[acceptable_ids]]
+        state['first_period'][first_value_ids] = period
+        has_value[first_value_ids] = True
+
+    def state_result(self, state, context, expr, ids):
+        num_values = np.where(state['has_value'][ids],
+                              context.period - state['first_period'][ids], 0)
+        return state['sum'][ids] / num_values
 
     dtype = always(float)
 
 
-class TimeSum(TimeFunction):
+class TimeSum(IncrementalTimeFunction):
     funcname = 'tsum'
 
-    def compute(self, context, expr):
-        entity = context.entity
-
-        baseperiod = entity.base_period
-        period = context.period - 1
-
+    def state_arrays(self, context, expr):
         typemap = {bool: int, int: int, float: float}
         res_type = typemap[getdtype(expr, context)]
-        res_size = len(entity.array)
-
-        sum_values = np.zeros(res_size, dtype=res_type)
-        id_to_rownum = context.id_to_rownum
-        while period >= baseperiod:
-            ids, values = self.value_for_period(expr, period, context,
-                                                fill=None)
-
-            # filter out lines which are present because there was a value for
-            # that individual at that period but not for that column
-            acceptable_rows = hasvalue(values)
-            acceptable_ids = ids[acceptable_rows]
-            if len(acceptable_ids):
-                acceptable_values = values[acceptable_rows]
-
-                value_rows = id_to_rownum[acceptable_ids]
+        return {'sum': np.zeros(0, dtype=res_type)}
 
-                period_value = np.zeros(res_size, dtype=np.float)
-                safe_put(period_value, value_rows, acceptable_values)
+    def update_state(self, state, period, ids, values):
+        # filter out lines which are present because there was a value for
+        # that individual at that period but not for that column
+        acceptable_rows = hasvalue(values)
+        state['sum'][ids[acceptable_rows]] += values[acceptable_rows]
 
-                sum_values += period_value
-            period -= 1
-        return sum_values
+    def state_result(self, state, context, expr, ids):
+        return state['sum'][ids]
 
     dtype = firstarg_dtype
 
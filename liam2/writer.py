@@ -0,0 +1,75 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import sys
+import threading
+from Queue import Queue
+
+
+# HDF5 (at least as shipped with PyTables) is not thread-safe, so all calls to
+# it which can happen while a BackgroundWriter is running must hold this lock.
+h5lock = threading.RLock()
+
+
+class BackgroundWriter(object):
+    """
+    Runs functions (writing data to an HDF5 file) in a separate thread, in the
+    order they were submitted. At most maxsize functions can be pending:
+    submitting more blocks until the oldest one is done, which caps the memory
+    used by the data waiting to be written.
+
+    If a function fails, the exception is raised in the main thread on the
+    next call to submit() or wait(), and all functions submitted after it are
+    skipped.
+    """
+    def __init__(self, maxsize=1):
+        self.queue = Queue(maxsize)
+        self.exc_info = None
+        self.thread = None
+
+    def _run(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                if func is None:
+                    return
+                if self.exc_info is None:
+                    with h5lock:
+                        func(*args)
+            except Exception:
+                self.exc_info = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        exc_info = self.exc_info
+        if exc_info is not None:
+            self.exc_info = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def submit(self, func, *args):
+        self._check()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name='BackgroundWriter')
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((func, args))
+
+    def wait(self):
+        """
+        waits until all submitted functions are done
+        """
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        """
+        waits until all submitted functions are done and stops the thread.
+        Unlike wait(), this does not raise exceptions which happened in the
+        writer thread.
+        """
+        if self.thread is not None:
+            self.queue.put((None, ()))
+            self.thread.join()
+            self.thread = None
@@ -126,6 +126,8 @@ if build_ext is not None:
     ext_modules = [Extension("cpartition", ["liam2/cpartition.pyx"],
                              include_dirs=[np.get_include()]),
                    Extension("cutils", ["liam2/cutils.pyx"],
+                             include_dirs=[np.get_include()]),
+                   Extension("calign", ["liam2/calign.pyx"],
                              include_dirs=[np.get_include()])]
     extra_kwargs['ext_modules'] = ext_modules
     options["build_ext"] = {}